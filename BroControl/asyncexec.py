@@ -0,0 +1,416 @@
+# An asyncio-based engine for running commands on the hosts of a cluster.
+#
+# This is an alternative to the thread-based MultiMasterManager in
+# ssh_runner (it speaks the same protocol with the same muxer).  Instead of
+# one thread per host, all connections are driven by a single event loop
+# that runs in a background thread, so this scales to many hosts.  The
+# event loop is also the single place where global concurrency limits are
+# enforced.
+#
+# This module requires Python 3.5 or newer and is only imported if the
+# "AsyncExecutor" option is enabled.
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import itertools
+import logging
+import sys
+import threading
+import time
+
+from BroControl import py3bro
+from BroControl import ssh_runner
+from BroControl.ssh_runner import FRAME, REQID, FRAME_READY, FRAME_DONE
+
+Queue = py3bro.Queue
+Empty = py3bro.Empty
+
+# The maximum number of connections that are set up concurrently (i.e.,
+# ssh handshakes and muxer bootstraps).
+MAX_PARALLEL_CONNECTS = 32
+
+# Seconds between heartbeat pings on idle connections.
+HEARTBEAT_INTERVAL = 30
+
+# The errors that writing to the muxer raises if the connection is gone.
+CONNECTION_ERRORS = (BrokenPipeError, ConnectionResetError)
+
+
+class AsyncSSHMaster:
+    def __init__(self, host, localaddrs):
+        self.host = host
+        self.localaddrs = localaddrs
+        self.proc = None
+        self.reader = None
+        self.alive = False
+
+        # Result queues of the batches in flight, indexed by request ID.
+        self.requests = {}
+
+        # A (maxprocs, semaphore) tuple that limits the number of commands
+        # handed to the muxer at a time (see AsyncMultiMasterManager).
+        self.slots = None
+
+        # Time when something was last received from the muxer.
+        self.last_recv = 0
+
+    def _connection_error_msg(self):
+        # Error message should indicate whether or not ssh is being used.
+        msgstr = "" if self.host in self.localaddrs else "ssh "
+
+        # Error message shows if a connection was previously established.
+        if self.alive:
+            return "Lost %sconnection to host %s" % (msgstr, self.host)
+        else:
+            return "Failed to establish %sconnection to host %s" % (msgstr, self.host)
+
+    # Start ssh (or a local shell) and bootstrap the muxer, unless there is
+    # a running muxer already.
+    async def connect(self):
+        if self.proc:
+            return
+
+        msg = self._connection_error_msg()
+        self.alive = False
+
+        try:
+            self.proc = await asyncio.create_subprocess_exec(
+                *ssh_runner.shell_cmd(self.host, self.localaddrs),
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                start_new_session=True)
+            self.proc.stdin.write(ssh_runner.get_muxer())
+            frame = await asyncio.wait_for(self._read_frame(), ssh_runner.CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            frame = None
+
+        if not frame or frame[0] != FRAME_READY:
+            await self.close()
+            raise Exception("%s: Failed to start command muxer on host %s" % (msg, self.host))
+
+        self.alive = True
+        self.last_recv = time.time()
+        self.reader = asyncio.ensure_future(self._read_frames())
+
+    async def _read_frame(self):
+        hdr = await self.proc.stdout.readexactly(FRAME.size)
+        ftype, length = FRAME.unpack(hdr)
+        payload = await self.proc.stdout.readexactly(length)
+        return ftype, payload
+
+    # Pass on the messages from the muxer to the batches they belong to.
+    async def _read_frames(self):
+        try:
+            while True:
+                ftype, payload = await self._read_frame()
+                self.last_recv = time.time()
+
+                if ftype == FRAME_DONE:
+                    reqid, idx, res = REQID.unpack(payload)[0], None, None
+                else:
+                    reqid, idx, res = ssh_runner.decode_result(payload)
+
+                q = self.requests.get(reqid)
+                if q:
+                    q.put_nowait((idx, res))
+        except asyncio.CancelledError:
+            raise
+        except asyncio.IncompleteReadError:
+            self._connection_lost("Lost connection to host %s" % self.host)
+        except Exception as e:
+            # E.g., a read error or a garbled frame.  Either way, the
+            # results of the batches in flight will not arrive.
+            self._connection_lost("Lost connection to host %s: %s" % (self.host, e))
+
+    # Fail all batches in flight and close the connection.
+    def _connection_lost(self, msg):
+        logging.debug(msg)
+        for q in self.requests.values():
+            q.put_nowait((None, Exception(msg)))
+        asyncio.ensure_future(self.close())
+
+    async def close(self):
+        proc, self.proc = self.proc, None
+        if not proc:
+            return
+
+        self.alive = False
+        if self.reader:
+            self.reader.cancel()
+        self.reader = None
+
+        # Closing stdin makes the muxer kill any commands that are still
+        # running before it exits, so give it a moment to do so.
+        proc.stdin.close()
+        try:
+            await asyncio.wait_for(proc.wait(), 1)
+        except asyncio.TimeoutError:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+            await proc.wait()
+
+    # Run a batch of commands and call "callback(idx, result)" for each
+    # command as soon as it finishes.  If the coroutine is cancelled, then
+    # the commands are killed on the host.
+    async def run_batch(self, reqid, cmds, shell, timeout, limits, callback):
+        pending = set(range(len(cmds)))
+        failure = None
+
+        if not self.requests:
+            # Start watching the connection for silence from now on.
+            self.last_recv = time.time()
+
+        q = asyncio.Queue()
+        self.requests[reqid] = q
+
+        try:
+            msgstr = "" if self.host in self.localaddrs else "ssh "
+            if not self.proc:
+                # The connection was lost before the batch could be sent.
+                failure = Exception("Lost %sconnection while running command on host %s" % (msgstr, self.host))
+            else:
+                try:
+                    self.proc.stdin.write(ssh_runner.batch_frame(cmds, timeout, shell, reqid, *limits))
+                    await self.proc.stdin.drain()
+                except CONNECTION_ERRORS as e:
+                    # Writing to the muxer failed, so the connection is gone.
+                    failure = Exception("Lost %sconnection while running command on host %s: %s" % (msgstr, self.host, e))
+                    self._connection_lost(str(failure))
+
+            while pending and not failure:
+                # The muxer kills commands that exceed their timeout, so
+                # while commands are outstanding, something must arrive
+                # within that time.
+                wait = max(self.last_recv + timeout + ssh_runner.COMMAND_GRACE - time.time(), 0)
+                try:
+                    idx, res = await asyncio.wait_for(q.get(), wait)
+                except asyncio.TimeoutError:
+                    if self.last_recv + timeout + ssh_runner.COMMAND_GRACE <= time.time():
+                        self._connection_lost("Command timeout on host %s" % self.host)
+                    continue
+
+                if idx is None:
+                    failure = res or Exception("No result received from host %s" % self.host)
+                    break
+
+                pending.discard(idx)
+                callback(idx, res)
+
+        except asyncio.CancelledError:
+            if self.proc:
+                try:
+                    self.proc.stdin.write(ssh_runner.cancel_frame(reqid))
+                except CONNECTION_ERRORS:
+                    pass
+            raise
+
+        finally:
+            del self.requests[reqid]
+
+        for idx in sorted(pending):
+            callback(idx, failure)
+
+    # Send an explicit "ping" through the muxer.  This is only used as a
+    # heartbeat while the host is idle.
+    async def ping(self, reqid):
+        results = []
+        await self.run_batch(reqid, [["/bin/echo", "ping"]], False, ssh_runner.CONNECT_TIMEOUT, (0, None), lambda idx, res: results.append(res))
+        if isinstance(results[0], Exception) or results[0].stdout.strip() != "ping":
+            await self.close()
+
+
+class AsyncMultiMasterManager:
+    # This class provides the same interface as the MultiMasterManager that
+    # is used by the Executor.  The methods are called from other threads
+    # and hand the work over to the event loop.
+    def __init__(self, localaddrs=[]):
+        self.localaddrs = localaddrs
+        self.masters = {}
+        self.reqids = itertools.count(1)
+        self.maxprocs = 0
+        self.cmdlimits = {}
+
+        self.loop = asyncio.new_event_loop()
+
+        # Before Python 3.8, subprocesses can only be used with an event
+        # loop in another thread if the child watcher (which must be set up
+        # in the main thread) is attached to it.
+        if sys.version_info < (3, 8):
+            asyncio.get_child_watcher().attach_loop(self.loop)
+
+        ready = threading.Event()
+        self.thread = threading.Thread(target=self._run_loop, args=(ready,))
+        self.thread.daemon = True
+        self.thread.start()
+        ready.wait()
+
+    def _run_loop(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.connects = asyncio.Semaphore(MAX_PARALLEL_CONNECTS)
+        self.loop.create_task(self._heartbeat())
+        self.loop.call_soon(ready.set)
+        self.loop.run_forever()
+
+    # Run a coroutine in the event loop and wait for its result.
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def set_limits(self, maxprocs, cmdlimits):
+        self.maxprocs = maxprocs
+        self.cmdlimits = cmdlimits
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            for master in list(self.masters.values()):
+                if master.proc and not master.requests:
+                    asyncio.ensure_future(master.ping(next(self.reqids)))
+
+    async def _run_host(self, host, hostcmds, shell, timeout, put):
+        master = self.masters.get(host)
+        if not master:
+            master = self.masters[host] = AsyncSSHMaster(host, self.localaddrs)
+
+        try:
+            if not master.proc:
+                async with self.connects:
+                    await master.connect()
+        except Exception as e:
+            logging.debug(str(e))
+            for i, cmd in hostcmds:
+                put((i, host, e))
+            return
+
+        limits = (self.maxprocs, self.cmdlimits)
+
+        if not self.maxprocs:
+            def callback(idx, res):
+                put((hostcmds[idx][0], host, res))
+
+            await master.run_batch(next(self.reqids), [cmd for (i, cmd) in hostcmds], shell, timeout, limits, callback)
+            return
+
+        # Only "maxprocs" commands (of all batches) are handed to the host
+        # at a time, each as a batch of its own, so that the next command
+        # is sent as soon as any of them finishes.  The muxer still applies
+        # the limits per type of command.
+        if not master.slots or master.slots[0] != self.maxprocs:
+            master.slots = (self.maxprocs, asyncio.Semaphore(self.maxprocs))
+        slots = master.slots[1]
+
+        async def run_one(i, cmd):
+            async with slots:
+                await master.run_batch(next(self.reqids), [cmd], shell, timeout, limits, lambda idx, res: put((i, host, res)))
+
+        await asyncio.gather(*[run_one(i, cmd) for (i, cmd) in hostcmds])
+
+    async def _run(self, cmds, shell, timeout, put):
+        hosts = collections.defaultdict(list)
+        for i, (host, cmd) in enumerate(cmds):
+            hosts[host].append((i, cmd))
+
+        await asyncio.gather(*[self._run_host(host, hostcmds, shell, timeout, put)
+                               for host, hostcmds in hosts.items()])
+
+    # Same as MultiMasterManager.iter_multihost_commands.
+    def iter_multihost_commands(self, cmds, shell=False, timeout=60):
+        rq = Queue()
+        future = asyncio.run_coroutine_threadsafe(self._run(cmds, shell, timeout, rq.put), self.loop)
+
+        try:
+            for _ in cmds:
+                while True:
+                    try:
+                        item = rq.get(timeout=1)
+                        break
+                    except Empty:
+                        if future.done() and rq.empty():
+                            # Raises the exception that ended the coroutine.
+                            future.result()
+                            return
+                yield item
+        finally:
+            # If the caller stopped early, then cancel the commands.
+            future.cancel()
+
+    # Same as MultiMasterManager.exec_multihost_commands.
+    def exec_multihost_commands(self, cmds, shell=False, timeout=60):
+        results = [None] * len(cmds)
+        for i, host, res in self.iter_multihost_commands(cmds, shell, timeout):
+            results[i] = (host, res)
+        return results
+
+    def host_status(self):
+        for h, o in list(self.masters.items()):
+            if h not in self.localaddrs:
+                yield h, o.alive
+
+    async def _shutdown_all(self):
+        masters = list(self.masters.values())
+        self.masters = {}
+        await asyncio.gather(*[master.close() for master in masters])
+
+    def shutdown_all(self):
+        self._call(self._shutdown_all())
+
+    async def _run_localcmd(self, id, cmd, env, inputtext):
+        cmdline = env + " " + cmd if env else cmd
+        logging.debug(cmdline)
+
+        proc = await asyncio.create_subprocess_shell(
+            cmdline, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True)
+
+        # Note: "output" is combined stdout/stderr output.
+        output, _ = await proc.communicate(inputtext.encode() if inputtext else None)
+        logging.debug("exit status: %d", proc.returncode)
+
+        return (id, proc.returncode == 0, output.decode(errors="replace"))
+
+    # Same as execute.run_localcmds, but waits for all commands at once.
+    def run_localcmds(self, cmds, maxprocs=0):
+        async def run_one(sem, cmd):
+            if not sem:
+                return await self._run_localcmd(*cmd)
+            async with sem:
+                return await self._run_localcmd(*cmd)
+
+        async def run():
+            sem = asyncio.Semaphore(maxprocs) if maxprocs else None
+            return await asyncio.gather(*[run_one(sem, cmd) for cmd in cmds])
+
+        return list(self._call(run()))
+
+
+class AsyncBroCtl:
+    # Provides the API of a BroCtl object (i.e., the methods marked with
+    # @expose) as coroutines, for embedding BroControl into an asyncio
+    # application.  BroCtl is not thread-safe, so the calls are run one at
+    # a time in a worker thread and do not block the caller's event loop.
+    #
+    # Example:
+    #     broctl = AsyncBroCtl(BroCtl())
+    #     results = await broctl.status()
+    def __init__(self, broctl):
+        self.broctl = broctl
+        self.worker = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def __getattr__(self, name):
+        func = getattr(self.broctl, name)
+        if not getattr(func, "api_exposed", False):
+            raise AttributeError("%s is not part of the BroControl API" % name)
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.worker, functools.partial(func, *args, **kwargs))
+
+        return call
+
+    async def finish(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(self.worker, self.broctl.finish)
+        self.worker.shutdown()
@@ -89,6 +89,7 @@ class BroCtl(object):
         self.plugins = pluginreg.PluginRegistry()
         self.setup()
         self.controller = control.Controller(self.config, self.ui, self.executor, self.plugins)
+        self.config.flush_state()
 
     def setup(self):
         plugindirs = self.config.sitepluginpath.split(":")
@@ -132,10 +133,12 @@ class BroCtl(object):
         self.config.initPostPlugins()
         self.plugins.initPlugins(self.ui)
         self.plugins.initPluginCmds()
+        self.config.flush_state()
 
     def finish(self):
         self.executor.finish()
         self.plugins.finishPlugins()
+        self.config.flush_state()
 
     def warn_broctl_install(self):
         self.config.warn_broctl_install()
@@ -192,10 +195,24 @@ class BroCtl(object):
         if not lockstatus:
             raise LockError("Unable to get lock")
 
-        self.config.read_state()
+        # Nobody else can change the state while we already hold the lock.
+        if lock.lockCount == 1:
+            self.config.read_state()
+
+            # Liveness checks are only reused within a single command.
+            self.controller.clear_liveness()
 
     def unlock(self):
-        lock.unlock(self.ui)
+        # Write the state changes of the command while we still hold the
+        # lock.
+        try:
+            if lock.lockCount == 1:
+                self.config.flush_state()
+        finally:
+            lock.unlock(self.ui)
+
+        if lock.lockCount == 0:
+            self.controller.clear_liveness()
 
     def node_names(self):
         return [ n.name for n in self.config.nodes() ]
@@ -304,7 +321,7 @@ class BroCtl(object):
 
     @expose
     @lock_required
-    def deploy(self):
+    def deploy(self, force=False):
         if not self.plugins.cmdPre("deploy"):
             results = cmdresult.CmdResult(ok=False)
             return results
@@ -314,7 +331,7 @@ class BroCtl(object):
             self.reload_cfg()
 
         self.ui.info("checking configurations ...")
-        results = self.check(check_node_types=True)
+        results = self.check(check_node_types=True, force=force)
         if not results.ok:
             for (node, success, output) in results.get_node_output():
                 if not success:
@@ -392,6 +409,18 @@ class BroCtl(object):
         self.plugins.cmdPost("cron", "?", False)
         return results
 
+    # Called by broctld when its health monitor lost the peering with the
+    # given nodes (a space-separated string of node names).
+    @lock_required_silent
+    def nodes_lost(self, node_list):
+        nodes = self.node_args(node_list)
+        self.controller.nodes_lost(nodes)
+
+    # Returns the nodes that broctld's health monitor should peer with.
+    @lock_required_silent
+    def health_targets(self):
+        return self.controller.health_targets()
+
     @expose
     @check_config
     @lock_required
@@ -412,11 +441,11 @@ class BroCtl(object):
     @expose
     @check_config
     @lock_required
-    def check(self, node_list=None, check_node_types=False):
+    def check(self, node_list=None, check_node_types=False, force=False):
         nodes = self.node_args(node_list, get_types=check_node_types)
 
         nodes = self.plugins.cmdPreWithNodes("check", nodes)
-        results = self.controller.check(nodes)
+        results = self.controller.check(nodes, force)
         self.plugins.cmdPostWithResults("check", results.get_node_data())
 
         return results
@@ -467,6 +496,18 @@ class BroCtl(object):
 
         return results
 
+    # This does not take the lock, so that waiting for the archive jobs
+    # does not hold up other commands.
+    @expose
+    @check_config
+    def archives(self, wait=False, node_list=None):
+        nodes = self.node_args(node_list, get_hosts=True)
+        nodes = self.plugins.cmdPreWithNodes("archives", nodes, wait)
+        results = self.controller.archives(nodes, wait)
+        self.plugins.cmdPostWithNodes("archives", nodes, wait)
+
+        return results
+
     @expose
     @check_config
     @lock_required
@@ -507,11 +548,11 @@ class BroCtl(object):
 
     @expose
     @check_config
-    def execute(self, cmd):
+    def execute(self, cmd, callback=None):
         nodes = self.node_args(get_hosts=True)
 
         if self.plugins.cmdPre("exec", cmd):
-            results = self.controller.execute_cmd(nodes, cmd)
+            results = self.controller.execute_cmd(nodes, cmd, callback)
         else:
             results = cmdresult.CmdResult(ok=False)
 
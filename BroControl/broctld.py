@@ -8,6 +8,7 @@ import random
 import traceback
 
 from BroControl import config
+from BroControl import health
 from BroControl import version
 from BroControl.broctl import BroCtl
 from BroControl import ser as json
@@ -15,6 +16,7 @@ from BroControl import ser as json
 from BroControl import web
 
 STOP_RUNNING = object()
+NODES_LOST = object()
 
 class TermUI:
     def __init__(self):
@@ -61,6 +63,14 @@ class BroCtrldWorker(Thread, Common):
         self.broctl.ui = self
         self.broctl.controller.ui = self
         self.broctl.executor.ui = self
+
+        # Watch the running nodes, so that a crashed node is noticed within
+        # seconds instead of at the next cron run.
+        self.monitor = health.HealthMonitor(self.broctl.config.controltopic, self.nodes_lost)
+        self.broctl.controller.health = self.monitor.table
+        self.monitor.start()
+        self.update_monitor()
+
         while True:
             if self.iteration():
                 return
@@ -75,6 +85,14 @@ class BroCtrldWorker(Thread, Common):
         if cmd is STOP_RUNNING:
             return True
 
+        if cmd is NODES_LOST:
+            try:
+                self.broctl.nodes_lost(*args)
+            except Exception:
+                print(traceback.format_exc())
+            self.update_monitor()
+            return
+
         func = getattr(self.broctl, cmd, self.noop)
 
         def respond(r):
@@ -87,8 +105,21 @@ class BroCtrldWorker(Thread, Common):
             res = func(*args)
         except Exception as e:
             res = traceback.format_exc()
+
+        # The command may have started or stopped nodes.
+        self.update_monitor()
         respond(res)
 
+    def update_monitor(self):
+        try:
+            self.monitor.update(self.broctl.health_targets())
+        except Exception:
+            print(traceback.format_exc())
+
+    # Called by the health monitor (in its own thread).
+    def nodes_lost(self, names):
+        self.q.put((None, NODES_LOST, (" ".join(names),)))
+
     def call(self, func, *args):
         self.command_queue.put((None, func, args))
 
@@ -152,6 +183,12 @@ class BroCtld(Thread, Common):
         print("sending result=%r for id=%r" % (result, id))
         return result
 
+    def handle_health(self):
+        monitor = getattr(self.worker, "monitor", None)
+        if not monitor:
+            return {}
+        return monitor.table.get()
+
     def handle_getlog(self, id, since):
         result = self.logs.get(id, since)
         print("sending log=%r for id=%r" % (result, id))
@@ -1,10 +1,13 @@
 # Functions to read and access the broctl configuration.
 
 import hashlib
+import json
 import os
 import socket
 import subprocess
 import re
+import time
+from threading import Thread
 
 from BroControl import py3bro
 from BroControl import node as node_mod
@@ -24,6 +27,110 @@ from .version import VERSION
 
 Config = None # Globally accessible instance of Configuration.
 
+# Seconds after which a cached fact about the local machine or the network
+# is determined again, even if its key has not changed.
+FACT_MAX_AGE = 3600
+
+# Seconds for which the addresses of a node's host are cached.  The host
+# name lookups don't tell us the real TTL of the DNS records.
+DNS_TTL = 300
+
+# Maximum number of host name lookups that are done concurrently.
+DNS_MAX_THREADS = 16
+
+# Returns a list identifying the current version of a file (or None if the
+# file does not exist).
+def file_id(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return [st.st_mtime, st.st_size, st.st_ino]
+
+# Returns a list that changes whenever the network interfaces of the local
+# machine change, or (on Linux) their addresses.  This is the key of the
+# cached local addresses.
+def local_addrs_id(hostname):
+    key = [hostname]
+
+    try:
+        key.append(sorted([name for (idx, name) in socket.if_nameindex()]))
+    except (AttributeError, OSError):
+        # Not available with Python 2 or on some platforms.
+        pass
+
+    for path in ("/proc/net/fib_trie", "/proc/net/if_inet6"):
+        try:
+            with open(path, "rb") as f:
+                key.append(hashlib.sha1(f.read()).hexdigest())
+        except (IOError, OSError):
+            pass
+
+    return key
+
+
+# A cache of facts that are expensive to determine (they require running
+# other programs, DNS lookups, or reading files), kept across broctl
+# invocations in a file in the spool directory.  Each fact is stored with a
+# key (e.g., the file_id of a file it was derived from), and is only used if
+# its key is still the same.
+class FactCache:
+    def __init__(self, path):
+        self.path = path
+        self.dirty = False
+
+        try:
+            with open(path, "r") as f:
+                self.facts = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.facts = {}
+
+        if not isinstance(self.facts, dict):
+            self.facts = {}
+
+    # Returns the value of the fact "name" if it was cached with the given
+    # key, or otherwise calls "func" to determine (and cache) the value.
+    def get(self, name, key, func, maxage=FACT_MAX_AGE):
+        value = self.lookup(name, key, maxage)
+        if value is None:
+            value = func()
+            self.put(name, key, value)
+        return value
+
+    # Returns the cached value of the fact "name" if it was cached with the
+    # given key less than "maxage" seconds ago, or None otherwise.
+    def lookup(self, name, key, maxage=FACT_MAX_AGE):
+        entry = self.facts.get(name)
+        if entry and entry.get("key") == key and time.time() - entry.get("time", 0) < maxage:
+            return entry["value"]
+        return None
+
+    def put(self, name, key, value):
+        self.facts[name] = {"key": key, "value": value, "time": time.time()}
+        self.dirty = True
+
+    # Write the cache if anything has changed.  Errors are ignored, because
+    # the cache only saves time.
+    def save(self):
+        if not self.dirty:
+            return
+
+        tmp = "%s.%d" % (self.path, os.getpid())
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self.facts, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return
+
+        self.dirty = False
+
+
 class NodeStore:
     def __init__(self):
         self.nodestore = {}
@@ -64,7 +171,9 @@ class Configuration:
         self.state = {}
         self.nodestore = {}
 
-        self.localaddrs = self._get_local_addrs()
+        # State variables that were changed but not yet written to the
+        # state store (see flush_state).
+        self.state_dirty = {}
 
         # Read broctl.cfg.
         self.config = self._read_config(cfgfile)
@@ -72,6 +181,9 @@ class Configuration:
         self._initialize_options()
         self._check_options()
 
+        hostname = socket.gethostname()
+        self.localaddrs = [str(a) for a in self.facts.get("localaddrs", local_addrs_id(hostname), self._get_local_addrs)]
+
         if state:
             self.state_store = state
         else:
@@ -100,15 +212,24 @@ class Configuration:
                 self.init_option(opt.name, opt.default)
 
         # Set defaults for options we derive dynamically.
+        hostname = socket.gethostname()
         self.init_option("mailto", "%s" % os.getenv("USER"))
-        self.init_option("mailfrom", "Big Brother <bro@%s>" % socket.gethostname())
+        self.init_option("mailfrom", "Big Brother <bro@%s>" % hostname)
         self.init_option("mailalarmsto", self.config["mailto"])
 
+        # Facts that require running other programs are cached.
+        if "facts" in self.__dict__:
+            self.facts.save()
+        self.facts = FactCache(os.path.join(self.config["spooldir"], "facts.json"))
+
         # Determine operating system.
-        success, output = execute.run_localcmd("uname")
-        if not success or not output:
-            raise RuntimeEnvironmentError("failed to run uname: %s" % output)
-        self.init_option("os", output.strip())
+        def get_os():
+            success, output = execute.run_localcmd("uname")
+            if not success or not output:
+                raise RuntimeEnvironmentError("failed to run uname: %s" % output)
+            return output.strip()
+
+        self.init_option("os", str(self.facts.get("os", list(os.uname()), get_os)))
 
         # Determine the CPU pinning command.
         pin_cmd = ""
@@ -120,14 +241,17 @@ class Configuration:
         self.init_option("pin_command", pin_cmd)
 
         # Find the time command (should be a GNU time for best results).
-        time_cmd = ""
-        success, output = execute.run_localcmd("which time")
-        if success and output:
-            # On redhat-based systems, path to cmd is prefixed with '\t' on 2nd
-            # line when alias is defined.
-            time_cmd = output.splitlines()[-1].strip()
-
-        self.init_option("time", time_cmd)
+        def get_time_cmd():
+            time_cmd = ""
+            success, output = execute.run_localcmd("which time")
+            if success and output:
+                # On redhat-based systems, path to cmd is prefixed with '\t' on
+                # 2nd line when alias is defined.
+                time_cmd = output.splitlines()[-1].strip()
+            return time_cmd
+
+        time_cmd = self.facts.get("time", [hostname, os.getenv("PATH")], get_time_cmd)
+        self.init_option("time", str(time_cmd))
 
         # Calculate the log expire interval (in minutes).
         minutes = self._get_interval_minutes("logexpireinterval")
@@ -168,6 +292,12 @@ class Configuration:
             if not os.path.isfile(v):
                 raise ConfigurationError('broctl option "%s" file not found: %s' % (f, v))
 
+        for opt in ("maxhostprocs", "maxhoststarts", "startstagger"):
+            if self.config[opt] < 0:
+                raise ConfigurationError('value of broctl option "%s" cannot be negative' % opt)
+
+        self.get_cmd_limits()
+
         # Verify that logs don't expire more quickly than the rotation interval
         logexpireseconds = 60 * self.config["logexpireminutes"]
         if 0 < logexpireseconds < self.config["logrotationinterval"]:
@@ -366,6 +496,29 @@ class Configuration:
 
         return env_vars
 
+    # Convert the value of the "maxhostprocspercmd" option (a comma-separated
+    # list such as "start-node=4, crash-diag=1") to a dictionary that maps a
+    # command name to the maximum number of concurrently running instances.
+    def get_cmd_limits(self):
+        limits = {}
+
+        text = self.config["maxhostprocspercmd"]
+        if text:
+            for keyval in text.split(","):
+                try:
+                    key, val = keyval.split("=", 1)
+                    key = key.strip()
+                    val = int(val)
+                except ValueError:
+                    key = val = None
+
+                if not key or val < 0:
+                    raise ConfigurationError('value of broctl option "maxhostprocspercmd" is invalid (must be a comma-separated list of command=number): %s' % keyval)
+
+                limits[key] = val
+
+        return limits
+
     # Parse node.cfg.
     def _read_nodes(self):
         config = py3bro.configparser.SafeConfigParser()
@@ -377,8 +530,8 @@ class Configuration:
             raise ConfigurationError(err)
 
         nodestore = NodeStore()
+        nodes = []
 
-        counts = {}
         for sec in config.sections():
             node = node_mod.Node(self, sec)
 
@@ -393,8 +546,16 @@ class Configuration:
 
                 node.__dict__[key] = val
 
+            nodes.append(node)
+
+        # Look up the addresses of all hosts up front (each host only once,
+        # and all of them concurrently).
+        hostaddrs = self._resolve_hosts([node.host for node in nodes if node.host])
+
+        counts = {}
+        for node in nodes:
             # Perform a sanity check on the node, and update nodestore.
-            self._check_node(node, nodestore, counts)
+            self._check_node(node, nodestore, counts, hostaddrs)
 
         # Perform a sanity check on the nodestore (make sure we have a valid
         # cluster config, etc.).
@@ -402,7 +563,67 @@ class Configuration:
 
         return nodestore.nodestore
 
-    def _check_node(self, node, nodestore, counts):
+    # Returns a dict that maps each of the given host names to a tuple
+    # (addrs, error), where "addrs" is the list of addresses of the host, or
+    # None if the lookup failed (then "error" is the error message).  Lookups
+    # are done in parallel, and the addresses are cached for DNS_TTL seconds
+    # (or until node.cfg is modified).
+    def _resolve_hosts(self, hosts):
+        cachekey = file_id(self.nodecfg)
+        hostaddrs = {}
+        todo = []
+
+        for host in hosts:
+            if host in hostaddrs or host in todo:
+                continue
+
+            addrs = self.facts.lookup("addrs-%s" % host, cachekey, DNS_TTL)
+            if addrs:
+                hostaddrs[host] = ([str(a) for a in addrs], None)
+            else:
+                todo.append(host)
+
+        results = [None] * len(todo)
+        queue = py3bro.Queue()
+        for i, host in enumerate(todo):
+            queue.put((i, host))
+
+        def run():
+            while True:
+                try:
+                    i, host = queue.get_nowait()
+                except py3bro.Empty:
+                    return
+
+                try:
+                    addrinfo = socket.getaddrinfo(host, None, 0, 0, socket.SOL_TCP)
+                except socket.gaierror as e:
+                    results[i] = (None, e.args[1])
+                    continue
+                except Exception as e:
+                    # E.g., a UnicodeError for an invalid host name.  This
+                    # must not end the thread, or the host would be left
+                    # without a result.
+                    results[i] = (None, str(e))
+                    continue
+
+                results[i] = ([addr[4][0] for addr in addrinfo], None)
+
+        threads = [Thread(target=run) for i in range(min(len(todo), DNS_MAX_THREADS))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        for (host, (addrs, error)) in zip(todo, results):
+            # Failed lookups are not cached, so they're retried next time.
+            if addrs:
+                self.facts.put("addrs-%s" % host, cachekey, addrs)
+            hostaddrs[host] = (addrs, error)
+
+        return hostaddrs
+
+    def _check_node(self, node, nodestore, counts, hostaddrs):
         if not node.type:
             raise ConfigurationError("no type given for node %s" % node.name)
 
@@ -412,12 +633,9 @@ class Configuration:
         if not node.host:
             raise ConfigurationError("no host given for node '%s'" % node.name)
 
-        try:
-            addrinfo = socket.getaddrinfo(node.host, None, 0, 0, socket.SOL_TCP)
-        except socket.gaierror as e:
-            raise ConfigurationError("hostname lookup failed for '%s' in node config [%s]" % (node.host, e.args[1]))
-
-        addrs = [addr[4][0] for addr in addrinfo]
+        (addrs, error) = hostaddrs[node.host]
+        if error is not None:
+            raise ConfigurationError("hostname lookup failed for '%s' in node config [%s]" % (node.host, error))
 
         # By default, just use the first IP addr in the list.
         addr_str = addrs[0]
@@ -631,22 +849,50 @@ class Configuration:
         # Convert key to lowercase because keys are stored in lowercase.
         return self.config.get(key.lower())
 
-    # Set a dynamic state variable.
+    # Set a dynamic state variable.  The change is written to the state
+    # store by the next call of flush_state.
     def set_state(self, key, val):
         key = key.lower()
         if self.state.get(key) == val:
             return
 
         self.state[key] = val
-        self.state_store.set(key, val)
+        self.state_dirty[key] = val
+
+    # Write all changed state variables to the state store in a single
+    # transaction.  This is done when the lock is released at the end of
+    # each command.  Newly determined cached facts are written, too.
+    def flush_state(self):
+        self.facts.save()
+
+        if not self.state_dirty:
+            return
+
+        items = sorted(self.state_dirty.items())
+        self.state_dirty = {}
+
+        # A state store that was passed in might not support this.
+        setmany = getattr(self.state_store, "setmany", None)
+        if setmany:
+            setmany(items)
+        else:
+            for (key, val) in items:
+                self.state_store.set(key, val)
 
     # Returns value of state variable, or the specified default value if the
     # state variable is not defined.
     def get_state(self, key, default=None):
         return self.state.get(key.lower(), default)
 
-    # Read dynamic state variables.
+    # Read dynamic state variables.  Nothing is read if the state store can
+    # tell that no other process has changed it since the last time.
     def read_state(self):
+        self.flush_state()
+
+        changed = getattr(self.state_store, "changed", None)
+        if changed and not changed():
+            return
+
         self.state = dict(self.state_store.items())
 
     # Use the ifconfig command to find local IP addrs.
@@ -889,11 +1135,26 @@ class Configuration:
                 # Clear the PID so we don't keep getting warnings.
                 self.set_state(key, None)
 
+    # Returns the hash value (as a string) of the contents of a file.  As
+    # long as the file is not modified, the cached value is used.
+    def _get_file_hash(self, path):
+        def get_hash():
+            with open(path, "r") as ff:
+                data = ff.read()
+
+            if py3bro.using_py3:
+                data = data.encode()
+
+            hh = hashlib.sha1()
+            hh.update(data)
+            return hh.hexdigest()
+
+        return str(self.facts.get("hash-%s" % path, file_id(path), get_hash))
+
     # Return a hash value (as a string) of the current broctl configuration.
     def _get_broctlcfg_hash(self, filehash=False):
         if filehash:
-            with open(self.cfgfile, "r") as ff:
-                data = ff.read()
+            return self._get_file_hash(self.cfgfile)
         else:
             data = str(sorted(self.config.items()))
 
@@ -907,8 +1168,7 @@ class Configuration:
     # Return a hash value (as a string) of the current broctl node config.
     def _get_nodecfg_hash(self, filehash=False):
         if filehash:
-            with open(self.nodecfg, "r") as ff:
-                data = ff.read()
+            return self._get_file_hash(self.nodecfg)
         else:
             nn = []
             for n in self.nodes():
@@ -930,14 +1190,20 @@ class Configuration:
         self.set_state("hash-broctlcfg", cfghash)
         self.set_state("hash-nodecfg", nodehash)
 
-    # Runs Bro to get its version number.
+    # Runs Bro to get its version number (unless the Bro binary is unchanged
+    # since the last time).
     def _get_bro_version(self):
-        from BroControl import execute
-
         bro = self.config["bro"]
         if not os.path.lexists(bro):
             raise ConfigurationError("cannot find Bro binary: %s" % bro)
 
+        return str(self.facts.get("broversion", [bro, file_id(bro)], self._run_bro_version))
+
+    def _run_bro_version(self):
+        from BroControl import execute
+
+        bro = self.config["bro"]
+
         version = ""
         success, output = execute.run_localcmd("%s -v" % bro)
         if success and output:
@@ -0,0 +1,303 @@
+# A local connection broker that keeps the connections to all hosts open
+# across broctl invocations.
+#
+# The broker is a long-running process (started with "broctl
+# --connection-broker") that owns a MultiMasterManager and listens on a
+# Unix socket.  Short-lived broctl processes send their commands to the
+# broker instead of starting their own ssh connections, so that each run
+# does not have to pay for a new ssh handshake and login per host.  If no
+# broker is running, then broctl runs the commands itself as usual.
+#
+# Each client connection carries one request, which is a single line of
+# JSON.  The broker answers with one JSON line per result followed by a
+# final "done" line.  If the client goes away before all results are
+# delivered, then the commands that are still running are cancelled.
+
+import errno
+import json
+import logging
+import os
+import socket
+import struct
+from threading import Thread
+
+from BroControl import py3bro
+from BroControl import ssh_runner
+from BroControl.exceptions import RuntimeEnvironmentError
+
+Queue = py3bro.Queue
+
+# Linux only: retrieves the credentials of the peer of a Unix socket.
+SO_PEERCRED = getattr(socket, "SO_PEERCRED", None)
+
+
+def _send(sock, obj):
+    data = json.dumps(obj)
+    if py3bro.using_py3:
+        data = data.encode()
+    sock.sendall(data + b"\n")
+
+def _recv(f):
+    line = f.readline()
+    if not line:
+        return None
+    if py3bro.using_py3:
+        line = line.decode()
+    return json.loads(line)
+
+# Results are sent as lists of the CmdResult fields.  With Python 2, the
+# output is a byte string, which must be converted for JSON.
+def _encode_result(res):
+    res = list(res)
+    if not py3bro.using_py3:
+        res[1] = res[1].decode("utf-8", "replace")
+        res[2] = res[2].decode("utf-8", "replace")
+    return res
+
+def _decode_result(res):
+    if not py3bro.using_py3:
+        res[1] = res[1].encode("utf-8")
+        res[2] = res[2].encode("utf-8")
+    return ssh_runner.CmdResult(*res)
+
+
+# Returns a connected BrokerClient, or None if no broker is listening on
+# "path".
+def connect(path, localaddrs):
+    client = BrokerClient(path, localaddrs)
+    try:
+        client.connect().close()
+    except socket.error:
+        return None
+
+    logging.debug("using connection broker at %s", path)
+    return client
+
+
+class BrokerClient:
+    # This class implements the part of the MultiMasterManager interface
+    # that is used by the Executor.  If the broker goes away, then the
+    # remaining requests are handled by an in-process MultiMasterManager.
+    def __init__(self, path, localaddrs):
+        self.path = path
+        self.localaddrs = localaddrs
+        self.maxprocs = 0
+        self.cmdlimits = {}
+        self.fallback = None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    def _fallback(self):
+        if not self.fallback:
+            logging.debug("connection broker at %s is gone", self.path)
+            self.fallback = ssh_runner.MultiMasterManager(self.localaddrs)
+            self.fallback.set_limits(self.maxprocs, self.cmdlimits)
+        return self.fallback
+
+    def set_limits(self, maxprocs, cmdlimits):
+        self.maxprocs = maxprocs
+        self.cmdlimits = cmdlimits
+        if self.fallback:
+            self.fallback.set_limits(maxprocs, cmdlimits)
+
+    # Same as MultiMasterManager.iter_multihost_commands.
+    def iter_multihost_commands(self, cmds, shell=False, timeout=60):
+        if self.fallback:
+            for res in self.fallback.iter_multihost_commands(cmds, shell, timeout):
+                yield res
+            return
+
+        req = {"op": "run", "cmds": cmds, "shell": shell, "timeout": timeout,
+               "limits": [self.maxprocs, self.cmdlimits]}
+        try:
+            sock = self.connect()
+            _send(sock, req)
+        except socket.error:
+            for res in self._fallback().iter_multihost_commands(cmds, shell, timeout):
+                yield res
+            return
+
+        # Closing the socket early tells the broker to cancel the commands.
+        f = sock.makefile("rb")
+        pending = set(range(len(cmds)))
+        try:
+            while pending:
+                try:
+                    msg = _recv(f)
+                except (socket.error, ValueError):
+                    msg = None
+
+                if msg is None:
+                    break
+
+                if "done" in msg:
+                    break
+
+                i = msg["i"]
+                pending.discard(i)
+                if "error" in msg:
+                    yield i, cmds[i][0], Exception(msg["error"])
+                else:
+                    yield i, cmds[i][0], _decode_result(msg["result"])
+        finally:
+            f.close()
+            sock.close()
+
+        for i in sorted(pending):
+            yield i, cmds[i][0], Exception("Lost connection to connection broker while running command on host %s" % cmds[i][0])
+
+    # Same as MultiMasterManager.host_status.
+    def host_status(self):
+        if self.fallback:
+            return self.fallback.host_status()
+
+        try:
+            sock = self.connect()
+            _send(sock, {"op": "status"})
+            f = sock.makefile("rb")
+            status = _recv(f)
+            f.close()
+            sock.close()
+        except (socket.error, ValueError):
+            return self._fallback().host_status()
+
+        return [(host, alive) for host, alive in status]
+
+    # The connections are owned by the broker, so there is nothing to do
+    # here unless we had to fall back to our own connections.
+    def shutdown_all(self):
+        if self.fallback:
+            self.fallback.shutdown_all()
+
+
+class ConnectionBroker:
+    def __init__(self, path, localaddrs):
+        self.path = path
+        self.sshrunner = ssh_runner.MultiMasterManager(localaddrs)
+
+    # Create the listening socket.  Only the user running the broker is
+    # allowed to connect.
+    def listen(self):
+        if os.path.exists(self.path):
+            try:
+                BrokerClient(self.path, []).connect().close()
+            except socket.error:
+                # A leftover from a broker that did not exit cleanly.
+                os.unlink(self.path)
+            else:
+                raise RuntimeEnvironmentError("a connection broker is already running at %s" % self.path)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        oldmask = os.umask(0o077)
+        try:
+            sock.bind(self.path)
+        except socket.error as err:
+            sock.close()
+            raise RuntimeEnvironmentError("cannot create connection broker socket %s: %s" % (self.path, err))
+        finally:
+            os.umask(oldmask)
+
+        sock.listen(16)
+        return sock
+
+    def serve(self):
+        sock = self.listen()
+        try:
+            while True:
+                try:
+                    conn, _ = sock.accept()
+                except socket.error as err:
+                    if err.args[0] == errno.EINTR:
+                        continue
+                    raise
+
+                if not self._peer_allowed(conn):
+                    conn.close()
+                    continue
+
+                t = Thread(target=self.handle, args=(conn,))
+                t.daemon = True
+                t.start()
+        finally:
+            sock.close()
+            os.unlink(self.path)
+            self.sshrunner.shutdown_all()
+
+    # Where supported, double-check that the peer runs as the same user as
+    # the broker.
+    def _peer_allowed(self, conn):
+        if SO_PEERCRED is None:
+            return True
+
+        try:
+            creds = conn.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, struct.calcsize("3i"))
+        except socket.error:
+            return True
+
+        pid, uid, gid = struct.unpack("3i", creds)
+        if uid != os.getuid():
+            logging.debug("connection broker: rejected client with uid %d", uid)
+            return False
+        return True
+
+    def handle(self, conn):
+        f = conn.makefile("rb")
+        try:
+            req = _recv(f)
+            if not req:
+                return
+
+            if req["op"] == "status":
+                _send(conn, list(self.sshrunner.host_status()))
+            elif req["op"] == "run":
+                self._run(conn, f, req)
+        except (socket.error, ValueError, KeyError) as err:
+            logging.debug("connection broker: %s", err)
+        finally:
+            f.close()
+            conn.close()
+
+    def _run(self, conn, f, req):
+        cmds = [(host, cmd) for host, cmd in req["cmds"]]
+        rq = Queue()
+
+        # Watch for the client closing the connection, which cancels the
+        # commands that are still running.
+        def watch():
+            try:
+                f.read()
+            except (socket.error, ValueError):
+                pass
+            rq.put((ssh_runner.STOP_RUNNING, None, None))
+
+        t = Thread(target=watch)
+        t.daemon = True
+        t.start()
+
+        # Each request comes with the limits of its client, which apply
+        # only to the commands of that request.
+        maxprocs, cmdlimits = req["limits"]
+        results = self.sshrunner.iter_multihost_commands(cmds, req["shell"], req["timeout"], rq, (maxprocs, cmdlimits))
+        try:
+            for i, host, res in results:
+                if isinstance(res, Exception):
+                    _send(conn, {"i": i, "error": str(res)})
+                else:
+                    _send(conn, {"i": i, "result": _encode_result(res)})
+        finally:
+            # Cancels the remaining commands if sending failed.
+            results.close()
+
+        _send(conn, {"done": True})
+
+
+# Run a connection broker listening on "path" until it is killed.
+def serve(path, localaddrs):
+    ConnectionBroker(path, localaddrs).serve()
@@ -2,10 +2,12 @@
 
 from collections import namedtuple
 import glob
+import hashlib
 import os
 import shutil
 import time
 import logging
+from threading import Event, Thread
 
 from BroControl import execute
 from BroControl import events
@@ -15,9 +17,25 @@ from BroControl import install
 from BroControl import cron
 from BroControl import node as node_mod
 from BroControl import cmdresult
+from BroControl import py3bro
+
+Queue = py3bro.Queue
+Empty = py3bro.Empty
+
+# The number of successful checks whose inputs are remembered.
+CHECK_CACHE_SIZE = 64
+
+# The types of nodes that must be up before a node of a given type is
+# started.  When stopping, the dependencies are reversed.
+_startdeps = {
+    "logger": [],
+    "manager": ["logger"],
+    "proxy": ["logger", "manager"],
+    "worker": ["logger", "manager", "proxy"],
+    "standalone": [],
+}
 
 
-# Waits for the nodes' Bro processes to reach the given status.
 # Build the Bro parameters for the given node. Include
 # script for live operation if live is true.
 def _make_bro_params(node, live):
@@ -92,6 +110,68 @@ def _make_env_params(node, returnlist=False):
 
     return " ".join(envs)
 
+# Group the given nodes by type.  Returns a list of (type, nodes) tuples in
+# the order in which the types are started.
+def _group_types(nodes):
+    groups = []
+    for t in node_mod.node_types():
+        tnodes = [n for n in nodes if n.type == t]
+        if tnodes:
+            groups.append((t, tnodes))
+
+    return groups
+
+# Returns the nodes in "nodes" that must be up before "node" is started,
+# i.e. the nodes that it connects to.  All nodes of a type connect to all
+# nodes of the types they depend on (see _startdeps).
+def _start_deps(node, nodes):
+    return [n for n in nodes if n.type in _startdeps[node.type]]
+
+# Check if any node of the given type has failed.
+def _type_failed(results, nodetype):
+    for (node, success, data) in results.nodes:
+        if not success and node.type == nodetype:
+            return True
+
+    return False
+
+
+# Remove a temporary directory, ignoring errors.
+def _remove_dir(path):
+    try:
+        shutil.rmtree(path)
+    except OSError:
+        pass
+
+def _hash_str(hh, data):
+    if py3bro.using_py3:
+        data = data.encode()
+    hh.update(data)
+
+# Add the names and contents of all files below "path" to the hash "hh".  If
+# "contents" is False, then only the sizes and modification times of the
+# files are used instead of their contents.
+def _hash_tree(hh, path, contents):
+    for (dirpath, dirnames, filenames) in os.walk(path, followlinks=True):
+        dirnames.sort()
+        for name in sorted(filenames):
+            pathname = os.path.join(dirpath, name)
+            try:
+                if contents:
+                    with open(pathname, "rb") as f:
+                        data = f.read()
+                else:
+                    st = os.stat(pathname)
+                    data = None
+            except (IOError, OSError):
+                continue
+
+            if data is None:
+                _hash_str(hh, "%s %d %d\n" % (pathname, st.st_size, st.st_mtime))
+            else:
+                _hash_str(hh, "%s %d\n" % (pathname, len(data)))
+                hh.update(data)
+
 
 def fmttime(t):
     return time.strftime(config.Config.timefmt, time.localtime(float(t)))
@@ -104,6 +184,19 @@ class Controller:
         self.executor = executor
         self.pluginregistry = pluginregistry
 
+        # Snapshot of the liveness checks done during the current broctl
+        # command.  Maps a node name to a (pid, isrunning) tuple.
+        self.liveness = {}
+
+        # If not None, a health.HealthTable that is kept up to date by a
+        # monitor peering with the running nodes (see broctld).  Nodes that
+        # it knows to be up are not checked over ssh.
+        self.health = None
+
+        # The startup times of the nodes that were probed (see _probe_nodes).
+        # Maps a node name to a (pid, started) tuple.
+        self.startups = {}
+
         # Create broctl-config.sh file so that shell script helpers have
         # current config values.
         install.make_broctl_config_sh(ui)
@@ -111,44 +204,209 @@ class Controller:
     def start(self, nodes):
         results = cmdresult.CmdResult()
 
-        loggers, manager, proxies, workers = node_mod.separate_types(nodes)
-
         for n in nodes:
             n.setExpectRunning(True)
 
-        # Start nodes. Do it in the order loggers, manager, proxies, workers.
-        if loggers:
-            self._start_nodes(loggers, results)
+        # Each node is started as soon as the nodes that it depends on (see
+        # _start_deps) are up.  Readiness is tracked per node, so a node
+        # waits only for its own dependencies, not for a whole stage.
+        deps = dict((n.name, _start_deps(n, nodes)) for n in nodes)
+        waiting = [n for (t, tnodes) in _group_types(nodes) for n in tnodes]
 
-            if not results.ok:
-                for n in (manager + proxies + workers):
-                    results.set_node_fail(n)
-                return results
+        # Names of the nodes that are up (or were already running), and of
+        # those that failed to start.
+        up = set()
+        failed = set()
 
-        if manager:
-            self._start_nodes(manager, results)
+        # Nodes waiting for a free slot on their host, the number of nodes
+        # currently starting on each host, and the earliest time of the
+        # next start on each host.
+        queued = []
+        starting = {}
+        nextstart = {}
+
+        # Each wave of starts runs in its own thread, which reports the
+        # progress of its nodes on "eventq".  Setting "stop" makes the
+        # threads stop waiting for their nodes.
+        eventq = Queue()
+        stop = Event()
+        threads = []
+        waves = 0
+
+        # Per-node timing: time when the node became ready to start, was
+        # launched, and was up (relative to "t0").
+        t0 = time.time()
+        timing = {}
+
+        def done(node, success, initializing=False):
+            starting[node.addr] -= 1
 
-            if not results.ok:
-                for n in (proxies + workers):
-                    results.set_node_fail(n)
-                return results
+            if not success:
+                failed.add(node.name)
+                results.set_node_fail(node)
+                return
 
-        if proxies:
-            self._start_nodes(proxies, results)
+            up.add(node.name)
 
-            if not results.ok:
-                for n in workers:
-                    results.set_node_fail(n)
-                return results
+            if initializing:
+                self.ui.info("(%s still initializing)" % node.name)
+
+            self._log_action(node, "started")
 
-        if workers:
-            self._start_nodes(workers, results)
+            times = timing[node.name] + [time.time() - t0]
+            logging.debug("%s: ready after %.2fs, launched after %.2fs, up after %.2fs", node.name, *times)
+            results.set_node_data(node, True, {"timing": dict(zip(("ready", "launched", "up"), times))})
 
-        return results
+        def started(node, success, output):
+            lines = output.splitlines()
+
+            if not success:
+                self.ui.error('cannot start %s; check output of "diag"' % node.name)
+                if output:
+                    self.ui.error(output)
+                done(node, False)
+                return
 
+            if lines and lines[0] == "nodir":
+                self.ui.error("cannot create working directory for %s" % node.name)
+                done(node, False)
+                return
+
+            if not lines or not lines[0]:
+                self.ui.error("failed to get PID of %s" % node.name)
+                done(node, False)
+                return
+
+            try:
+                pid = int(lines[0])
+            except ValueError:
+                self.ui.error("invalid PID for %s: %s" % (node.name, lines[0]))
+                done(node, False)
+                return
+
+            node.setPID(pid)
+            self._forget_liveness([node])
+
+            # It can happen that Bro hangs in DNS lookups at startup
+            # which can take a while.  If there is not a TERMINATED
+            # status by now, we assume that it is doing fine and will
+            # move on to RUNNING once DNS is done.
+            state = lines[1] if len(lines) > 1 else "initializing"
+            if state == "terminated":
+                self.ui.error('%s terminated immediately after starting; check output with "diag"' % node.name)
+                node.clearPID()
+                done(node, False)
+            else:
+                done(node, True, state == "initializing")
+
+        try:
+            while True:
+                # Activate the nodes whose dependencies are done.  Nodes
+                # that turn out to be running already are up right away,
+                # which may activate more nodes.
+                activated = True
+                while activated:
+                    activated = False
+                    ready = []
+                    for node in list(waiting):
+                        names = [d.name for d in deps[node.name]]
+                        if [d for d in names if d not in up and d not in failed]:
+                            continue
+
+                        waiting.remove(node)
+
+                        if [d for d in names if d in failed]:
+                            failed.add(node.name)
+                            results.set_node_fail(node)
+                            activated = True
+                            continue
+
+                        ready += [node]
+
+                    for (t, tnodes) in _group_types(ready):
+                        tostart = self._prepare_start(tnodes)
+                        for node in tnodes:
+                            if node not in tostart:
+                                up.add(node.name)
+                                activated = True
+
+                        for node in tostart:
+                            timing[node.name] = [time.time() - t0]
+                        queued += tostart
+
+                # Launch the queued nodes whose hosts have a free slot.
+                now = time.time()
+                maxstarts = self.config.maxhoststarts
+                wave = []
+                for node in list(queued):
+                    host = node.addr
+                    if maxstarts and starting.get(host, 0) >= maxstarts:
+                        continue
+                    if nextstart.get(host, 0) > now:
+                        continue
+
+                    queued.remove(node)
+                    wave += [node]
+                    starting[host] = starting.get(host, 0) + 1
+                    nextstart[host] = now + self.config.startstagger / 1000.0
+                    timing[node.name] += [now - t0]
+
+                if wave:
+                    t = Thread(target=self._launch_nodes, args=(self._start_cmds(wave), eventq, stop))
+                    t.start()
+                    threads += [t]
+                    waves += 1
+
+                if not waves and not queued and not waiting:
+                    break
+
+                # Wait for the next event, or until the next queued node may
+                # be launched.
+                timeout = 1
+                waits = [nextstart[n.addr] for n in queued if not (maxstarts and starting.get(n.addr, 0) >= maxstarts)]
+                if waits:
+                    timeout = min(max(min(waits) - time.time(), 0), timeout)
+
+                try:
+                    (event, node, args) = eventq.get(True, timeout)
+                except Empty:
+                    continue
+
+                if event == "started":
+                    started(node, *args)
+
+                elif event == "done":
+                    waves -= 1
+                    # Don't lose the PIDs of running nodes if broctl dies.
+                    self.config.flush_state()
+
+                elif event == "error":
+                    raise args
+
+        except BaseException:
+            # On an error or an interrupt, wait for the running waves to give
+            # up on their nodes, and keep the PIDs of those that did start.
+            stop.set()
+            for t in threads:
+                t.join()
+
+            while True:
+                try:
+                    (event, node, args) = eventq.get_nowait()
+                except Empty:
+                    break
+
+                if event == "started":
+                    started(node, *args)
+
+            self.config.flush_state()
+            raise
+
+        return results
 
-    # Starts the given nodes.
-    def _start_nodes(self, nodes, results):
+    # Prepare starting the given nodes, which all have the same type.
+    # Returns the nodes that need to be started.
+    def _prepare_start(self, nodes):
         self.ui.info("starting %s ..." % node_mod.nodes_describe(nodes))
 
         filtered = []
@@ -165,17 +423,12 @@ class Controller:
             self.ui.info("creating crash report for previously crashed nodes: %s" % ", ".join([n.name for n in crashed]))
             self._make_crash_reports(crashed)
 
-        # Make working directories.
-        dirs = [(node, node.cwd()) for node in nodes]
-        nodes = []
-        for (node, success, output) in self.executor.mkdirs(dirs):
-            if success:
-                nodes += [node]
-            else:
-                self.ui.error("cannot create working directory for %s" % node.name)
-                results.set_node_fail(node)
+        return nodes
 
-        # Start Bro process.
+    # Build the commands that start the given nodes.  The "start-node"
+    # helper creates the working directory, starts Bro, and waits until it
+    # is up, so that starting a node takes a single round trip.
+    def _start_cmds(self, nodes):
         cmds = []
         for node in nodes:
             envs = []
@@ -186,85 +439,104 @@ class Controller:
                 pin_cpu = -1
 
             envs = _make_env_params(node, True)
-            cmds += [(node, "start", envs + [node.cwd(), str(pin_cpu)] + _make_bro_params(node, True))]
-
-        nodes = []
-        # Note: the shell is used to interpret the command because broargs
-        # might contain quoted arguments.
-        for (node, success, output) in self.executor.run_helper(cmds, shell=True):
-            if success:
-                if not output:
-                    self.ui.error("failed to get PID of %s" % node.name)
-                    results.set_node_fail(node)
-                    continue
+            cmds += [(node, "start-node", envs + [str(self.config.starttimeout), node.cwd(), str(pin_cpu)] + _make_bro_params(node, True))]
 
-                pidstr = output.splitlines()[0]
-                try:
-                    pid = int(pidstr)
-                except ValueError:
-                    self.ui.error("invalid PID for %s: %s" % (node.name, pidstr))
-                    results.set_node_fail(node)
-                    continue
+        return cmds
 
-                nodes += [node]
-                node.setPID(pid)
-            else:
-                self.ui.error('cannot start %s; check output of "diag"' % node.name)
-                results.set_node_fail(node)
-                if output:
-                    self.ui.error(output)
+    # Run the start commands "cmds".  This runs in its own thread and only
+    # talks to the hosts (the node state must be updated by the main
+    # thread).  The progress is reported on "eventq" as (event, node, args)
+    # tuples:
+    #
+    #   ("started", node, (success, output)): the start command has
+    #     finished (see the "start-node" helper for the output).
+    #   ("error", None, exception): something went wrong.
+    #   ("done", None, None): this is always the last event.
+    #
+    # Once "stop" is set, the thread stops waiting for the remaining nodes.
+    def _launch_nodes(self, cmds, eventq, stop):
+        try:
+            # Note: the shell is used to interpret the command because
+            # broargs might contain quoted arguments.
+            timeout = self.config.starttimeout + self.config.commandtimeout
+            res = self.executor.iter_helper(cmds, shell=True, timeout=timeout)
+            try:
+                for (node, success, output) in res:
+                    eventq.put(("started", node, (success, output)))
+                    if stop.is_set():
+                        break
+            finally:
+                # This cancels the commands that are still running.
+                res.close()
 
-        # Check whether processes did indeed start up.
-        hanging = []
-        running = []
+        except Exception as err:
+            eventq.put(("error", None, err))
 
-        for (node, success) in self._waitforbros(nodes, "RUNNING", 3, True):
-            if success:
-                running += [node]
-            else:
-                hanging += [node]
-
-        # It can happen that Bro hangs in DNS lookups at startup
-        # which can take a while. At this point we already know
-        # that the process has been started (_waitforbros ensures that).
-        # If by now there is not a TERMINATED status, we assume that it
-        # is doing fine and will move on to RUNNING once DNS is done.
-        for (node, success) in self._waitforbros(hanging, "TERMINATED", 0, False):
-            if success:
-                self.ui.error('%s terminated immediately after starting; check output with "diag"' % node.name)
-                node.clearPID()
-                results.set_node_fail(node)
-            else:
-                self.ui.info("(%s still initializing)" % node.name)
-                running += [node]
+        finally:
+            eventq.put(("done", None, None))
 
-        for node in running:
-            self._log_action(node, "started")
-            results.set_node_success(node)
+    # Forget the results of all previous liveness checks.  This is done at
+    # the beginning and end of each broctl command.
+    def clear_liveness(self):
+        self.liveness = {}
 
-        return results
+    # Forget the liveness of the given nodes (e.g., after sending a signal).
+    def _forget_liveness(self, nodes):
+        for node in nodes:
+            self.liveness.pop(node.name, None)
 
-    def _isrunning(self, nodes, setcrashed=True):
+    # Check which of the given nodes are running.  If "cached" is True, then
+    # the result of a previous check of the same PID during the current
+    # command is used instead of checking again.
+    def _isrunning(self, nodes, setcrashed=True, cached=True):
 
         results = []
-        cmds = []
+        verdicts = {}
 
+        # Check all PIDs on a host with a single helper invocation.
+        hostnodes = {}
         for node in nodes:
             pid = node.getPID()
             if not pid:
                 results += [(node, False)]
                 continue
 
-            cmds += [(node, "check-pid", [str(pid)])]
+            if cached and node.name in self.liveness and self.liveness[node.name][0] == pid:
+                verdicts[node.name] = self.liveness[node.name][1]
+                continue
+
+            if cached and self.health and self.health.isup(node.name, pid):
+                verdicts[node.name] = True
+                continue
+
+            hostnodes.setdefault(node.addr, []).append((node, pid))
+
+        cmds = []
+        for hnodes in hostnodes.values():
+            cmds += [(hnodes[0][0], "check-pids", [str(pid) for (n, pid) in hnodes])]
 
         for (node, success, output) in self.executor.run_helper(cmds):
-            # If we cannot run the helper script, then we ignore this node
-            # because the process might actually be running but we can't tell.
-            if not success:
-                self.ui.error("failed to run check-pid on node %s" % node.name)
+            hnodes = hostnodes[node.addr]
+            lines = output.splitlines()
+
+            # If we cannot run the helper script, then we ignore these nodes
+            # because the processes might actually be running but we can't
+            # tell.
+            if not success or len(lines) != len(hnodes):
+                for (n, pid) in hnodes:
+                    self.ui.error("failed to run check-pids on node %s" % n.name)
                 continue
 
-            running = output.strip() == "running"
+            for ((n, pid), line) in zip(hnodes, lines):
+                running = line.split(None, 1)[-1] == "running"
+                self.liveness[n.name] = (pid, running)
+                verdicts[n.name] = running
+
+        for node in nodes:
+            if node.name not in verdicts:
+                continue
+
+            running = verdicts[node.name]
 
             results += [(node, running)]
 
@@ -276,76 +548,86 @@ class Controller:
 
         return results
 
-    def _waitforbros(self, nodes, status, timeout, ensurerunning):
-        # If ensurerunning is true, process must still be running.
-        if ensurerunning:
-            running = self._isrunning(nodes)
-        else:
-            running = [(node, True) for node in nodes]
+    # Same as _isrunning, but also gets the status, the startup time, and the
+    # resource usage of the given nodes with a single helper invocation per
+    # host.  Returns a list of (node, isrunning, info) tuples, where "info"
+    # is a dict with the keys "status", "started", "vsize", "rss" and "cpu"
+    # (a value is None if it is not available).  If "cached" is True, then
+    # nodes that the health monitor knows to be up are only probed if their
+    # startup time is not known yet; the resource usage of the others is
+    # not available.
+    def _probe_nodes(self, nodes, setcrashed=True, cached=False):
 
         results = []
+        probes = {}
 
-        # Determine set of nodes still to check.
-        todo = {}
-        for (node, isrunning) in running:
-            if isrunning:
-                todo[node.name] = node
-            else:
-                results += [(node, False)]
+        hostnodes = {}
+        for node in nodes:
+            pid = node.getPID()
+            if not pid:
+                results += [(node, False, None)]
+                continue
 
-        while True:
-            # Determine whether process is still running. We need to do this
-            # before we get the state to avoid a race condition.
+            if cached and self.health and self.health.isup(node.name, pid) and self.startups.get(node.name, (None, None))[0] == pid:
+                info = {"vsize": None, "rss": None, "cpu": None, "status": "RUNNING", "started": self.startups[node.name][1]}
+                probes[node.name] = (True, info)
+                continue
 
-            nodelist = sorted(todo.values(), key=node_mod.sortnode)
-            running = self._isrunning(nodelist, setcrashed=False)
+            hostnodes.setdefault(node.addr, []).append((node, pid))
 
-            # Check nodes' .status file
-            cmds = []
-            for node in nodelist:
-                cmds += [(node, "first-line", ["%s/.status" % node.cwd()])]
+        cmds = []
+        for hnodes in hostnodes.values():
+            args = []
+            for (n, pid) in hnodes:
+                args += [str(pid), n.cwd()]
+            cmds += [(hnodes[0][0], "node-status", args)]
 
-            for (node, success, output) in self.executor.run_helper(cmds):
-                if not success or not output:
-                    continue
+        for (node, success, output) in self.executor.run_helper(cmds):
+            hnodes = hostnodes[node.addr]
+            lines = output.splitlines()
+
+            # As in _isrunning, nodes are ignored if we cannot run the
+            # helper script.
+            if not success or len(lines) != len(hnodes):
+                for (n, pid) in hnodes:
+                    self.ui.error("failed to run node-status on node %s" % n.name)
+                continue
 
-                fields = output.split()
-                if len(fields) == 2:
-                    if status in fields[0]:
-                        # Status reached. Cool.
-                        del todo[node.name]
-                        results += [(node, True)]
-                else:
-                    # Something's wrong. We give up on that node.
-                    del todo[node.name]
-                    results += [(node, False)]
+            for ((n, pid), line) in zip(hnodes, lines):
+                fields = line.split()
+                if len(fields) != 7:
+                    self.ui.error("bad output from node-status on node %s: %s" % (n.name, line))
+                    continue
 
-            for (node, isrunning) in running:
-                if node.name in todo and not isrunning:
-                    # Alright, a dead node's status will not change anymore.
-                    del todo[node.name]
-                    results += [(node, False)]
+                vals = [None if f == "-" else f for f in fields]
+                running = vals[1] == "1"
+                info = {
+                    "vsize": int(vals[2]) if vals[2] else None,
+                    "rss": int(vals[3]) if vals[3] else None,
+                    "cpu": int(vals[4]) if vals[4] else None,
+                    "status": vals[5],
+                    "started": vals[6],
+                }
 
-            if not todo:
-                # All done.
-                break
+                self.liveness[n.name] = (pid, running)
+                probes[n.name] = (running, info)
 
-            # Wait a bit before we start over.
-            time.sleep(1)
+                if running and info["started"]:
+                    self.startups[n.name] = (pid, info["started"])
 
-            # Timeout reached?
-            timeout -= 1
-            if timeout <= 0:
-                break
+        for node in nodes:
+            if node.name not in probes:
+                continue
 
-            logging.debug("Waiting for %d node(s)...", len(todo))
+            (running, info) = probes[node.name]
 
-        for node in todo.values():
-            # These did time-out.
-            results += [(node, False)]
+            results += [(node, running, info)]
 
-        if todo:
-            logging.debug("Timeout while waiting for %d node(s)", len(todo))
+            if not running:
+                if setcrashed:
+                    # Grmpf. It crashed.
+                    node.clearPID()
+                    node.setCrashed()
 
         return results
 
@@ -400,44 +682,44 @@ class Controller:
     def stop(self, nodes):
         results = cmdresult.CmdResult()
 
-        loggers, manager, proxies, workers = node_mod.separate_types(nodes)
-
         for n in nodes:
             n.setExpectRunning(False)
 
-        # Stop nodes. Do it in the order workers, proxies, manager, loggers
-        # (the reverse of "start").
-        if workers:
-            self._stop_nodes(workers, results)
-
-            if not results.ok:
-                for n in (proxies + manager + loggers):
-                    results.set_node_fail(n)
-                return results
-
-        if proxies:
-            self._stop_nodes(proxies, results)
-
-            if not results.ok:
-                for n in (manager + loggers):
-                    results.set_node_fail(n)
-                return results
-
-        if manager:
-            self._stop_nodes(manager, results)
-
-            if not results.ok:
-                for n in loggers:
-                    results.set_node_fail(n)
-                return results
+        # Nodes are stopped once all nodes of the types that depend on them
+        # (see _startdeps) are stopped, i.e. in the reverse order of
+        # "start".  All types that are ready are stopped together.
+        groups = _group_types(nodes)
+        bytype = dict(groups)
+        waiting = [t for (t, tnodes) in reversed(groups)]
+
+        while waiting:
+            ready = []
+            for t in waiting:
+                dependents = [u for u in waiting if t in _startdeps[u]]
+                if not dependents:
+                    ready += [t]
+
+            stopnodes = []
+            for t in ready:
+                waiting.remove(t)
+
+                dependents = [u for u in bytype if t in _startdeps[u]]
+                if [u for u in dependents if _type_failed(results, u)]:
+                    for n in bytype[t]:
+                        results.set_node_fail(n)
+                else:
+                    stopnodes += bytype[t]
 
-        if loggers:
-            self._stop_nodes(loggers, results)
+            if stopnodes:
+                self._stop_nodes(stopnodes, results)
 
         return results
 
     def _stop_nodes(self, nodes, results):
-        self.ui.info("stopping %s ..." % node_mod.nodes_describe(nodes))
+        for (t, tnodes) in reversed(_group_types(nodes)):
+            self.ui.info("stopping %s ..." % node_mod.nodes_describe(tnodes))
+
+        t0 = time.time()
 
         running = []
 
@@ -454,97 +736,50 @@ class Controller:
             self.ui.info("creating crash report for previously crashed nodes: %s" % ", ".join([n.name for n in crashed]))
             self._make_crash_reports(crashed)
 
-        # Helper function to stop nodes with given signal.
-        def stop(nodes, signal):
-            cmds = []
-            for node in nodes:
-                cmds += [(node, "stop", [str(node.getPID()), str(signal)])]
+        # Each node is stopped on its host, which sends a SIGKILL if the
+        # node does not terminate in time, and then runs post-terminate.
+        # The archiving of the logs continues in the background.
+        cmds = []
+        for node in running:
+            cmds += [(node, "stop-node", [str(node.getPID()), node.type, node.cwd(), str(self.config.stoptimeout)])]
 
-            return self.executor.run_helper(cmds)
+        self._forget_liveness(running)
 
-        # Stop nodes.
-        for (node, success, output) in stop(running, 15):
+        timeout = self.config.stoptimeout + 15 + self.config.commandtimeout
+        for (node, success, output) in self.executor.iter_helper(cmds, timeout=timeout):
             if not success:
                 # Give up on this node.  Most likely either we cannot connect
                 # to the host, or we don't have permission to kill the process.
                 self.ui.error("unable to stop %s: %s" % (node.name, output))
                 results.set_node_fail(node)
-                running.remove(node)
-
-        if running:
-            time.sleep(1)
-
-        # Check whether they terminated.
-        terminated = []
-        kill = []
-        for (node, success) in self._waitforbros(running, "TERMINATED", self.config.stoptimeout, False):
-            if not success:
-                # Check whether it crashed during shutdown ...
-                result = self._isrunning([node])
-                for (node, isrunning) in result:
-                    if isrunning:
-                        self.ui.info("%s did not terminate ... killing ..." % node.name)
-                        kill += [node]
-                    else:
-                        # crashed flag is set by _isrunning().
-                        self.ui.info("%s crashed during shutdown" % node.name)
-
-        if kill:
-            # Kill those which did not terminate gracefully.
-            stop(kill, 9)
-            # Give them a bit to disappear.
-            time.sleep(5)
-
-        # Check which are still running. We check all nodes to be on the safe
-        # side and give them a bit more time to finally disappear.
-        timeout = 10
-
-        todo = {}
-        for node in running:
-            todo[node.name] = node
-
-        while True:
-
-            nodelist = sorted(todo.values(), key=node_mod.sortnode)
-            running = self._isrunning(nodelist, setcrashed=False)
-
-            for (node, isrunning) in running:
-                if node.name in todo and not isrunning:
-                    # Alright, it's gone.
-                    del todo[node.name]
-                    terminated += [node]
-                    results.set_node_success(node)
-
-            if not todo:
-                # All done.
-                break
-
-            # Wait a bit before we start over.
+                continue
 
-            if timeout <= 0:
-                break
+            lines = output.splitlines()
+            how = lines[0] if lines else ""
+            state = lines[1] if len(lines) > 1 else ""
 
-            time.sleep(1)
-            timeout -= 1
+            logging.debug("%s: %s (%s) after %.2fs", node.name, state, how, time.time() - t0)
 
-        for node in todo.values():
-            results.set_node_fail(node)
+            if how == "killed":
+                self.ui.info("%s did not terminate ... killing ..." % node.name)
+            elif how == "crashed":
+                self.ui.info("%s crashed during shutdown" % node.name)
+                node.clearPID()
+                node.setCrashed()
 
-        # Do post-terminate cleanup for those which terminated gracefully.
-        cleanup = [node for node in terminated if not node.hasCrashed()]
+            if state != "stopped":
+                results.set_node_fail(node)
+                continue
 
-        cmds = []
-        postterminate = os.path.join(self.config.scriptsdir, "post-terminate")
-        for node in cleanup:
-            crashflag = "killed" if node in kill else ""
+            results.set_node_success(node)
 
-            cmds += [(node, postterminate, [node.type, node.cwd(), crashflag])]
+            if how == "crashed":
+                continue
 
-        for (node, success, output) in self.executor.run_cmds(cmds):
-            if success:
+            if len(lines) > 2 and lines[2] == "0":
                 self._log_action(node, "stopped")
             else:
-                self.ui.error("error running post-terminate for %s:\n%s" % (node.name, output))
+                self.ui.error("error running post-terminate for %s:\n%s" % (node.name, "\n".join(lines[3:])))
                 self._log_action(node, "stopped (failed)")
 
             node.clearPID()
@@ -562,37 +797,29 @@ class Controller:
         if showall:
             self.ui.info("Getting process status ...")
 
-        nodestatus = self._isrunning(nodes)
+        nodestatus = self._probe_nodes(nodes, cached=True)
         running = []
 
-        cmds = []
-        for (node, isrunning) in nodestatus:
-            if isrunning:
-                running += [node]
-                cmds += [(node, "first-line", ["%s/.status" % node.cwd(), "%s/.startup" % node.cwd()])]
-
         statuses = {}
         startups = {}
-        for (n, success, output) in self.executor.run_helper(cmds):
-            out = output.splitlines()
-            try:
-                val = out[0].split()[0].lower() if (success and out[0]) else "???"
-            except IndexError:
-                val = "???"
+        for (node, isrunning, info) in nodestatus:
+            if not isrunning:
+                continue
 
-            statuses[n.name] = val
+            running += [node]
+            statuses[node.name] = info["status"].lower() if info["status"] else "???"
 
             try:
-                val = fmttime(out[1]) if (success and out[1]) else "???"
-            except (IndexError, ValueError):
-                val = "???"
-
-            startups[n.name] = val
+                startups[node.name] = fmttime(info["started"]) if info["started"] else "???"
+            except ValueError:
+                startups[node.name] = "???"
 
         if showall:
             self.ui.info("Getting peer status ...")
             peers = {}
             nodes = [n for n in running if statuses[n.name] == "running"]
+            # The liveness of these nodes was just checked above, so this
+            # does not check it again.
             for (node, success, args) in self._query_peerstatus(nodes):
                 if success and args:
                     peers[node.name] = []
@@ -604,7 +831,7 @@ class Controller:
                         if val:
                             peers[node.name] += [val]
 
-        for (node, isrunning) in nodestatus:
+        for (node, isrunning, info) in nodestatus:
             node_info = {
                 "name": node.name,
                 "type": node.type,
@@ -612,6 +839,9 @@ class Controller:
                 "status": "stopped",
                 "pid": None,
                 "started": None,
+                "vsize": None,
+                "rss": None,
+                "cpu": None,
             }
             if showall:
                 node_info["peers"] = None
@@ -631,14 +861,19 @@ class Controller:
                         node_info["peers"] = "???"
 
                 node_info["started"] = startups[node.name]
+                node_info["vsize"] = info["vsize"]
+                node_info["rss"] = info["rss"]
+                node_info["cpu"] = info["cpu"]
 
             results.set_node_data(node, True, node_info)
 
         return results
 
     # Check the configuration for nodes without installing first.
-    def check(self, nodes):
-        return self._check_config(nodes, False, False)
+    # If "force" is False, then nodes whose configuration has not changed
+    # since their last successful check are not checked again.
+    def check(self, nodes, force=False):
+        return self._check_config(nodes, False, False, force)
 
     # Print the loaded_scripts.log for either the installed scripts
     # (if "check" is false), or the original scripts (if "check" is true).
@@ -646,13 +881,27 @@ class Controller:
         return self._check_config(nodes, not check, True)
 
 
-    def _check_config(self, nodes, installed, list_scripts):
+    def _check_config(self, nodes, installed, list_scripts, force=False):
         results = cmdresult.CmdResult()
 
-        nodetmpdirs = [(node, os.path.join(self.config.tmpdir, "check-config-%s" % node.name)) for node in nodes]
+        # Nodes whose checks would run Bro with the same inputs are checked
+        # only once, and the result is used for all of them.
+        scriptnames = self._check_script_names(installed)
+        groups = {}
+        grouplist = []
+        for node in nodes:
+            key = self._check_key(node, scriptnames)
+            if key not in groups:
+                groups[key] = []
+                grouplist.append((key, groups[key]))
+            groups[key].append(node)
+
+        logging.debug("checking %d nodes with %d runs of Bro", len(nodes), len(grouplist))
+
+        nodetmpdirs = [(key, group, os.path.join(self.config.tmpdir, "check-config-%s" % group[0].name)) for (key, group) in grouplist]
 
-        nodes = []
-        for (node, cwd) in nodetmpdirs:
+        groups = []
+        for (key, group, cwd) in nodetmpdirs:
             if os.path.isdir(cwd):
                 try:
                     shutil.rmtree(cwd)
@@ -668,10 +917,15 @@ class Controller:
                 results.ok = False
                 return results
 
-            nodes += [(node, cwd)]
+            groups += [(key, group, cwd)]
+
+        # Digests of the inputs of recent successful checks.
+        cached = self.config.get_state("checkcache") or []
+        unchanged = []
 
         cmds = []
-        for (node, cwd) in nodes:
+        for (key, group, cwd) in groups:
+            node = group[0]
 
             env = _make_env_params(node)
 
@@ -689,21 +943,107 @@ class Controller:
                 results.ok = False
                 return results
 
-            cmd = os.path.join(self.config.scriptsdir, "check-config") + " %s %s %s %s" % (installed_policies, print_scripts, cwd, " ".join(_make_bro_params(node, False)))
+            params = _make_bro_params(node, False)
+
+            # The list of loaded scripts is not cached.
+            digest = None
+            if not list_scripts:
+                digest = self._check_digest(cwd, installed, key)
+                if not force and digest in cached:
+                    unchanged += group
+                    for n in group:
+                        results.set_node_output(n, True, "")
+                    _remove_dir(cwd)
+                    continue
+
+            cmd = os.path.join(self.config.scriptsdir, "check-config") + " %s %s %s %s" % (installed_policies, print_scripts, cwd, " ".join(params))
             cmd += " broctl/check"
 
-            cmds += [((node, cwd), cmd, env, None)]
+            cmds += [((group, cwd, digest), cmd, env, None)]
 
-        for ((node, cwd), success, output) in execute.run_localcmds(cmds):
-            results.set_node_output(node, success, output)
-            try:
-                shutil.rmtree(cwd)
-            except OSError as err:
-                # Don't bother reporting an error now.
-                pass
+        if unchanged:
+            self.ui.info("configuration unchanged since last successful check: %s" % ", ".join([n.name for n in unchanged]))
+
+        # Each check is a full parse of the Bro scripts, so don't run more
+        # of them at once than there are CPUs.
+        passed = []
+        for ((group, cwd, digest), success, output) in self.executor.run_localcmds(cmds, util.cpu_count()):
+            for node in group:
+                results.set_node_output(node, success, output)
+            if success and digest:
+                passed.append(digest)
+            _remove_dir(cwd)
+
+        if passed:
+            # Remember only the most recent successful checks.
+            cached = [d for d in cached if d not in passed] + passed
+            self.config.set_state("checkcache", cached[-CHECK_CACHE_SIZE:])
 
         return results
 
+    # Returns a digest of everything that can affect the result of checking
+    # the Bro scripts in "cwd" (which must already contain the generated
+    # scripts) for nodes with the given key (see _check_key).
+    def _check_digest(self, cwd, installed, key):
+        hh = hashlib.sha1()
+
+        _hash_str(hh, "%s %r" % (installed, key))
+
+        bro = self.config.bro
+        try:
+            st = os.stat(bro)
+            _hash_str(hh, "%s %d %d" % (bro, st.st_size, st.st_mtime))
+        except OSError:
+            pass
+
+        for (dir, contents) in self._check_dirs(installed):
+            _hash_tree(hh, dir, contents)
+        _hash_tree(hh, cwd, True)
+
+        return hh.hexdigest()
+
+    # Returns the directories with the scripts that a check may load, as a
+    # list of (dir, contents) tuples, where "contents" tells if changes of
+    # the files are detected by content (see _hash_tree).  Bro's own
+    # scripts are only checked for changes of their size and modification
+    # time, the others are compared by content.
+    def _check_dirs(self, installed):
+        dirs = [(self.config.policydir, False), (self.config.policydirsiteinstallauto, True)]
+
+        if installed:
+            dirs += [(self.config.policydirsiteinstall, True)]
+        else:
+            dirs += [(self.config.subst(dir), True) for dir in self.config.sitepolicypath.split(":") if dir]
+
+        return dirs
+
+    # Returns the set of the file names (without directory) of all scripts
+    # in the directories of _check_dirs.
+    def _check_script_names(self, installed):
+        names = set()
+        for (dir, contents) in self._check_dirs(installed):
+            for (dirpath, dirnames, filenames) in os.walk(dir, followlinks=True):
+                names.update(filenames)
+
+        return names
+
+    # Returns a key describing the inputs of a check of the given node, so
+    # that nodes with equal keys give the same check results.  The node's
+    # name is passed to Bro (as CLUSTER_NODE and as a script prefix), but
+    # it only matters if there are scripts using the name as prefix in any
+    # of the script directories ("scriptnames" are the names of the files
+    # in them, see _check_script_names).
+    def _check_key(self, node, scriptnames):
+        prefix = "%s." % node.name
+        for name in scriptnames:
+            if name.startswith(prefix):
+                return (node.name, )
+
+        params = ["" if arg == node.name else arg for arg in _make_bro_params(node, False)]
+        env = [e for e in _make_env_params(node, True) if e != "CLUSTER_NODE=%s" % node.name]
+
+        return (node.type, tuple(params), tuple(env))
+
     def _query_peerstatus(self, nodes):
         running = self._isrunning(nodes)
 
@@ -714,10 +1054,12 @@ class Controller:
 
         return events.send_events_parallel(eventlist, config.Config.controltopic)
 
-    def execute_cmd(self, nodes, cmd):
+    # If "callback" is not None, it is called with the arguments (node,
+    # success, output) as soon as the command finishes on each node.
+    def execute_cmd(self, nodes, cmd, callback=None):
         results = cmdresult.CmdResult()
 
-        for node, success, out in self.executor.run_shell_cmds([(n, cmd) for n in nodes]):
+        for node, success, out in self.executor.run_shell_cmds([(n, cmd) for n in nodes], callback):
             results.set_node_output(node, success, out)
 
         return results
@@ -777,7 +1119,7 @@ class Controller:
         crashdiag = os.path.join(self.config.scriptsdir, "crash-diag")
         cmds = [(node, crashdiag, [node.cwd()]) for node in nodes]
 
-        for (node, success, output) in self.executor.run_cmds(cmds):
+        for (node, success, output) in self.executor.run_cmds(cmds, fulloutput=True):
             if not success:
                 errmsgs = "error running crash-diag for %s\n" % node.name
                 errmsgs += output
@@ -932,7 +1274,7 @@ class Controller:
                 cmds += [(node.name, os.path.join(self.config.scriptsdir, "update") + " %s %s/tcp %s" % (util.format_bro_addr(node.addr), node.getPort(), args), env, None)]
                 self.ui.info("updating %s ..." % node.name)
 
-        res = execute.run_localcmds(cmds)
+        res = self.executor.run_localcmds(cmds)
 
         for (tag, success, output) in res:
             node = self.config.nodes(tag)[0]
@@ -973,7 +1315,7 @@ class Controller:
 
                 cmds += [(node, "df", [path])]
 
-        for (node, success, output) in self.executor.run_helper(cmds):
+        for (node, success, output) in self.executor.iter_helper(cmds):
             if success:
                 fields = output.split()
                 if len(fields) != 4:
@@ -1004,6 +1346,39 @@ class Controller:
 
         return results
 
+    # Report the post-terminate jobs that are still archiving logs in the
+    # background on the hosts of the given nodes.  If "wait" is True, then
+    # wait until all of them have finished.  The data of each node's result
+    # is a dict with a list of (node name, pid, directory) tuples.
+    def archives(self, nodes, wait=False):
+        results = cmdresult.CmdResult()
+
+        jobs = {}
+        todo = nodes
+        while todo:
+            timeout = max(self.config.commandtimeout - 5, 0) if wait else 0
+            cmds = [(node, "archive-jobs", [str(timeout)]) for node in todo]
+
+            todo = []
+            for (node, success, output) in self.executor.run_helper(cmds):
+                if not success:
+                    jobs[node.name] = (False, {"_output": output})
+                    continue
+
+                hostjobs = [tuple(line.split(None, 2)) for line in output.splitlines() if line.strip()]
+                jobs[node.name] = (True, {"jobs": hostjobs})
+                if wait and hostjobs:
+                    todo += [node]
+
+            if todo:
+                self.ui.info("waiting for %d archive job(s) ..." % sum([len(jobs[n.name][1]["jobs"]) for n in todo]))
+
+        for node in nodes:
+            (success, data) = jobs[node.name]
+            results.set_node_data(node, success, data)
+
+        return results
+
     # Returns a list of tuples of the form (node, error, vals) where 'error' is
     # an error message string, or None if there was no error.  'vals' is a
     # dict which maps tags to their values.  Tags are "pid", "vsize",
@@ -1364,7 +1739,7 @@ class Controller:
                 return results
 
         paths = [self.config.subst(dir) for (dir, mirror) in syncs if mirror]
-        if not execute.sync(nodes, paths, self.ui):
+        if not self.executor.sync(nodes, paths, self.ui):
             results.ok = False
             return results
 
@@ -1374,6 +1749,51 @@ class Controller:
         return results
 
 
+    # Check if node state matches expected state, and start/stop if
+    # necessary.  If "cached" is False, then the nodes are always checked
+    # over ssh.
+    def watch(self, nodes, cached=True):
+        startlist = []
+        stoplist = []
+        for (node, isrunning) in self._isrunning(nodes, cached=cached):
+            expectrunning = node.getExpectRunning()
+
+            if not isrunning and expectrunning:
+                startlist.append(node)
+            elif isrunning and not expectrunning:
+                stoplist.append(node)
+
+        if startlist:
+            self.start(startlist)
+        if stoplist:
+            self.stop(stoplist)
+
+    # Called when the health monitor lost the peering with the given nodes.
+    # Losing a peering does not necessarily mean that Bro has died (it may
+    # have been stopped on purpose, or the network may be down), so the
+    # nodes are checked over ssh.  Crashed nodes are then handled as "cron"
+    # would do it, just sooner.
+    def nodes_lost(self, nodes):
+        # Nodes that were stopped by broctl have no PID anymore.
+        nodes = [node for node in nodes if node.getPID()]
+        if not nodes:
+            return
+
+        if self.config.cronenabled:
+            self.watch(nodes, cached=False)
+        else:
+            self._isrunning(nodes, cached=False)
+
+    # Returns (name, addr, port, pid) tuples of the nodes that should be
+    # watched by the health monitor.
+    def health_targets(self):
+        targets = []
+        for node in self.config.nodes():
+            pid = node.getPID()
+            if pid:
+                targets += [(node.name, node.addr, node.getPort(), pid)]
+        return targets
+
     # Triggers all activity which is to be done regularly via cron.
     def cron(self, watch):
         if not self.config.cronenabled:
@@ -1392,22 +1812,7 @@ class Controller:
         cronui.buffer_output()
 
         if watch:
-            # Check if node state matches expected state, and start/stop if
-            # necessary.
-            startlist = []
-            stoplist = []
-            for (node, isrunning) in self._isrunning(self.config.nodes()):
-                expectrunning = node.getExpectRunning()
-
-                if not isrunning and expectrunning:
-                    startlist.append(node)
-                elif isrunning and not expectrunning:
-                    stoplist.append(node)
-
-            if startlist:
-                results = self.start(startlist)
-            if stoplist:
-                results = self.stop(stoplist)
+            self.watch(self.config.nodes())
 
         # Check for dead hosts.
         tasks.check_hosts()
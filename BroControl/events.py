@@ -1,4 +1,6 @@
 import logging
+import select
+import time
 
 from BroControl import config
 
@@ -24,15 +26,20 @@ except ImportError as e:
 #   result_event: name of a event the node sends back. None if no event is
 #                 sent back.
 #
-# Returns a list of tuples (node, success, results_args).
+# Returns a list of tuples (node, success, results_args) in the same order
+# as "events".
 #   If success is True, result_args is a list of arguments as shipped with the
 #   result event, or [] if no result_event was specified.
 #   If success is False, results_args is a string with an error message.
+#
+# All nodes are contacted concurrently, and the whole exchange must finish
+# within CommTimeout seconds.  Each node gets its own endpoint, because the
+# result events do not tell which node sent them.
 
 def send_events_parallel(events, topic):
 
     results = []
-    sent = []
+    requests = []
 
     for (node, event, args, result_event) in events:
 
@@ -40,68 +47,87 @@ def send_events_parallel(events, topic):
             results += [(node, False, "Python bindings for Broker: %s" % errmsg)]
             continue
 
-        success, endpoint, sub = _send_event_init(node, event, args, result_event, topic)
-
-        if success and result_event:
-            sent += [(node, result_event, endpoint, sub)]
-        else:
-            results += [(node, success, endpoint, sub)]
-
-    for (node, result_event, endpoint, sub) in sent:
-        success, result_args = _send_event_wait(node, result_event, endpoint, sub)
-        endpoint.shutdown()
-        results += [(node, success, result_args)]
-
-    return results
-
-def _send_event_init(node, event, args, result_event, topic):
-
-    host = node.addr
-    endpoint = broker.Endpoint()
-    subscriber = endpoint.make_subscriber(topic)
-    status_subscriber = endpoint.make_status_subscriber(True)
-    endpoint.peer(host, node.getPort(), 1)
-
-    tries = 0
-
-    while True:
-        msgs = status_subscriber.get(1, 1)
-
-        for msg in msgs:
-            if isinstance(msg, broker.Status):
-                if msg.code() == broker.SC.PeerAdded:
-                    ev = broker.bro.Event(event, *args)
-                    endpoint.publish(topic + "/" + repr(msg.context()), ev)
-                    logging.debug("broker: %s(%s) to node %s", event,
-                                  ", ".join(args), node.name)
-                    return (True, endpoint, subscriber)
-
-        tries += 1
-
-        if tries > config.Config.commtimeout:
-            return (False, "time-out", None)
-
-def _send_event_wait(node, result_event, bc, sub):
-    if not result_event:
-        return (True, [])
-
-    # Wait for reply event.
-    tries = 0
-
-    while True:
-        msgs = sub.get(1, 1)
-
-        for msg in msgs:
-            (topic, event) = msg
+        req = _Request(node, event, args, result_event, topic)
+        requests += [req]
+        results += [req]
+
+    deadline = time.time() + config.Config.commtimeout
+
+    try:
+        while True:
+            fds = {}
+            for req in requests:
+                if req.result is None:
+                    fds[req.fd()] = req
+
+            timeout = deadline - time.time()
+            if not fds or timeout <= 0:
+                break
+
+            ready, _, _ = select.select(list(fds), [], [], timeout)
+            for fd in ready:
+                fds[fd].poll()
+    finally:
+        for req in requests:
+            req.endpoint.shutdown()
+
+    for req in requests:
+        if req.result is None:
+            if req.peered:
+                logging.debug("broker: timeout during receive from node %s", req.node.name)
+            else:
+                logging.debug("broker: timeout during peering with node %s", req.node.name)
+            req.result = (False, "time-out")
+
+    return [r if isinstance(r, tuple) else (r.node, r.result[0], r.result[1]) for r in results]
+
+
+# The state of sending an event to one node.
+class _Request:
+    def __init__(self, node, event, args, result_event, topic):
+        self.node = node
+        self.event = event
+        self.args = args
+        self.result_event = result_event
+        self.topic = topic
+        self.peered = False
+
+        # A tuple (success, result_args) once we are done with this node.
+        self.result = None
+
+        self.endpoint = broker.Endpoint()
+        self.subscriber = self.endpoint.make_subscriber(topic)
+        self.status_subscriber = self.endpoint.make_status_subscriber(True)
+
+        # Don't block here, so that we can peer with all nodes at once.
+        self.endpoint.peer_nosync(node.addr, node.getPort(), 1)
+
+    # The file descriptor that becomes readable when there is something to
+    # do for this node.
+    def fd(self):
+        if self.peered:
+            return self.subscriber.fd()
+        return self.status_subscriber.fd()
+
+    def poll(self):
+        if not self.peered:
+            for msg in self.status_subscriber.poll():
+                if isinstance(msg, broker.Status) and msg.code() == broker.SC.PeerAdded:
+                    ev = broker.bro.Event(self.event, *self.args)
+                    self.endpoint.publish(self.topic + "/" + repr(msg.context()), ev)
+                    logging.debug("broker: %s(%s) to node %s", self.event,
+                                  ", ".join(self.args), self.node.name)
+                    self.peered = True
+
+                    if not self.result_event:
+                        self.result = (True, [])
+                    return
+            return
+
+        for (topic, event) in self.subscriber.poll():
             ev = broker.bro.Event(event)
             args = ev.args()
-            logging.debug("broker: %s(%s) from node %s", result_event,
-                          ", ".join(args), node.name)
-            return (True, args)
-
-        tries += 1
-
-        if tries > config.Config.commtimeout:
-            logging.debug("broker: timeout during receive from node %s", node.name)
-            return (False, "time-out")
-
+            logging.debug("broker: %s(%s) from node %s", self.result_event,
+                          ", ".join(args), self.node.name)
+            self.result = (True, args)
+            return
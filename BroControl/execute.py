@@ -4,12 +4,18 @@
 import os
 import shutil
 import subprocess
+import sys
 import logging
+from threading import Thread
 
 from BroControl import py3bro
+from BroControl import connbroker
 from BroControl import ssh_runner
 from BroControl import util
 
+Queue = py3bro.Queue
+Empty = py3bro.Empty
+
 
 # Copy src to dstdir, preserving permission bits and file type.  The src
 # file type can be symlink, regular file, or directory (directories are copied
@@ -47,8 +53,9 @@ def install(src, dstdir, cmdout):
 
     return True
 
-# rsyncs paths from localhost to destination hosts.
-def sync(nodes, paths, cmdout):
+# rsyncs paths from localhost to destination hosts.  The rsync commands
+# are run with "runcmds" (see run_localcmds).
+def sync(nodes, paths, cmdout, runcmds=None):
     result = True
     cmds = []
     for n in nodes:
@@ -58,7 +65,7 @@ def sync(nodes, paths, cmdout):
         cmdline = "rsync %s" % " ".join(args)
         cmds += [(n, cmdline, "", None)]
 
-    for (id, success, output) in run_localcmds(cmds):
+    for (id, success, output) in (runcmds or run_localcmds)(cmds):
         if not success:
             cmdout.error("rsync to %s failed: %s" % (id.addr, output))
             result = False
@@ -78,9 +85,13 @@ def run_localcmd(cmd, env=None, inputtext=None):
 
 # Same as run_localcmd() but runs a set of local commands in parallel.
 # Cmds is a list of (id, cmd, envs, inputtext) tuples, where id is
-# an arbitrary cookie identifying each command.
+# an arbitrary cookie identifying each command.  If maxprocs is not zero,
+# then at most that many commands run at the same time.
 # Returns a list of (id, success, output) tuples.
-def run_localcmds(cmds):
+def run_localcmds(cmds, maxprocs=0):
+    if maxprocs and len(cmds) > maxprocs:
+        return _run_localcmds_bounded(cmds, maxprocs)
+
     results = []
     running = []
 
@@ -94,6 +105,38 @@ def run_localcmds(cmds):
 
     return results
 
+# Runs the commands with "maxprocs" threads, each of which runs one
+# command after the other.
+def _run_localcmds_bounded(cmds, maxprocs):
+    results = [None] * len(cmds)
+    todo = Queue()
+    for i, cmd in enumerate(cmds):
+        todo.put((i, cmd))
+
+    def run():
+        while True:
+            try:
+                i, (id, cmd, envs, inputtext) = todo.get_nowait()
+            except Empty:
+                return
+
+            try:
+                proc = _run_localcmd_init(id, cmd, envs)
+                success, output = _run_localcmd_wait(proc, inputtext)
+            except Exception as err:
+                # Record the failure instead of leaving the result empty.
+                success, output = False, str(err)
+
+            results[i] = (id, success, output)
+
+    threads = [Thread(target=run) for i in range(maxprocs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return results
+
 def _run_localcmd_init(id, cmd, env):
 
     if env:
@@ -140,11 +183,37 @@ subprocess.Popen.__del__ = _emptyDel
 class Executor:
     def __init__(self, config):
         self.config = config
-        self.sshrunner = ssh_runner.MultiMasterManager(config.localaddrs)
+
+        # The asyncio-based engine, if it is enabled.
+        self.asyncrunner = None
+
+        # Use the connections of a running connection broker, if any.
+        self.sshrunner = connbroker.connect(config.connbrokersocket, config.localaddrs)
+        if not self.sshrunner:
+            if config.asyncexecutor and sys.version_info >= (3, 5):
+                from BroControl import asyncexec
+                self.asyncrunner = asyncexec.AsyncMultiMasterManager(config.localaddrs)
+                self.sshrunner = self.asyncrunner
+            else:
+                if config.asyncexecutor:
+                    logging.debug("AsyncExecutor requires Python 3.5 or newer, using threads instead")
+                self.sshrunner = ssh_runner.MultiMasterManager(config.localaddrs)
 
     def finish(self):
         self.sshrunner.shutdown_all()
 
+    # Same as the run_localcmds function, but uses the asyncio-based engine
+    # if it is enabled.
+    def run_localcmds(self, cmds, maxprocs=0):
+        if self.asyncrunner:
+            return self.asyncrunner.run_localcmds(cmds, maxprocs)
+        return run_localcmds(cmds, maxprocs)
+
+    # Same as the sync function, but uses the asyncio-based engine if it is
+    # enabled.
+    def sync(self, nodes, paths, cmdout):
+        return sync(nodes, paths, cmdout, self.run_localcmds)
+
     # Run commands in parallel on one or more hosts.
     #
     # cmds:  a list of the form: [ (node, cmd, args), ... ]
@@ -153,6 +222,13 @@ class Executor:
     #   shell.
     # helper:  if True, then the "cmd" will be modified to specify the full
     #   path to the broctl helper script.
+    # callback:  if not None, a function that is called with the arguments
+    #   (node, success, output) as soon as each command finishes.
+    # timeout:  if not None, the number of seconds after which the commands
+    #   are killed (instead of the CommandTimeout option).
+    # fulloutput:  if True, then the complete output of commands whose output
+    #   was too large to be sent at once is retrieved from the host.
+    #   Otherwise, such output is truncated.
     #
     # Returns a list of results: [(node, success, output), ...]
     #   where "success" is a boolean (True if command's exit status was zero),
@@ -160,11 +236,32 @@ class Executor:
     #   stderr, or an error message if no result was received (this could occur
     #   upon failure to communicate with remote host, or if the command being
     #   executed did not finish before the timeout).
-    def run_cmds(self, cmds, shell=False, helper=False):
+    def run_cmds(self, cmds, shell=False, helper=False, callback=None, timeout=None, fulloutput=False):
         results = []
 
+        for (i, bronode, success, output) in self._iter_cmds(cmds, shell, helper, timeout, fulloutput):
+            if callback:
+                callback(bronode, success, output)
+            results.append((i, bronode, success, output))
+
+        results.sort(key=lambda r: r[0])
+
+        return [(bronode, success, output) for (i, bronode, success, output) in results]
+
+    # Same as run_cmds, but a generator that yields the (node, success,
+    # output) tuples in the order in which the commands finish on any host.
+    def iter_cmds(self, cmds, shell=False, helper=False, timeout=None):
+        for (i, bronode, success, output) in self._iter_cmds(cmds, shell, helper, timeout, False):
+            yield (bronode, success, output)
+
+    # Yields (i, node, success, output) tuples in completion order, where "i"
+    # is the position of the result in the list returned by run_cmds.
+    def _iter_cmds(self, cmds, shell, helper, timeout, fulloutput):
         if not cmds:
-            return results
+            return
+
+        if timeout is None:
+            timeout = self.config.commandtimeout
 
         dd = {}
         hostlist = []
@@ -176,6 +273,7 @@ class Executor:
             dd[host].append(nodecmd)
 
         nodecmdlist = []
+        bronodes = []
         for host in hostlist:
             for bronode, cmd, args in dd[host]:
                 if helper:
@@ -190,36 +288,52 @@ class Executor:
                     cmdargs += args
 
                 nodecmdlist.append((bronode.addr, cmdargs))
+                bronodes.append(bronode)
                 logging.debug("%s: %s", bronode.host, " ".join(cmdargs))
 
-        for host, result in self.sshrunner.exec_multihost_commands(nodecmdlist, shell, self.config.commandtimeout):
-            nodecmd = dd[host].pop(0)
-            bronode = nodecmd[0]
+        self.sshrunner.set_limits(self.config.maxhostprocs, self.config.get_cmd_limits())
+
+        for i, host, result in self.sshrunner.iter_multihost_commands(nodecmdlist, shell, timeout):
+            bronode = bronodes[i]
             if not isinstance(result, Exception):
-                res = result[0]
-                out = result[1]
-                err = result[2]
-                results.append((bronode, res == 0, out + err))
-                logging.debug("%s: exit code %d", bronode.host, res)
+                res = result.status
+                output = result.stdout + result.stderr
+                logging.debug("%s: exit code %d (queued %.2fs, ran %.2fs)", bronode.host, res, result.queued, result.runtime)
+                if result.spilled:
+                    logging.debug("%s: output of %d bytes saved in %s", bronode.host, result.size, result.spilled)
+                    fetched = False
+                    if fulloutput:
+                        fetched, complete = self.fetch_output(bronode, result.spilled)
+                    if fetched:
+                        output = complete
+                    else:
+                        output += "\n[output truncated, %d bytes total]\n" % result.size
+                if result.killed == "timeout":
+                    output += "\n[command killed after %d seconds]\n" % timeout
+                elif result.killed == "cancelled":
+                    output += "\n[command cancelled]\n"
+                yield (i, bronode, res == 0, output)
             else:
-                results.append((bronode, False, str(result)))
-
-        return results
+                yield (i, bronode, False, str(result))
 
     # Run shell commands in parallel on one or more hosts.
     # cmdlines:  a list of the form [ (node, cmdline), ... ]
     #   where "cmdline" is a string to be interpreted by the shell
     #
-    # Return value is same as run_cmds.
-    def run_shell_cmds(self, cmdlines):
+    # Return value (and "callback") is same as run_cmds.
+    def run_shell_cmds(self, cmdlines, callback=None):
         cmds = [(node, cmdline, []) for node, cmdline in cmdlines]
 
-        return self.run_cmds(cmds, shell=True)
+        return self.run_cmds(cmds, shell=True, callback=callback)
 
     # A convenience function that calls run_cmds.
     def run_helper(self, cmds, shell=False):
         return self.run_cmds(cmds, shell, True)
 
+    # A convenience function that calls iter_cmds.
+    def iter_helper(self, cmds, shell=False, timeout=None):
+        return self.iter_cmds(cmds, shell, True, timeout)
+
     # A convenience function that calls run_cmds.
     # dirs:  a list of the form [ (node, dir), ... ]
     #
@@ -257,6 +371,16 @@ class Executor:
 
         return results
 
+    # Retrieve the complete output of a command whose output was truncated
+    # because it was too large ("path" is the name of the spill file on the
+    # host).  The file is removed on the remote host afterwards.
+    #
+    # Returns a tuple (success, output).
+    def fetch_output(self, node, path):
+        results = self.run_cmds([(node, ssh_runner.FETCH_CMD, [path])])
+        _, success, output = results[0]
+        return (success, output)
+
     def host_status(self):
         return self.sshrunner.host_status()
 
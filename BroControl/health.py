@@ -0,0 +1,170 @@
+# Near-real-time health of the running nodes.
+#
+# The HealthMonitor keeps a single Broker endpoint peered with every running
+# node.  Broker notices within seconds when a peering goes away (which is
+# what happens when a Bro process dies, because the kernel closes its
+# sockets), so the monitor can report a lost node long before the next
+# "broctl cron" would notice it.  Broker keeps trying to re-establish lost
+# peerings, so a node that is restarted is seen as up again automatically.
+#
+# The state of each node is kept in a HealthTable, which can be read
+# without contacting the hosts.
+
+import logging
+import select
+import time
+from threading import Thread, Lock
+
+from BroControl import py3bro
+
+Queue = py3bro.Queue
+Empty = py3bro.Empty
+
+try:
+    import broker
+except ImportError:
+    broker = None
+
+# Seconds between attempts to re-establish a lost peering.
+RETRY_INTERVAL = 1
+
+
+class HealthTable:
+    # The state of a node is one of:
+    #   "connecting":  we are trying to peer with the node.
+    #   "up":  we are peered with the node.
+    #   "lost":  the peering with the node went away.
+    def __init__(self):
+        self.lock = Lock()
+        self.nodes = {}
+
+    def set(self, name, pid, state):
+        with self.lock:
+            self.nodes[name] = {"pid": pid, "state": state, "since": time.time()}
+
+    def remove(self, name):
+        with self.lock:
+            self.nodes.pop(name, None)
+
+    # Returns True if the node with the given PID is known to be up.
+    def isup(self, name, pid):
+        with self.lock:
+            entry = self.nodes.get(name)
+            return entry is not None and entry["pid"] == pid and entry["state"] == "up"
+
+    # Returns a dict mapping node names to a copy of their entries.
+    def get(self):
+        with self.lock:
+            return dict((name, dict(entry)) for (name, entry) in self.nodes.items())
+
+
+class HealthMonitor(Thread):
+    # "lost" is a function that is called (from the monitor thread) with a
+    # list of node names whenever peerings with nodes go away.
+    def __init__(self, topic, lost):
+        Thread.__init__(self)
+        self.daemon = True
+        self.topic = topic
+        self.lost = lost
+        self.table = HealthTable()
+        self.q = Queue()
+
+        # Maps (addr, port) to (name, pid) of the nodes we are peering with.
+        self.peers = {}
+
+    # Set the nodes to watch.  "targets" is a list of (name, addr, port,
+    # pid) tuples of all running nodes.
+    def update(self, targets):
+        self.q.put(targets)
+
+    def run(self):
+        if not broker:
+            logging.debug("health monitor: Python bindings for Broker not found")
+            return
+
+        endpoint = broker.Endpoint()
+        # Broker only accepts a peering if both sides agree on a topic.
+        endpoint.make_subscriber(self.topic)
+        status = endpoint.make_status_subscriber(True)
+
+        try:
+            while True:
+                # Keep monitoring if something goes wrong, since nothing
+                # else would notice that the monitor is gone.
+                try:
+                    self._step(endpoint, status)
+                except Exception as err:
+                    logging.warning("health monitor: %s", err)
+                    time.sleep(RETRY_INTERVAL)
+        finally:
+            endpoint.shutdown()
+
+    def _step(self, endpoint, status):
+        ready, _, _ = select.select([status.fd()], [], [], RETRY_INTERVAL)
+        if ready:
+            self._handle_status(status.poll())
+
+        while True:
+            try:
+                targets = self.q.get_nowait()
+            except Empty:
+                break
+            self._set_targets(endpoint, targets)
+
+    def _set_targets(self, endpoint, targets):
+        wanted = {}
+        for (name, addr, port, pid) in targets:
+            if port > 0:
+                wanted[(addr, port)] = (name, pid)
+
+        for (peer, (name, pid)) in list(self.peers.items()):
+            if peer not in wanted:
+                logging.debug("health monitor: stop watching node %s", name)
+                del self.peers[peer]
+                self.table.remove(name)
+                endpoint.unpeer(peer[0], peer[1])
+
+        for (peer, (name, pid)) in wanted.items():
+            if peer in self.peers:
+                # A restarted node keeps its address, and Broker re-peers
+                # with it on its own.  The new process is not known to be
+                # up until then.
+                if self.peers[peer] != (name, pid):
+                    self.peers[peer] = (name, pid)
+                    self.table.set(name, pid, "connecting")
+            else:
+                logging.debug("health monitor: watching node %s", name)
+                self.peers[peer] = (name, pid)
+                self.table.set(name, pid, "connecting")
+                endpoint.peer_nosync(peer[0], peer[1], RETRY_INTERVAL)
+
+    def _handle_status(self, msgs):
+        lost = []
+
+        for msg in msgs:
+            if not isinstance(msg, broker.Status):
+                continue
+
+            # Not all status messages are about a peer.
+            network = msg.context().network
+            if network is None:
+                continue
+
+            peer = (network.address, network.port)
+            if peer not in self.peers:
+                continue
+
+            (name, pid) = self.peers[peer]
+            code = msg.code()
+
+            if code == broker.SC.PeerAdded:
+                logging.debug("health monitor: node %s is up", name)
+                self.table.set(name, pid, "up")
+
+            elif code in (broker.SC.PeerLost, broker.SC.PeerRemoved):
+                logging.debug("health monitor: lost node %s", name)
+                self.table.set(name, pid, "lost")
+                lost.append(name)
+
+        if lost:
+            self.lost(lost)
@@ -18,8 +18,8 @@ def _break_lock(cmdout):
         cmdout.error("failed to read lock file: %s" % err)
         return -1
 
-    success, output = execute.run_localcmd("%s %s" % (os.path.join(config.Config.helperdir, "check-pid"), pid))
-    if success and output.strip() == "running":
+    success, output = execute.run_localcmd("%s %s" % (os.path.join(config.Config.helperdir, "check-pids"), pid))
+    if success and output.strip() == "%s running" % pid:
         # Process still exists.
         try:
             return int(pid)
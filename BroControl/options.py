@@ -35,12 +35,24 @@ options = [
 
     Option("StopTimeout", 60, "int", Option.USER, False,
            "The number of seconds to wait before sending a SIGKILL to a node which was previously issued the 'stop' command but did not terminate gracefully."),
+    Option("MaxHostStarts", 0, "int", Option.USER, False,
+           "The maximum number of Bro processes that broctl starts concurrently on each host (zero means no limit).  A process counts until it has finished initializing, so this limits the load caused by parsing scripts at startup."),
+    Option("StartStagger", 0, "int", Option.USER, False,
+           "The number of milliseconds to wait between starting two Bro processes on the same host."),
+    Option("StartTimeout", 3, "int", Option.USER, False,
+           "The number of seconds to wait for a node to reach the RUNNING status after starting it.  A node that takes longer is reported as still initializing."),
     Option("CommTimeout", 10, "int", Option.USER, False,
            "The number of seconds to wait before assuming Broccoli communication events have timed out."),
     Option("ControlTopic", "bro/control", "string", Option.USER, False,
            "The Broker topic name used for sending and receiving control messages to Bro processes."),
     Option("CommandTimeout", 60, "int", Option.USER, False,
            "The number of seconds to wait for a command to return results."),
+    Option("AsyncExecutor", 0, "bool", Option.USER, False,
+           "True to run commands with an asyncio-based engine that drives the connections to all hosts from a single event loop instead of one thread per host (requires Python 3.5 or newer)."),
+    Option("MaxHostProcs", 0, "int", Option.USER, False,
+           "The maximum number of commands (such as helper scripts) that broctl runs concurrently on each host (zero means no limit).  Commands exceeding the limit wait on the host until a running command finishes."),
+    Option("MaxHostProcsPerCmd", "", "string", Option.USER, False,
+           "A comma-separated list of per-command limits (e.g. maxhostprocspercmd=start-node=4, crash-diag=1) on the number of instances of a command that broctl runs concurrently on each host.  The command name is the name of the program or helper script that broctl runs."),
     Option("BroPort", 47760, "int", Option.USER, False,
            "The TCP port number that Bro will listen on. For a cluster configuration, each node in the cluster will automatically be assigned a subsequent port to listen on."),
     Option("LogRotationInterval", 3600, "int", Option.USER, False,
@@ -194,6 +206,8 @@ options = [
            "File defining the local networks."),
     Option("StateFile", "${SpoolDir}/state.db", "string", Option.AUTOMATIC, False,
            "File storing the current broctl state."),
+    Option("ConnBrokerSocket", "${SpoolDir}/connbroker.sock", "string", Option.AUTOMATIC, False,
+           "Unix socket of the optional connection broker (started with 'broctl --connection-broker') that keeps the connections to all hosts open across broctl runs."),
     Option("LockFile", "${SpoolDir}/lock", "string", Option.AUTOMATIC, False,
            "Lock file preventing concurrent shell operations."),
 
@@ -194,16 +194,20 @@ class Plugin(object):
         return result
 
     @doc.api
-    def executeParallel(self, cmds):
+    def executeParallel(self, cmds, callback=None):
         """Executes a set of commands in parallel on multiple hosts. ``cmds``
         is a list of tuples ``(node, cmd)``, in which the *node* is a `Node`_
         instance and *cmd* is a string with the command to execute for it. The
         method returns a list of tuples ``(node, success, output)``, in which
         ``success`` is True if the command ran successfully, and ``output`` is
         a string containing the combined stdout/stderr output for the
-        corresponding ``node``."""
+        corresponding ``node``.
 
-        return self.executor.run_shell_cmds(cmds)
+        If ``callback`` is given, it is called with the arguments ``(node,
+        success, output)`` as soon as each command finishes, so that a plugin
+        can act on early results while other commands are still running."""
+
+        return self.executor.run_shell_cmds(cmds, callback)
 
     ### Methods that must be overridden by plugins.
 
@@ -814,6 +818,28 @@ class Plugin(object):
         """
         pass
 
+    @doc.api("override")
+    def cmd_archives_pre(self, nodes, wait):
+        """Called just before the ``archives`` command is run. It receives
+        the list of nodes, and returns the list of nodes that should proceed
+        with the command. *wait* is boolean indicating whether the ``--wait``
+        argument has been given.
+
+        This method can be overridden by derived classes. The default
+        implementation does nothing.
+        """
+        pass
+
+    @doc.api("override")
+    def cmd_archives_post(self, nodes, wait):
+        """Called just after the ``archives`` command has finished. Arguments
+        are as with the ``pre`` method.
+
+        This method can be overridden by derived classes. The default
+        implementation does nothing.
+        """
+        pass
+
     @doc.api("override")
     def cmd_capstats_pre(self, nodes, interval):
         """Called just before the ``capstats`` command is run. It receives the
@@ -207,6 +207,12 @@ class TestPlugin(BroControl.plugin.Plugin):
     def cmd_cleanup_post(self, nodes, all):
         self.message("TestPlugin: Test post 'cleanup': %s (%s)" % (self._nodes(nodes), all))
 
+    def cmd_archives_pre(self, nodes, wait):
+        self.message("TestPlugin: Test pre 'archives':  %s (%s)" % (self._nodes(nodes), wait))
+
+    def cmd_archives_post(self, nodes, wait):
+        self.message("TestPlugin: Test post 'archives': %s (%s)" % (self._nodes(nodes), wait))
+
     def cmd_capstats_pre(self, nodes, interval):
         self.message("TestPlugin: Test pre 'capstats':  %s (%d)" % (self._nodes(nodes), interval))
 
@@ -1,88 +1,730 @@
-import ast
 import collections
+import itertools
 import json
 import subprocess
 import select
+import struct
 import time
 import os
 import base64
 import zlib
 import logging
-from threading import Thread
+from threading import Lock, Thread
 
 from BroControl import py3bro
 Queue = py3bro.Queue
 Empty = py3bro.Empty
 
 
-def get_muxer(shell):
+# Framing of the muxer protocol.  Every message in either direction is a
+# frame consisting of a one-byte frame type and the payload length (FRAME),
+# followed by the payload.
+FRAME = struct.Struct("!cI")
+
+# Payload header of a result frame: request ID of the batch, command index,
+# exit status, flags, length of stdout, length of stderr, length of the spill
+# file name, the total output size (i.e., before any truncation), and the
+# time in milliseconds that the command was queued and running.
+RESULT = struct.Struct("!IIiBIIIQII")
+
+# Payload of "done" and "cancel" frames: request ID of the batch.
+REQID = struct.Struct("!I")
+
+# Frame types.
+FRAME_READY = b"R"   # muxer -> broctl: the muxer is up and running
+FRAME_BATCH = b"B"   # broctl -> muxer: JSON-encoded command batch
+FRAME_RESULT = b"O"  # muxer -> broctl: result of one command
+FRAME_DONE = b"D"    # muxer -> broctl: all results of the batch were sent
+FRAME_CANCEL = b"C"  # broctl -> muxer: kill all commands of a batch
+
+# Result flags.
+FLAG_STDOUT_ZLIB = 1
+FLAG_STDERR_ZLIB = 2
+FLAG_TIMEOUT = 4     # the command was killed because it ran too long
+FLAG_CANCELLED = 8   # the command was killed (or not run) due to a cancel
+
+# Outputs larger than this many bytes are zlib-compressed by the muxer.
+COMPRESS_MIN_SIZE = 4096
+
+# If the combined stdout/stderr of a command is larger than this many bytes,
+# then the muxer writes the complete output to a temp file on the remote
+# host (as it arrives, so that it is never held in memory) and sends only
+# this many bytes.  The file can be retrieved with the FETCH_CMD command as
+# long as the muxer is running, and is removed when the muxer exits.
+SPILL_SIZE = 16 * 1024 * 1024
+
+# Number of seconds to wait for results beyond the command timeout (the
+# muxer kills commands that exceed the timeout) before assuming that the
+# connection is lost.
+COMMAND_GRACE = 5
+
+# Command handled by the muxer itself: outputs the contents of a spill file
+# (without any size limit) and removes the file.
+FETCH_CMD = "__broctl_fetch__"
+
+def get_muxer():
     # The full path of the Python interpreter.  Configured by CMake.
     pythonpath = "@PYTHON_EXECUTABLE@"
 
+    # The muxer is a long-lived agent that is started once per connection.
+    # It then reads any number of command batches from stdin, each tagged
+    # with a request ID.  Batches run concurrently, results are written as
+    # they arrive and each batch is terminated by a "done" frame.  Commands
+    # are queued and started as slots free up if the number of concurrently
+    # running commands is limited (per host and/or per command name).  Each
+    # command runs in its own process group, which is killed if the command
+    # exceeds its deadline, if its batch is cancelled, or if the muxer exits.
+    # Some of the broctl helper scripts are implemented natively by the
+    # muxer (see "natives" below), which avoids forking a shell and several
+    # other processes per command.  The scripts are still used where the
+    # native version is not supported (e.g., there is no /proc).
     muxer = r"""
-import os,sys,subprocess,signal,select,json
-TIMEOUT=120
-
-def w(s):
-	sys.stdout.write(repr(s) + "\n")
-	sys.stdout.flush()
-
-def exec_cmds(cmds):
-	p=[]
-	for i,cmd in enumerate(cmds):
+import os,sys,re,subprocess,select,json,struct,zlib,tempfile,time,signal,shlex,shutil
+FRAME=struct.Struct("!cI")
+RESULT=struct.Struct("!IIiBIIIQII")
+REQID=struct.Struct("!I")
+
+def w(t,payload=b""):
+	data=FRAME.pack(t,len(payload))+payload
+	while data:
+		data=data[os.write(1,data):]
+
+# Send the result of a command.  If the output was written to a spill file
+# already (see read_output), then "size" is the complete output size and
+# "spill" the name of the file.
+def result(batch,i,status,out,err,queued=0,runtime=0,flags=0,limit=None,size=None,spill=b""):
+	if limit is None:
+		limit=batch["spill"]
+	if size is None:
+		size=len(out)+len(err)
+	if size>limit:
+		if not spill:
+			f=new_spill()
+			f.write(out)
+			f.write(err)
+			f.close()
+			spill=enc(f.name)
+		out=out[:limit]
+		err=err[:limit-len(out)]
+	if len(out)>=batch["compress"]:
+		out=zlib.compress(out,1)
+		flags|=1
+	if len(err)>=batch["compress"]:
+		err=zlib.compress(err,1)
+		flags|=2
+	ms=lambda t:min(int(t*1000),0xffffffff)
+	w(b"O",RESULT.pack(batch["id"],i,status,flags,len(out),len(err),len(spill),size,ms(queued),ms(runtime))+out+err+spill)
+	batch["left"]-=1
+	if not batch["left"]:
+		done(batch)
+
+# Returns a new spill file.  Spill files that were not fetched are removed
+# when the muxer exits.
+def new_spill():
+	fd,path=tempfile.mkstemp(prefix="broctl-output-")
+	spills.add(path)
+	f=open(path,"wb")
+	os.close(fd)
+	return f
+
+def done(batch):
+	del batches[batch["id"]]
+	w(b"D",REQID.pack(batch["id"]))
+
+def fetch(batch,i,path):
+	try:
+		f=open(path,"rb")
+		out=f.read()
+		f.close()
+		os.unlink(path)
+		spills.discard(path)
+	except Exception as e:
+		return result(batch,i,1,b"",str(e).encode())
+	result(batch,i,0,out,b"",limit=1<<62)
+
+# Returns the command line of a shell command (which is sent as a string or
+# as a list containing the string).
+def shell_line(cmd):
+	if isinstance(cmd,list):
+		return " ".join(cmd)
+	return cmd
+
+def cmd_type(cmd,shell):
+	if shell:
+		cmd=shell_line(cmd).split()
+	return os.path.basename((cmd or [""])[0])
+
+def read_file(path):
+	f=open(path,"rb")
+	try:
+		return f.read()
+	finally:
+		f.close()
+
+def enc(s):
+	if not isinstance(s,bytes):
+		s=s.encode("utf-8","replace")
+	return s
+
+def h_check_pid(o,args):
+	if not linux:
+		return None
+	try:
+		pid=int(args[0])
+		os.kill(pid,0)
+		cmdline=read_file("/proc/%d/cmdline"%pid)
+	except Exception:
+		cmdline=b""
+	if b"bro" in cmdline:
+		return 0,b"running\n",b""
+	return 0,b"not running\n",b""
+
+def bro_running(pid):
+	try:
+		return b"bro" in read_file("/proc/%d/cmdline"%int(pid))
+	except (ValueError,OSError,IOError):
+		return False
+
+def h_check_pids(o,args):
+	if not linux:
+		return None
+	out=[]
+	for pid in args:
+		if bro_running(pid):
+			out.append("%s running\n"%pid)
+		else:
+			out.append("%s not running\n"%pid)
+	return 0,enc("".join(out)),b""
+
+def h_first_line(o,args):
+	out=[]
+	for fname in args:
+		line=b""
 		try:
-			proc=subprocess.Popen(cmd,stdout=subprocess.PIPE,stderr=subprocess.PIPE __SHELL__)
-			p.append((i,proc))
-		except Exception as e:
-			w((i,(1,'',str(e))))
-	return p
-
-w("ready")
-commands=[]
-signal.alarm(TIMEOUT)
-for line in iter(sys.stdin.readline,"done\n"):
-	commands.append(json.loads(line))
-
-procs=exec_cmds(commands)
-cmd_map={}
-fd_map={}
-fds=set()
-for i,proc in procs:
-	o={"idx":i, "proc":proc, "stdout":[], "stderr":[], "waiting":2}
-	fd_map[proc.stdout]=o["stdout"]
-	fd_map[proc.stderr]=o["stderr"]
-	cmd_map[proc.stdout]=o
-	cmd_map[proc.stderr]=o
-	fds.update((proc.stdout,proc.stderr))
-
-while fds:
-	r,_,_=select.select(fds,[],[])
-	for fd in r:
-		output=os.read(fd.fileno(),1024)
-		if output:
-			fd_map[fd].append(output)
+			if os.path.getsize(fname):
+				f=open(fname,"rb")
+				try:
+					line=f.readline()
+				finally:
+					f.close()
+		except (OSError,IOError):
+			pass
+		out.append(line or b"\n")
+	return 0,b"".join(out),b""
+
+def mount_device(path):
+	best=None
+	for line in read_file("/proc/self/mounts").decode("utf-8","replace").splitlines():
+		fields=line.split()
+		if len(fields)<2:
 			continue
-
-		cmd=cmd_map[fd]
-		fds.remove(fd)
-		cmd["waiting"]-=1
-		if cmd["waiting"]:
+		dev,mnt=[re.sub(r"\\([0-7]{3})",lambda m:chr(int(m.group(1),8)),f) for f in fields[:2]]
+		if path==mnt or path.startswith(mnt.rstrip("/")+"/"):
+			if best is None or len(mnt)>=len(best[1]):
+				best=(dev,mnt)
+	return best and best[0]
+
+# Returns True if the first "name" command found in the PATH is the one
+# installed by the OS (i.e., it was not replaced by a wrapper script).
+def system_cmd(name):
+	for d in os.environ.get("PATH","").split(os.pathsep):
+		path=os.path.join(d,name)
+		if os.path.isfile(path) and os.access(path,os.X_OK):
+			return os.path.dirname(os.path.realpath(path)) in ("/bin","/usr/bin","/sbin","/usr/sbin")
+	return False
+
+def h_df(o,args):
+	if not linux or len(args)!=1 or not system_cmd("df"):
+		return None
+	if not os.path.isdir(args[0]):
+		return 1,enc("not a directory: %s\n"%args[0]),b""
+	st=os.statvfs(args[0])
+	dev=mount_device(os.path.realpath(args[0]))
+	if not dev:
+		return None
+	kb=lambda n:(n*st.f_frsize+1023)//1024*1024
+	return 0,enc("%s %d %d %d \n"%(dev,kb(st.f_blocks),kb(st.f_blocks-st.f_bfree),kb(st.f_bavail))),b""
+
+# Returns a tuple (command, vsize, rss, cpu) with the resource usage of a
+# process, or None if there is no such process.  The CPU usage is averaged
+# over the lifetime of the process.
+def proc_usage(pid,pagesize,hz,uptime):
+	try:
+		stat=read_file("/proc/%s/stat"%pid).decode("utf-8","replace")
+	except (OSError,IOError):
+		return None
+	comm=stat[stat.find("(")+1:stat.rfind(")")].split() or ["?"]
+	f=stat[stat.rfind(")")+2:].split()
+	elapsed=uptime-int(f[19])/hz
+	cpu=0
+	if elapsed>0:
+		cpu=int((int(f[11])+int(f[12]))/hz*100/elapsed)
+	return comm[0],int(f[20]),int(f[21])*pagesize,cpu
+
+def usage_params():
+	return os.sysconf("SC_PAGE_SIZE"),float(os.sysconf("SC_CLK_TCK")),float(read_file("/proc/uptime").split()[0])
+
+def h_top(o,args):
+	if not linux or args or not system_cmd("top"):
+		return None
+	params=usage_params()
+	out=[]
+	for pid in os.listdir("/proc"):
+		if not pid.isdigit():
 			continue
-
-		proc=cmd["proc"]
-		status=proc.wait()
-		out=b"".join(cmd["stdout"])
-		err=b"".join(cmd["stderr"])
-		w((cmd["idx"],(status,out,err)))
-
-w("done")
+		u=proc_usage(pid,*params)
+		if u:
+			out.append("%s %d %d %d %s \n"%(pid,u[1],u[2],u[3],u[0]))
+	return 0,enc("".join(out)),b""
+
+# Same as the "node-status" helper.
+def h_node_status(o,args):
+	if not linux or len(args)%2:
+		return None
+	params=usage_params()
+	out=[]
+	for i in range(0,len(args),2):
+		pid,wd=args[i],args[i+1]
+		status,startup=[(h_first_line(o,[os.path.join(wd,n)])[1].split() or [b"-"])[0] for n in (".status",".startup")]
+		u=None
+		if bro_running(pid):
+			u=proc_usage(int(pid),*params)
+		if u:
+			usage="1 %d %d %d"%u[1:]
+		else:
+			usage="0 - - -"
+		out.append(enc("%s %s "%(int(pid),usage))+status+b" "+startup+b"\n")
+	return 0,b"".join(out),b""
+
+def h_stop(o,args):
+	if len(args)!=2 or not args[1].isdigit():
+		return None
+	try:
+		os.kill(int(args[0]),int(args[1]))
+	except ValueError:
+		return None
+	except OSError as e:
+		return 1,b"",enc("kill: (%s) - %s\n"%(args[0],e.strerror))
+	return 0,b"",b""
+
+# Same as the "start" helper, except that the .pid file is polled more
+# often.  Returns a function that returns the result once Bro is running
+# (see poll_natives).
+def h_start(o,args):
+	origargs=args
+	env=dict(os.environ)
+	while args and args[0]=="-v" and len(args)>1:
+		var=args[1].split("=",1)
+		if len(var)==2:
+			env[var[0]]=var[1]
+		args=args[2:]
+	if args and args[0].startswith("-"):
+		return None
+	if len(args)<3:
+		return 1,b"",enc("start: too few cmd-line options received: \"%s\" (this is usually caused by shell metacharacters in the env_vars broctl option)\n"%" ".join(origargs))
+	wd=args[0]
+	if not os.path.isdir(wd):
+		return 1,b"",enc("start: cd: %s: No such directory\n"%wd)
+	runbro=os.path.join(os.path.dirname(o["helperdir"]),"run-bro")
+	try:
+		for name in (".pid",".test"):
+			if os.path.lexists(os.path.join(wd,name)):
+				os.unlink(os.path.join(wd,name))
+		open(os.path.join(wd,".test"),"w").close()
+		os.unlink(os.path.join(wd,".test"))
+	except (OSError,IOError):
+		return 1,b"",enc("start: problem with Bro working directory (try running broctl as a different user, or check permissions of Bro working dir: %s)\n"%wd)
+	if not os.path.isfile(runbro):
+		return 1,b"",enc("start: file not found: %s\n"%runbro)
+	def detach():
+		os.setsid()
+		signal.signal(signal.SIGHUP,signal.SIG_IGN)
+	files=[open(os.path.join(wd,n),"w") for n in ("stdout.log","stderr.log")]
+	try:
+		o["child"]=subprocess.Popen([runbro]+args[1:],cwd=wd,env=env,stdin=devnull,stdout=files[0],stderr=files[1],close_fds=True,preexec_fn=detach)
+	finally:
+		for f in files:
+			f.close()
+	pidfile=os.path.join(wd,".pid")
+	def poll():
+		try:
+			pid=read_file(pidfile).strip()
+		except (OSError,IOError):
+			return None
+		if not pid:
+			return None
+		if pid==b"-1":
+			return 1,b"",b""
+		return 0,pid+b"\n",b""
+	return poll
+
+# Same as the "wait-status" helper.  Returns a function that returns the
+# result once there is one (see poll_natives).
+def h_wait_status(o,args):
+	if not linux or len(args)!=4:
+		return None
+	status,timeout,cwd,pid=args
+	try:
+		end=time.time()+float(timeout)
+	except ValueError:
+		return None
+	statusfile=os.path.join(cwd,".status")
+	status=enc(status)
+	def poll():
+		# Check the process before the status to avoid a race condition.
+		running=bro_running(pid)
+		if status!=b"-":
+			line=b""
+			try:
+				f=open(statusfile,"rb")
+				try:
+					line=f.readline()
+				finally:
+					f.close()
+			except (OSError,IOError):
+				pass
+			if line:
+				fields=line.split()
+				if len(fields)!=2:
+					return 0,b"invalid\n",b""
+				if status in fields[0]:
+					return 0,b"reached\n",b""
+		if not running:
+			return 0,b"dead\n",b""
+		if time.time()>=end:
+			return 0,b"timeout\n",b""
+		return None
+	return poll
+
+# Same as the "start-node" helper: creates the working directory, starts
+# Bro and waits until it is up.  Returns a function that returns the result
+# once there is one (see poll_natives).
+def h_start_node(o,args):
+	i=0
+	while args[i:i+1]==["-v"] or args[i:i+1]==[b"-v"]:
+		i+=2
+	if not linux or len(args)<i+2:
+		return None
+	try:
+		timeout=float(args[i])
+	except ValueError:
+		return None
+	wd=args[i+1]
+	try:
+		os.makedirs(wd)
+	except OSError:
+		if not os.path.isdir(wd):
+			return 0,b"nodir\n",b""
+	start=h_start(o,args[:i]+args[i+1:])
+	if not callable(start):
+		return start
+	st={}
+	def poll():
+		if "pid" not in st:
+			res=start()
+			if res is None:
+				return None
+			if res[0] or not res[1].strip().isdigit():
+				return res
+			st["pid"]=res[1].strip()
+			st["wait"]=h_wait_status(o,["RUNNING",str(timeout),wd,st["pid"]])
+		res=st["wait"]()
+		if res is None:
+			return None
+		if res[1]==b"reached\n":
+			state=b"running"
+		else:
+			res=h_wait_status(o,["TERMINATED","0",wd,st["pid"]])()
+			state=b"terminated" if res[1] in (b"reached\n",b"dead\n") else b"initializing"
+		return 0,st["pid"]+b"\n"+state+b"\n",b""
+	return poll
+
+# Same as the "stop-node" helper.  Returns a function that returns the
+# result once there is one (see poll_natives).
+def h_stop_node(o,args):
+	if not linux or len(args)!=4 or not args[0].isdigit():
+		return None
+	pid,nodetype,wd,timeout=args
+	try:
+		float(timeout)
+	except ValueError:
+		return None
+	try:
+		os.kill(int(pid),signal.SIGTERM)
+	except OSError as e:
+		return 1,b"",enc("kill: (%s) - %s\n"%(pid,e.strerror))
+	st={"wait":h_wait_status(o,["TERMINATED",timeout,wd,pid])}
+	def poll():
+		if "how" not in st:
+			res=st["wait"]()
+			if res is None:
+				return None
+			if res[1]==b"reached\n":
+				st["how"]=b"terminated"
+				st["wait"]=h_wait_status(o,["-","10",wd,pid])
+			elif res[1]==b"dead\n" or not bro_running(pid):
+				return 0,b"crashed\nstopped\n",b""
+			else:
+				try:
+					os.kill(int(pid),signal.SIGKILL)
+				except OSError:
+					pass
+				st["how"]=b"killed"
+				st["wait"]=h_wait_status(o,["-","15",wd,pid])
+		if "post" not in st:
+			res=st["wait"]()
+			if res is None:
+				return None
+			if res[1]!=b"dead\n":
+				return 0,st["how"]+b"\nrunning\n",b""
+			st["out"]=tempfile.TemporaryFile()
+			cmd=[os.path.join(os.path.dirname(o["helperdir"]),"post-terminate"),nodetype,wd]
+			if st["how"]==b"killed":
+				cmd.append("killed")
+			st["post"]=o["post"]=subprocess.Popen(cmd,stdin=devnull,stdout=st["out"],stderr=subprocess.STDOUT,close_fds=True,preexec_fn=os.setsid)
+		rc=st["post"].poll()
+		if rc is None:
+			return None
+		st["out"].seek(0)
+		out=st["out"].read()
+		st["out"].close()
+		return 0,st["how"]+b"\nstopped\n"+enc(str(rc))+b"\n"+out,b""
+	return poll
+
+natives={"check-pid":h_check_pid,"check-pids":h_check_pids,"first-line":h_first_line,"df":h_df,"top":h_top,"stop":h_stop,"start":h_start,"wait-status":h_wait_status,"start-node":h_start_node,"stop-node":h_stop_node,"node-status":h_node_status}
+
+# Returns the native implementation and the arguments if "cmd" runs one of
+# the broctl helper scripts, or None otherwise.
+def native_helper(cmd,shell):
+	if shell:
+		cmd=shell_line(cmd)
+	if bytes is str:
+		cmd=enc(cmd) if shell else [enc(c) for c in cmd]
+	if shell:
+		if [c for c in cmd if c in "$`\\;|&<>(){}[]*?~#\n"]:
+			return None
+		try:
+			cmd=shlex.split(cmd)
+		except ValueError:
+			return None
+	if not cmd:
+		return None
+	f=natives.get(os.path.basename(cmd[0]))
+	d=os.path.dirname(cmd[0])
+	if not f or os.path.basename(d)!="helpers" or not os.path.isfile(cmd[0]) or not os.path.isfile(os.path.join(os.path.dirname(d),"broctl-config.sh")):
+		return None
+	return f,cmd[1:],d
+
+def start_batch(batch):
+	batch["left"]=len(batch["cmds"])
+	batches[batch["id"]]=batch
+	if not batch["left"]:
+		return done(batch)
+	for i,cmd in enumerate(batch["cmds"]):
+		if not batch["shell"] and cmd[0]==batch["fetch"]:
+			fetch(batch,i,cmd[1])
+			continue
+		queue.append({"idx":i,"cmd":cmd,"type":cmd_type(cmd,batch["shell"]),"batch":batch,"queued":time.time()})
+
+def cancel(reqid):
+	for o in [o for o in queue if o["batch"]["id"]==reqid]:
+		queue.remove(o)
+		result(o["batch"],o["idx"],1,b"",b"",time.time()-o["queued"],0,8)
+	for o in [o for o in running if o["batch"]["id"]==reqid]:
+		kill(o,8)
+
+# The limits of a batch apply to its own commands, but all commands running
+# on the host count against them.
+def schedule():
+	for o in list(queue):
+		batch=o["batch"]
+		if batch["limit"] and len(running)>=batch["limit"]:
+			continue
+		n=batch["limits"].get(o["type"])
+		if n and len([r for r in running if r["type"]==o["type"]])>=n:
+			continue
+		queue.remove(o)
+		spawn(o)
+
+def spawn(o):
+	batch=o["batch"]
+	o["started"]=time.time()
+	o["deadline"]=o["started"]+batch["timeout"]
+	native=native_helper(o["cmd"],batch["shell"])
+	if native:
+		f,args,o["helperdir"]=native
+		try:
+			res=f(o,args)
+		except Exception:
+			res=None
+		if callable(res):
+			o.update(proc=None,poll=res,files=(),interval=0,next=o["started"])
+			running.append(o)
+			return
+		if res:
+			result(batch,o["idx"],res[0],res[1],res[2],o["started"]-o["queued"],time.time()-o["started"])
+			return
+	try:
+		proc=subprocess.Popen(o["cmd"],stdin=devnull,stdout=subprocess.PIPE,stderr=subprocess.PIPE,shell=batch["shell"],preexec_fn=os.setsid)
+	except Exception as e:
+		result(batch,o["idx"],1,b"",str(e).encode(),o["started"]-o["queued"])
+		return
+	o.update(proc=proc,files=(proc.stdout,proc.stderr),out={},kept={},size=0,spill=None,waiting=2)
+	for f in o["files"]:
+		o["out"][f.fileno()]=[]
+		o["kept"][f.fileno()]=0
+		cmd_map[f.fileno()]=o
+	running.append(o)
+
+# Only the first "spill" bytes of each output stream are kept in memory.
+# Once the output of a command gets larger than that, all of it goes to a
+# spill file as it arrives: stdout directly, and stderr to a temp file that
+# is appended to the spill file when the command has finished.
+def read_output(fd):
+	o=cmd_map[fd]
+	output=os.read(fd,65536)
+	if output:
+		limit=o["batch"]["spill"]
+		o["size"]+=len(output)
+		if not o["spill"] and o["size"]>limit:
+			start_spill(o)
+		if o["spill"]:
+			o["spill"][fd].write(output)
+		if o["kept"][fd]<limit:
+			output=output[:limit-o["kept"][fd]]
+			o["out"][fd].append(output)
+			o["kept"][fd]+=len(output)
+		return
+	del cmd_map[fd]
+	o["waiting"]-=1
+	if not o["waiting"]:
+		finish(o)
+
+def start_spill(o):
+	outfd,errfd=[f.fileno() for f in o["files"]]
+	o["spill"]={outfd:new_spill(),errfd:tempfile.TemporaryFile()}
+	for fd,chunks in o["out"].items():
+		for data in chunks:
+			o["spill"][fd].write(data)
+
+def finish(o,flags=0,res=None):
+	size=None
+	spill=b""
+	if o["proc"]:
+		fds=[f.fileno() for f in o["files"]]
+		for fd in fds:
+			cmd_map.pop(fd,None)
+		out,err=[b"".join(o["out"][fd]) for fd in fds]
+		for f in o["files"]:
+			f.close()
+		res=(o["proc"].wait(),out,err)
+		size=o["size"]
+		if o["spill"]:
+			outf,errf=[o["spill"][fd] for fd in fds]
+			errf.seek(0)
+			shutil.copyfileobj(errf,outf)
+			errf.close()
+			outf.close()
+			spill=enc(outf.name)
+	elif res is None:
+		res=(1,b"",b"")
+	for p in (o.get("child"),o.get("post")):
+		if p:
+			children.append(p)
+	running.remove(o)
+	result(o["batch"],o["idx"],res[0],res[1],res[2],o["started"]-o["queued"],time.time()-o["started"],flags,size=size,spill=spill)
+
+# Kill the process group of the command.  The processes that a native helper
+# starts (Bro itself, post-terminate) are detached and must outlive it, so they
+# are left alone and only reaped later.
+def killpg(o):
+	if o["proc"]:
+		try:
+			os.killpg(o["proc"].pid,signal.SIGKILL)
+		except OSError:
+			pass
+
+def kill(o,flags):
+	killpg(o)
+	finish(o,flags)
+
+# Check on the native helpers that wait for something to happen, and reap
+# the processes that they have started in the background.  The interval
+# between checks starts small and grows while nothing happens, so that a
+# change is seen quickly without spinning during long waits.
+def poll_natives():
+	now=time.time()
+	for o in [o for o in running if o.get("poll") and o["next"]<=now]:
+		res=o["poll"]()
+		if res:
+			finish(o,0,res)
+			continue
+		o["interval"]=min(max(o["interval"]*2,0.01),0.1)
+		o["next"]=time.time()+o["interval"]
+	for p in list(children):
+		if p.poll() is not None:
+			children.remove(p)
+
+def kill_expired():
+	now=time.time()
+	for o in [o for o in running if o["deadline"]<=now]:
+		kill(o,4)
+
+def main():
+	inbuf=b""
+	w(b"R")
+	while True:
+		poll_natives()
+		kill_expired()
+		schedule()
+		# Wake up at the next deadline or native helper check.
+		timeout=None
+		wakeups=[o["deadline"] for o in running]+[o["next"] for o in running if o.get("poll")]
+		if wakeups:
+			timeout=max(min(wakeups)-time.time(),0)
+		rd,_,_=select.select([0]+list(cmd_map),[],[],timeout)
+		for fd in rd:
+			if fd:
+				if fd in cmd_map:
+					read_output(fd)
+				continue
+			data=os.read(0,65536)
+			if not data:
+				return
+			inbuf+=data
+			while len(inbuf)>=FRAME.size:
+				t,n=FRAME.unpack_from(inbuf)
+				if len(inbuf)<FRAME.size+n:
+					break
+				payload=inbuf[FRAME.size:FRAME.size+n]
+				inbuf=inbuf[FRAME.size+n:]
+				if t==b"C":
+					cancel(REQID.unpack(payload)[0])
+				else:
+					start_batch(json.loads(payload.decode()))
+
+devnull=open(os.devnull,"r")
+batches={}
+cmd_map={}
+queue=[]
+running=[]
+children=[]
+spills=set()
+linux=sys.platform.startswith("linux") and os.path.isdir("/proc/self")
+signal.signal(signal.SIGTERM,lambda *args:sys.exit(0))
+signal.signal(signal.SIGHUP,lambda *args:sys.exit(0))
+try:
+	main()
+finally:
+	for o in running:
+		killpg(o)
+	for path in spills:
+		try:
+			os.unlink(path)
+		except OSError:
+			pass
 """
 
-    if shell:
-        muxer = muxer.replace("__SHELL__", ",shell=True")
-    else:
-        muxer = muxer.replace("__SHELL__", "")
-
     if py3bro.using_py3:
         muxer = muxer.encode()
 
@@ -92,7 +734,7 @@ w("done")
         muxer = muxer.decode()
 
     # Note: the "b" string prefix here for Py3 is ignored by Py2.6-2.7
-    muxer = "%s -c 'import zlib,base64; exec(zlib.decompress(base64.b64decode(b\"%s\")))'\n" % (pythonpath, muxer)
+    muxer = "exec %s -c 'import zlib,base64; exec(zlib.decompress(base64.b64decode(b\"%s\")))'\n" % (pythonpath, muxer)
 
     if py3bro.using_py3:
         muxer = muxer.encode()
@@ -100,42 +742,133 @@ w("done")
     return muxer
 
 
-CmdResult = collections.namedtuple("CmdResult", "status stdout stderr")
+# The result of one command.  If the output was too large, then "spilled" is
+# the name of the file on the remote host that contains the complete output,
+# and "size" is the complete output size.  Otherwise, "spilled" is None.
+# "queued" and "runtime" are the number of seconds that the command waited
+# for a free slot on the host and ran, respectively.  "killed" is "timeout"
+# or "cancelled" if the muxer killed the command, or None otherwise.
+CmdResult = collections.namedtuple("CmdResult", "status stdout stderr spilled size queued runtime killed")
+
+# Returns a frame that sends a batch of commands to the muxer (see
+# SSHMaster.send_commands for the arguments).
+def batch_frame(cmds, timeout, shell, reqid, maxprocs=0, cmdlimits=None):
+    batch = {"id": reqid, "shell": shell, "cmds": cmds,
+             "timeout": timeout, "compress": COMPRESS_MIN_SIZE,
+             "spill": SPILL_SIZE, "fetch": FETCH_CMD, "limit": maxprocs,
+             "limits": cmdlimits or {}}
+    payload = json.dumps(batch)
+    if py3bro.using_py3:
+        payload = payload.encode()
+
+    return FRAME.pack(FRAME_BATCH, len(payload)) + payload
+
+# Returns a frame that cancels the batch "reqid".
+def cancel_frame(reqid):
+    return FRAME.pack(FRAME_CANCEL, REQID.size) + REQID.pack(reqid)
+
+# Decode the payload of a result frame.  Returns a (reqid, idx, CmdResult)
+# tuple.
+def decode_result(payload):
+    reqid, idx, status, flags, outlen, errlen, spilllen, size, queued, runtime = RESULT.unpack_from(payload)
+    pos = RESULT.size
+    out = payload[pos:pos + outlen]
+    pos += outlen
+    err = payload[pos:pos + errlen]
+    pos += errlen
+    spilled = payload[pos:pos + spilllen]
+
+    if flags & FLAG_STDOUT_ZLIB:
+        out = zlib.decompress(out)
+    if flags & FLAG_STDERR_ZLIB:
+        err = zlib.decompress(err)
+
+    if py3bro.using_py3:
+        out = out.decode(errors="replace")
+        err = err.decode(errors="replace")
+        spilled = spilled.decode(errors="replace")
+
+    killed = None
+    if flags & FLAG_TIMEOUT:
+        killed = "timeout"
+    elif flags & FLAG_CANCELLED:
+        killed = "cancelled"
+
+    return reqid, idx, CmdResult(status, out, err, spilled or None, size, queued / 1000.0, runtime / 1000.0, killed)
+
+# Returns the command that starts a shell on "host", in which the muxer is
+# then started.  Never uses ssh for the local host.
+def shell_cmd(host, localaddrs):
+    if host in localaddrs:
+        return ["sh"]
+
+    # The BatchMode=yes disables interactive prompting.  The LogLevel=error
+    # prevents seeing login banners but allows error messages from ssh.
+    return [
+        "ssh",
+        "-o", "BatchMode=yes",
+        "-o", "LogLevel=error",
+        host,
+        "sh",
+    ]
 
 class SSHMaster:
     def __init__(self, host, localaddrs):
-        # The BatchMode=yes disables interactive prompting.  The LogLevel=error
-        # prevents seeing login banners but allows error messages from ssh.
-        self.base_cmd = [
-            "ssh",
-            "-o", "BatchMode=yes",
-            "-o", "LogLevel=error",
-            host,
-        ]
         self.host = host
         self.need_connect = True
         self.master = None
         self.localaddrs = localaddrs
-        self.run_mux = get_muxer(False)
-        self.run_mux_shell = get_muxer(True)
+        self.run_mux = get_muxer()
 
-    def connect(self):
+    # Start ssh (or a local shell) and bootstrap the muxer.  This is done
+    # only once per connection, all subsequent command batches are sent to
+    # the already running muxer.
+    def connect(self, timeout=60):
         if self.need_connect:
-            if self.host in self.localaddrs:
-                cmd = ["sh"]
-            else:
-                cmd = self.base_cmd + ["sh"]
+            cmd = shell_cmd(self.host, self.localaddrs)
             self.master = subprocess.Popen(cmd, bufsize=0, stdout=subprocess.PIPE, stdin=subprocess.PIPE, close_fds=True, preexec_fn=os.setsid)
             self.need_connect = False
 
-    def readline_with_timeout(self, timeout):
-        readable, _, _ = select.select([self.master.stdout], [], [], timeout)
-        if not readable:
+            self.master.stdin.write(self.run_mux)
+            self.master.stdin.flush()
+
+            # Wait until we receive the "ready" message from muxer script
+            try:
+                frame = self.read_frame(timeout)
+            except EOFError:
+                frame = None
+
+            if not frame or frame[0] != FRAME_READY:
+                self.close()
+                raise Exception("Failed to start command muxer on host %s" % self.host)
+
+    # Read exactly n bytes from the muxer.  Returns None if nothing arrives
+    # before the deadline, and raises EOFError if the muxer has gone away.
+    def _read_exact(self, n, deadline):
+        fd = self.master.stdout.fileno()
+        buf = []
+        while n:
+            readable, _, _ = select.select([fd], [], [], max(deadline - time.time(), 0))
+            if not readable:
+                return None
+            data = os.read(fd, min(n, 65536))
+            if not data:
+                raise EOFError
+            buf.append(data)
+            n -= len(data)
+        return b"".join(buf)
+
+    # Returns a (type, payload) tuple, or None upon timeout.
+    def read_frame(self, timeout):
+        deadline = time.time() + timeout
+        hdr = self._read_exact(FRAME.size, deadline)
+        if hdr is None:
+            return None
+        ftype, length = FRAME.unpack(hdr)
+        payload = self._read_exact(length, deadline)
+        if payload is None:
             return None
-        jtxt = self.master.stdout.readline()
-        if py3bro.using_py3:
-            jtxt = jtxt.decode()
-        return jtxt
+        return ftype, payload
 
     def exec_command(self, cmd, shell=False, timeout=60):
         return self.exec_commands([cmd], shell, timeout)[0]
@@ -144,53 +877,94 @@ class SSHMaster:
         self.send_commands(cmds, timeout, shell)
         return self.collect_results(timeout)
 
-    def send_commands(self, cmds, timeout, shell=False):
-        self.connect()
-        if shell:
-            self.master.stdin.write(self.run_mux_shell)
-        else:
-            self.master.stdin.write(self.run_mux)
+    # Send a batch of commands to the muxer.  The "reqid" tags all results
+    # of the batch, so that several batches can be in flight at once.
+    # "maxprocs" limits the number of commands running concurrently on the
+    # host (zero means no limit), and "cmdlimits" is a dict that does the
+    # same for individual command names.  Each command that runs longer than
+    # "timeout" seconds is killed by the muxer.
+    def send_commands(self, cmds, timeout, shell=False, reqid=0, maxprocs=0, cmdlimits=None):
+        self.connect(timeout)
+
+        # Send the whole batch with a single write.
+        self.master.stdin.write(batch_frame(cmds, timeout, shell, reqid, maxprocs, cmdlimits))
         self.master.stdin.flush()
+        self.sent_commands = len(cmds)
 
-        # Wait until we receive the "ready" message from muxer script
-        self.readline_with_timeout(timeout)
-
-        for cmd in cmds:
-            jcmd = "%s\n" % json.dumps(cmd)
-            if py3bro.using_py3:
-                jcmd = jcmd.encode()
-            self.master.stdin.write(jcmd)
-        # Note: the "b" string prefix here for Py3 is ignored by Py2.6-2.7
-        self.master.stdin.write(b"done\n")
+    # Kill all commands of the batch "reqid" on the host.  The results of
+    # the batch are still delivered as usual.
+    def cancel(self, reqid):
+        self.master.stdin.write(cancel_frame(reqid))
         self.master.stdin.flush()
-        self.sent_commands = len(cmds)
 
-    def collect_results(self, timeout):
-        outputs = [Exception("Command timeout on host %s" % self.host)] * self.sent_commands
+    # Read the next message from the muxer.  Returns a (reqid, idx, result)
+    # tuple, where idx and result are None if the batch "reqid" is done, or
+    # None upon timeout.  Raises EOFError if the muxer has gone away.
+    def recv(self, timeout):
+        frame = self.read_frame(timeout)
+        if frame is None:
+            return None
+        ftype, payload = frame
+        if ftype == FRAME_DONE:
+            return REQID.unpack(payload)[0], None, None
+        return decode_result(payload)
+
+    def fileno(self):
+        return self.master.stdout.fileno()
+
+    # Yields (idx, result) tuples in the order in which the commands of the
+    # batch "reqid" finish.  Results of other batches are dropped.  If the
+    # results stop arriving (timeout or loss of connection), then an
+    # Exception is yielded for each command that is still outstanding.
+    def iter_results(self, timeout, reqid=0):
+        pending = set(range(self.sent_commands))
+        failure = None
 
         while True:
-            line = self.readline_with_timeout(timeout)
-            if not line:
+            try:
+                msg = self.recv(timeout + COMMAND_GRACE)
+            except EOFError:
+                # The muxer (or ssh) went away before finishing the batch.
+                logging.debug("Lost connection to host %s", self.host)
+                failure = Exception("Lost connection to host %s" % self.host)
+                self.close()
+                break
+            if msg is None:
                 logging.debug("Command timeout on host %s", self.host)
+                failure = Exception("Command timeout on host %s" % self.host)
                 self.close()
                 break
-            resp = ast.literal_eval(line)
-            if resp == "done":
+
+            rid, idx, result = msg
+            if rid != reqid:
+                continue
+            if idx is None:
+                failure = Exception("No result received from host %s" % self.host)
                 break
-            idx, result = resp
-            status, out, err = result
 
-            if py3bro.using_py3:
-                out = out.decode(errors="replace")
-                err = err.decode(errors="replace")
+            pending.discard(idx)
+            yield idx, result
 
-            outputs[idx] = CmdResult(status, out, err)
+        for idx in sorted(pending):
+            yield idx, failure
+
+    def collect_results(self, timeout, reqid=0):
+        outputs = [None] * self.sent_commands
+        for idx, result in self.iter_results(timeout, reqid):
+            outputs[idx] = result
         return outputs
 
     def close(self):
         if not self.master:
             return
         self.master.stdin.close()
+
+        # Closing stdin makes the muxer kill any commands that are still
+        # running before it exits, so give it a moment to do so.
+        deadline = time.time() + 1
+        while self.master.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+
         try:
             self.master.kill()
         except OSError:
@@ -203,6 +977,9 @@ class SSHMaster:
 
 STOP_RUNNING = object()
 
+# Seconds to wait for the muxer to come up (or answer a heartbeat ping).
+CONNECT_TIMEOUT = 10
+
 class HostHandler(Thread):
     def __init__(self, host, localaddrs, timeout):
         self.host = host
@@ -211,35 +988,79 @@ class HostHandler(Thread):
         self.q = Queue()
         self.alive = False
         self.master = None
+
+        # Batches that were sent to the muxer but are not done yet, indexed
+        # by request ID.  Each value is a (rq, pending, timeout) tuple.
+        self.requests = {}
+
+        # Time when something was last received from the muxer.
+        self.last_recv = 0
+
+        # The thread waits for both the muxer and new requests, so anyone
+        # putting something on the queue writes a byte to this pipe.
+        self.wakeup_r, self.wakeup_w = os.pipe()
         Thread.__init__(self)
 
+    def _wakeup(self):
+        try:
+            os.write(self.wakeup_w, b"x")
+        except OSError:
+            # The thread has already terminated.
+            pass
+
     def shutdown(self):
-        self.q.put((STOP_RUNNING, None, None))
+        self.q.put((STOP_RUNNING, ()))
+        self._wakeup()
 
     def connect(self):
         if self.master:
             self.master.close()
         self.master = SSHMaster(self.host, self.localaddrs)
 
-    def ping(self):
+    def _connection_error_msg(self):
         # Error message should indicate whether or not ssh is being used.
         msgstr = "" if self.host in self.localaddrs else "ssh "
 
         # Error message shows if a connection was previously established.
         if self.alive:
-            msg = "Lost %sconnection to host %s" % (msgstr, self.host)
+            return "Lost %sconnection to host %s" % (msgstr, self.host)
         else:
-            msg = "Failed to establish %sconnection to host %s" % (msgstr, self.host)
+            return "Failed to establish %sconnection to host %s" % (msgstr, self.host)
 
-        # This will be set to True below only if the "ping" is received.
+    # Make sure there is a running muxer on the host.  The muxer sends a
+    # "ready" message once it has started, so a successful connect already
+    # proves that the host is reachable and no separate ping is needed.
+    def ensure_connected(self):
+        if self.alive and not self.master.need_connect:
+            return ""
+
+        msg = self._connection_error_msg()
         self.alive = False
+        self.connect()
 
         try:
-            resp = self.master.exec_command(["/bin/echo", "ping"], timeout=10)
+            self.master.connect(CONNECT_TIMEOUT)
         except Exception as e:
             # This happens most likely due to broken pipe (i.e., ssh
             # terminates, usually because it couldn't connect, or its own
-            # timeout occurred).
+            # timeout occurred), or a timeout waiting for the muxer.
+            return "%s: %s" % (msg, e)
+
+        self.alive = True
+        self.last_recv = time.time()
+        return ""
+
+    # Send an explicit "ping" through the muxer.  This is only used as a
+    # heartbeat while the host is idle.
+    def ping(self):
+        msg = self._connection_error_msg()
+
+        # This will be set to True below only if the "ping" is received.
+        self.alive = False
+
+        try:
+            resp = self.master.exec_command(["/bin/echo", "ping"], timeout=CONNECT_TIMEOUT)
+        except Exception as e:
             return "%s: %s" % (msg, e)
 
         try:
@@ -258,98 +1079,304 @@ class HostHandler(Thread):
         return "Communication failure with host %s when checking connection" % self.host
 
     def connect_and_ping(self):
+        msg = self.ensure_connected()
         if not self.alive:
-            self.connect()
+            return msg
         return self.ping()
 
     def run(self):
-        while True:
-            if self.iteration():
-                return
+        try:
+            while True:
+                if self.iteration():
+                    return
+        finally:
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
 
     def iteration(self):
-        try:
-            item, shell, rq = self.q.get(timeout=30)
-        except Empty:
+        fds = [self.wakeup_r]
+        if self.requests:
+            fds.append(self.master.fileno())
+            timeout = max(self._deadline() - time.time(), 0)
+        else:
+            timeout = 30
+
+        readable, _, _ = select.select(fds, [], [], timeout)
+
+        if not readable and not self.requests:
             self.connect_and_ping()
             return False
 
-        if item is STOP_RUNNING:
-            return True
+        if self.wakeup_r in readable:
+            os.read(self.wakeup_r, 4096)
+            while True:
+                try:
+                    op, args = self.q.get_nowait()
+                except Empty:
+                    break
+
+                if op is STOP_RUNNING:
+                    self._fail_requests("Connection to host %s was shut down" % self.host)
+                    if self.master:
+                        self.master.close()
+                    return True
+
+                op(*args)
+
+        if self.requests and self.master.fileno() in readable:
+            self._receive()
+
+        self._check_timeouts()
+        return False
+
+    # Finish request "reqid" by putting an Exception on its queue for each
+    # command that has no result yet.
+    def _fail_request(self, reqid, msg):
+        rq, pending, _ = self.requests.pop(reqid)
+        for idx in sorted(pending):
+            rq.put((reqid, idx, Exception(msg)))
+        rq.put((reqid, None, None))
+
+    def _fail_requests(self, msg):
+        for reqid in list(self.requests):
+            self._fail_request(reqid, msg)
+
+    def _connection_lost(self, msg):
+        logging.debug(msg)
+        self.alive = False
+        self.master.close()
+        self._fail_requests(msg)
 
-        msg = self.connect_and_ping()
+    def _send(self, reqid, commands, shell, timeout, limits, rq):
+        msg = self.ensure_connected()
         if not self.alive:
             logging.debug(msg)
-            resp = [Exception(msg)] * len(item)
-            rq.put(resp)
-            return False
+            for idx in range(len(commands)):
+                rq.put((reqid, idx, Exception(msg)))
+            rq.put((reqid, None, None))
+            return
+
+        if not self.requests:
+            # Start watching the connection for silence from now on.
+            self.last_recv = time.time()
+
+        self.requests[reqid] = (rq, set(range(len(commands))), timeout)
 
         try:
-            resp = self.master.exec_commands(item, shell, self.timeout)
+            self.master.send_commands(commands, timeout, shell, reqid, *limits)
         except Exception as e:
-            self.alive = False
+            # Writing to the muxer failed, so the connection is gone.
             msgstr = "" if self.host in self.localaddrs else "ssh "
-            msg = "Lost %sconnection while running command on host %s: %s" % (msgstr, self.host, e)
-            logging.debug(msg)
-            resp = [Exception(msg)] * len(item)
-            time.sleep(2)
-        rq.put(resp)
+            self._connection_lost("Lost %sconnection while running command on host %s: %s" % (msgstr, self.host, e))
 
-        return False
+    def _cancel(self, reqid):
+        if reqid not in self.requests:
+            return
+
+        try:
+            self.master.cancel(reqid)
+        except Exception as e:
+            self._connection_lost("Lost connection to host %s: %s" % (self.host, e))
+
+    # Pass on one message from the muxer to the request it belongs to.
+    def _receive(self):
+        try:
+            msg = self.master.recv(self.timeout)
+        except EOFError:
+            msg = None
+
+        if msg is None:
+            # The muxer (or ssh) went away, or stopped in mid-frame.
+            self._connection_lost("Lost connection to host %s" % self.host)
+            return
+
+        self.last_recv = time.time()
+        reqid, idx, res = msg
+        req = self.requests.get(reqid)
+        if not req:
+            # The request has already timed out.
+            return
 
-    def send_commands(self, commands, shell, rq):
-        self.q.put((commands, shell, rq))
+        if idx is None:
+            self._fail_request(reqid, "No result received from host %s" % self.host)
+            return
+
+        rq, pending, _ = req
+        pending.discard(idx)
+        rq.put((reqid, idx, res))
+
+    # The muxer kills commands that exceed their timeout, so while commands
+    # are outstanding, some result must arrive within the longest timeout.
+    # Returns the time by which that has to happen.
+    def _deadline(self):
+        timeout = max([req[2] for req in self.requests.values()])
+        return self.last_recv + timeout + COMMAND_GRACE
+
+    # If the muxer has been silent for too long, then assume that the
+    # connection is gone.
+    def _check_timeouts(self):
+        if self.requests and self._deadline() <= time.time():
+            self._connection_lost("Command timeout on host %s" % self.host)
+
+    # Queue a batch of commands.  The results are put on the queue "rq" as
+    # (reqid, idx, result) tuples, followed by (reqid, None, None) once all
+    # results of the batch have been delivered.  "limits" is a (maxprocs,
+    # cmdlimits) tuple as expected by SSHMaster.send_commands.
+    def send_commands(self, reqid, commands, shell, timeout, limits, rq):
+        self.q.put((self._send, (reqid, commands, shell, timeout, limits, rq)))
+        self._wakeup()
+
+    # Kill all commands of the batch "reqid" that are still running.
+    def cancel(self, reqid):
+        self.q.put((self._cancel, (reqid,)))
+        self._wakeup()
 
 
 class MultiMasterManager:
     def __init__(self, localaddrs=[]):
         self.masters = {}
-        self.response_queues = {}
         self.localaddrs = localaddrs
 
-    def setup(self, host, timeout):
-        if host not in self.masters:
-            self.masters[host] = HostHandler(host, self.localaddrs, timeout)
-            self.masters[host].start()
+        # Commands may be sent from several threads (e.g., by the start
+        # scheduler or the connection broker), so the creation of host
+        # handlers must be serialized.
+        self.setuplock = Lock()
+
+        # Outstanding requests, indexed by request ID.  Each value is a
+        # (host, rq, number of commands) tuple.
+        self.requests = {}
+        self.reqids = itertools.count(1)
+
+        # Limits on the number of concurrently running commands per host.
+        self.maxprocs = 0
+        self.cmdlimits = {}
+
+    # Limit the number of commands that run concurrently on each host to
+    # "maxprocs" (zero means no limit).  "cmdlimits" is a dict that maps a
+    # command name (i.e., the basename of the program) to the maximum
+    # number of instances of that command running concurrently on a host.
+    # Commands exceeding a limit are queued on the host.
+    def set_limits(self, maxprocs, cmdlimits):
+        self.maxprocs = maxprocs
+        self.cmdlimits = cmdlimits
 
-    def send_commands(self, host, commands, timeout, shell=False):
+    def setup(self, host, timeout):
+        with self.setuplock:
+            if host not in self.masters:
+                self.masters[host] = HostHandler(host, self.localaddrs, timeout)
+                self.masters[host].start()
+
+    # Send a batch of commands to a host.  Returns the request ID that
+    # identifies the batch.  Any number of batches can be outstanding for
+    # the same host.  "limits" is a (maxprocs, cmdlimits) tuple (see
+    # set_limits) that overrides the limits of this manager for the batch.
+    def send_commands(self, host, commands, timeout, shell=False, rq=None, limits=None):
         self.setup(host, timeout)
-        rq = Queue()
-        self.response_queues[host] = rq
-        self.masters[host].send_commands(commands, shell, rq)
+        if rq is None:
+            rq = Queue()
+        if limits is None:
+            limits = (self.maxprocs, self.cmdlimits)
+        reqid = next(self.reqids)
+        self.requests[reqid] = (host, rq, len(commands))
+        self.masters[host].send_commands(reqid, commands, shell, timeout, limits, rq)
+        return reqid
+
+    # Read responses from "rq" until all requests in "reqids" are done.
+    # Yields (reqid, idx, result) tuples in the order in which the results
+    # arrive.  If the caller stops early (e.g., due to a KeyboardInterrupt),
+    # then the commands that are still running are cancelled.
+    def _iter_responses(self, rq, reqids, hosttimeout):
+        outstanding = {}
+        for reqid in reqids:
+            outstanding[reqid] = set(range(self.requests[reqid][2]))
 
-    def get_result(self, host, hosttimeout):
-        # Add a few seconds to the host timeout in order to let the
-        # command timeout happen first.
-        hosttimeout += 5
-
-        rq = self.response_queues[host]
         try:
-            return rq.get(timeout=hosttimeout)
-        except Empty:
-            self.shutdown(host)
-            # This can happen due to commands that take a while to run, a
-            # loss of connectivity to remote host, or both.
-            return [Exception("Timeout waiting for commands to finish on host %s" % host)] #FIXME: needs to be the right length
+            while outstanding:
+                # The host handlers notice a stalled connection on their own
+                # and the muxer enforces the command timeout, so this is only
+                # a last resort if a host handler got stuck.
+                try:
+                    reqid, idx, res = rq.get(timeout=hosttimeout + COMMAND_GRACE + 5)
+                except Empty:
+                    for reqid, idxs in outstanding.items():
+                        host = self.requests[reqid][0]
+                        if host in self.masters:
+                            self.shutdown(host)
+                        for idx in sorted(idxs):
+                            yield reqid, idx, Exception("Timeout waiting for commands to finish on host %s" % host)
+                    outstanding = {}
+                    return
+
+                if reqid is STOP_RUNNING:
+                    # The caller is no longer interested in the results.
+                    return
+
+                if reqid not in outstanding:
+                    continue
+
+                if idx is None:
+                    del outstanding[reqid]
+                    continue
+
+                outstanding[reqid].discard(idx)
+                yield reqid, idx, res
+        finally:
+            for reqid in outstanding:
+                host = self.requests[reqid][0]
+                if host in self.masters:
+                    self.masters[host].cancel(reqid)
+
+            for reqid in reqids:
+                self.requests.pop(reqid, None)
+
+    # Wait for the results of the batch "reqid".  Returns a list with one
+    # result per command; commands that did not finish in time have an
+    # Exception as their result.
+    def get_result(self, reqid, hosttimeout):
+        _, rq, count = self.requests[reqid]
+        results = [None] * count
+        for _, idx, res in self._iter_responses(rq, [reqid], hosttimeout):
+            results[idx] = res
+        return results
 
     def exec_command(self, host, command, timeout=30):
         return self.exec_commands(host, [command], timeout)[0]
 
     def exec_commands(self, host, commands, timeout=60):
-        self.send_commands(host, commands, timeout)
-        return self.get_result(host, timeout)
-
-    def exec_multihost_commands(self, cmds, shell=False, timeout=60):
+        reqid = self.send_commands(host, commands, timeout)
+        return self.get_result(reqid, timeout)
+
+    # Run commands on multiple hosts in parallel.  "cmds" is a list of
+    # (host, cmd) tuples.  Yields (i, host, result) tuples, where "i" is the
+    # index of the command in "cmds", as soon as each command finishes.
+    # If "rq" is given, then it is used as the response queue, and putting
+    # (STOP_RUNNING, None, None) on it cancels the commands.  "limits" is
+    # the same as for send_commands.
+    def iter_multihost_commands(self, cmds, shell=False, timeout=60, rq=None, limits=None):
         hosts = collections.defaultdict(list)
-        for host, cmd in cmds:
-            hosts[host].append(cmd)
-
-        for host, cmds in hosts.items():
-            self.send_commands(host, cmds, timeout, shell)
+        for i, (host, cmd) in enumerate(cmds):
+            hosts[host].append((i, cmd))
+
+        if rq is None:
+            rq = Queue()
+        batches = {}
+        for host, hostcmds in hosts.items():
+            reqid = self.send_commands(host, [cmd for (i, cmd) in hostcmds], timeout, shell, rq, limits)
+            batches[reqid] = host
+
+        for reqid, idx, res in self._iter_responses(rq, list(batches), timeout):
+            host = batches[reqid]
+            yield hosts[host][idx][0], host, res
+
+    # Same as iter_multihost_commands, but yields (host, result) tuples in
+    # the same order as "cmds".
+    def exec_multihost_commands(self, cmds, shell=False, timeout=60):
+        results = [None] * len(cmds)
+        for i, host, res in self.iter_multihost_commands(cmds, shell, timeout):
+            results[i] = (host, res)
 
-        for host in hosts:
-            for res in self.get_result(host, timeout):
-                yield host, res
+        for res in results:
+            yield res
 
     def host_status(self):
         for h, o in self.masters.items():
@@ -366,4 +1393,3 @@ class MultiMasterManager:
         self.masters = {}
 
     __del__ = shutdown_all
-
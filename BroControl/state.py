@@ -1,8 +1,52 @@
 import json
 import sqlite3
 
+from BroControl import py3bro
 from BroControl.exceptions import RuntimeEnvironmentError
 
+if py3bro.using_py3:
+    _strtypes = (str, )
+    _inttypes = (int, )
+else:
+    _strtypes = (str, unicode)
+    _inttypes = (int, long)
+
+# The per-node state variables that are kept in the "nodes" table (the key
+# of such a variable is the node name followed by the suffix).  Each entry
+# is (suffix, column, types of values that can be stored in the column).
+_nodefields = [
+    ("-expect-running", "expect_running", (bool, )),
+    ("-crashed", "crashed", (bool, )),
+    ("-host", "host", _strtypes),
+    ("-port", "port", _inttypes),
+    ("-pid", "pid", _inttypes),
+]
+
+_nodecolumns = [column for (suffix, column, types) in _nodefields]
+_boolcolumns = [column for (suffix, column, types) in _nodefields if bool in types]
+
+# Returns a tuple (node name, column, types) if the given state variable
+# belongs to the "nodes" table, or None otherwise.  Plugin state variables
+# contain dots, so they are never mistaken for per-node variables.
+def _nodekey(key):
+    for (suffix, column, types) in _nodefields:
+        if not key.endswith(suffix):
+            continue
+
+        name = key[:-len(suffix)]
+        if not name or "." in name:
+            return None
+
+        return (name, column, types)
+
+    return None
+
+# Returns True if the value can be stored in the "nodes" table.  Values of
+# other types are stored in the "state" table as usual.
+def _typed(nodekey, value):
+    return value is None or type(value) in nodekey[2]
+
+
 class SqliteState:
     def __init__(self, path):
         self.path = path
@@ -14,18 +58,41 @@ class SqliteState:
 
         self.c = self.db.cursor()
 
+        # The data version at the last call of changed().
+        self.data_version = None
+
         try:
             self.setup()
         except sqlite3.Error as err:
             raise RuntimeEnvironmentError("%s: %s\nCheck if the user running BroControl has write access to the database file.\nOtherwise, the database file is possibly corrupt." % (err, path))
 
     def setup(self):
-        # Create table
+        # With a write-ahead log, a commit needs fewer writes to disk and
+        # readers do not block the writer.
+        self.c.execute("PRAGMA journal_mode=WAL")
+
+        # Create tables
         self.c.execute('''CREATE TABLE IF NOT EXISTS state (
             key   TEXT  PRIMARY KEY  NOT NULL,
             value TEXT
         )''')
 
+        self.c.execute('''CREATE TABLE IF NOT EXISTS nodes (
+            name           TEXT  PRIMARY KEY  NOT NULL,
+            pid            INTEGER,
+            host           TEXT,
+            port           INTEGER,
+            crashed        INTEGER,
+            expect_running INTEGER
+        )''')
+
+        # Move per-node variables written by older versions to the new table.
+        self.c.execute("SELECT key, value FROM state")
+        old = [(k, json.loads(v)) for (k, v) in self.c.fetchall()]
+        old = [(k, v) for (k, v) in old if _nodekey(k) and _typed(_nodekey(k), v)]
+        if old:
+            self._setmany(old)
+
         self.db.commit()
 
     def get(self, key):
@@ -33,17 +100,92 @@ class SqliteState:
         records = self.c.fetchall()
         if records:
             return json.loads(records[0][0])
+
+        nodekey = _nodekey(key)
+        if nodekey:
+            (name, column, types) = nodekey
+            self.c.execute("SELECT %s FROM nodes WHERE name=?" % column, [name])
+            records = self.c.fetchall()
+            if records:
+                return self._fromcolumn(column, records[0][0])
+
         return None
 
     def set(self, key, value):
-        value = json.dumps(value)
+        self.setmany([(key, value)])
+
+    # Set the variables in the list of (key, value) tuples "items" in a
+    # single transaction.
+    def setmany(self, items):
         try:
-            self.c.execute("REPLACE INTO state (key, value) VALUES (?,?)", [key, value])
+            self._setmany(items)
         except sqlite3.Error as err:
+            self.db.rollback()
             raise RuntimeEnvironmentError("%s: %s\nCheck if the user running BroControl has write access to the database file." % (err, self.path))
 
         self.db.commit()
 
+    def _setmany(self, items):
+        plain = []
+        nodes = {}
+        for (key, value) in items:
+            nodekey = _nodekey(key)
+            if nodekey and _typed(nodekey, value):
+                nodes.setdefault(nodekey[0], {})[nodekey[1]] = value
+                # A variable is stored in only one of the tables.
+                plain.append((key, None))
+                continue
+
+            if nodekey:
+                nodes.setdefault(nodekey[0], {})[nodekey[1]] = None
+            plain.append((key, json.dumps(value)))
+
+        self.c.executemany("DELETE FROM state WHERE key=?", [(k, ) for (k, v) in plain if v is None])
+        self.c.executemany("REPLACE INTO state (key, value) VALUES (?,?)", [(k, v) for (k, v) in plain if v is not None])
+
+        for (name, columns) in nodes.items():
+            self.c.execute("INSERT OR IGNORE INTO nodes (name) VALUES (?)", [name])
+            cols = sorted(columns)
+            assignments = ", ".join(["%s=?" % col for col in cols])
+            self.c.execute("UPDATE nodes SET %s WHERE name=?" % assignments,
+                           [columns[col] for col in cols] + [name])
+
+    def setdefault(self, key, value):
+        if self.get(key) is None:
+            self.set(key, value)
+
+    # Returns True if another process has committed changes to the database
+    # since the previous call (or if this is the first call).  Our own
+    # changes do not count.
+    def changed(self):
+        try:
+            self.c.execute("PRAGMA data_version")
+            row = self.c.fetchone()
+        except sqlite3.Error:
+            row = None
+
+        # Old versions of SQLite don't support this.
+        if not row:
+            return True
+
+        changed = row[0] != self.data_version
+        self.data_version = row[0]
+        return changed
+
     def items(self):
         self.c.execute("SELECT key, value FROM state")
-        return [(k, json.loads(v)) for (k, v) in self.c.fetchall()]
+        items = [(k, json.loads(v)) for (k, v) in self.c.fetchall()]
+
+        self.c.execute("SELECT name, %s FROM nodes" % ", ".join(_nodecolumns))
+        for row in self.c.fetchall():
+            name = row[0]
+            for ((suffix, column, types), value) in zip(_nodefields, row[1:]):
+                if value is not None:
+                    items.append((name + suffix, self._fromcolumn(column, value)))
+
+        return items
+
+    def _fromcolumn(self, column, value):
+        if value is not None and column in _boolcolumns:
+            return bool(value)
+        return value
@@ -1,5 +1,6 @@
 import os
 import errno
+import multiprocessing
 
 from BroControl import config
 
@@ -51,3 +52,10 @@ def number_unit_str(num):
             return "%3.0f%s" % (num / factor, unit)
     return " %3.0f" % (num)
 
+
+# Returns the number of CPUs of the local machine (1 if unknown).
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
@@ -46,6 +46,10 @@ def result(id, since=0):
     since = int(since)
     return {"log": app.daemon.getlog(id, since) or []}
 
+@app.route('/health')
+def health():
+    return {"health": app.daemon.call("health")}
+
 @app.route('/:cmd')
 def cmd(cmd):
     i = app.daemon.call(cmd)
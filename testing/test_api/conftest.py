@@ -0,0 +1,21 @@
+import sys
+
+import pytest
+
+from BroControl import ssh_runner
+
+
+# The muxer is normally run by the Python interpreter that was found at
+# build time, so substitute the one that runs the tests.
+@pytest.fixture
+def muxer(monkeypatch):
+    get_muxer = ssh_runner.get_muxer
+    python = sys.executable.encode()
+    monkeypatch.setattr(ssh_runner, "get_muxer", lambda: get_muxer().replace(b"@PYTHON_EXECUTABLE@", python))
+
+# Returns an SSHMaster that runs the muxer on the local host.
+@pytest.fixture
+def master(muxer):
+    m = ssh_runner.SSHMaster("localhost", ["localhost"])
+    yield m
+    m.close()
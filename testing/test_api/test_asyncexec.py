@@ -0,0 +1,105 @@
+from __future__ import print_function
+import sys
+import time
+from threading import Thread
+
+import pytest
+
+if sys.version_info < (3, 5):
+    pytest.skip("the asyncio-based engine requires Python 3.5", allow_module_level=True)
+
+from BroControl import asyncexec
+from BroControl import ssh_runner
+
+HOST = "localhost"
+
+@pytest.fixture
+def runner(muxer):
+    r = asyncexec.AsyncMultiMasterManager([HOST])
+    yield r
+    r.shutdown_all()
+
+def test_run_commands(runner):
+    cmds = [(HOST, ["echo", "one"]), (HOST, ["sh", "-c", "echo two >&2; exit 2"])]
+    results = runner.exec_multihost_commands(cmds, timeout=10)
+
+    assert [host for (host, res) in results] == [HOST, HOST]
+    assert results[0][1].status == 0
+    assert results[0][1].stdout == "one\n"
+    assert results[1][1].status == 2
+    assert results[1][1].stderr == "two\n"
+
+def test_completion_order(runner):
+    cmds = [(HOST, ["sleep", "0.5"]), (HOST, ["true"])]
+    order = [i for (i, host, res) in runner.iter_multihost_commands(cmds, timeout=10)]
+    assert order == [1, 0]
+
+def test_connection_lost(runner):
+    # Kill the muxer once the batch has been sent.
+    def kill_muxer():
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            master = runner.masters.get(HOST)
+            if master and master.requests:
+                master.proc.kill()
+                return
+            time.sleep(0.05)
+
+    t = Thread(target=kill_muxer)
+    t.start()
+    results = runner.iter_multihost_commands([(HOST, ["sleep", "30"])], timeout=60)
+    i, host, res = next(results)
+    t.join()
+    assert isinstance(res, Exception)
+    assert "Lost connection" in str(res)
+
+    # The next batch reconnects.
+    assert runner.exec_multihost_commands([(HOST, ["echo", "hi"])], timeout=10)[0][1].stdout == "hi\n"
+
+def test_garbled_frame(runner, monkeypatch):
+    def garbled(payload):
+        raise ValueError("garbled frame")
+
+    monkeypatch.setattr(ssh_runner, "decode_result", garbled)
+    i, host, res = list(runner.iter_multihost_commands([(HOST, ["true"])], timeout=10))[0]
+    assert isinstance(res, Exception)
+    assert "garbled frame" in str(res)
+
+def test_run_localcmds(runner):
+    cmds = [(i, "echo %d" % i, "", None) for i in range(5)] + [("env", "sh -c 'echo $FOO'", "FOO=bar", None), ("in", "cat", "", "input")]
+    results = runner.run_localcmds(cmds, maxprocs=2)
+
+    assert results[:5] == [(i, True, "%d\n" % i) for i in range(5)]
+    assert results[5] == ("env", True, "bar\n")
+    assert results[6] == ("in", True, "input")
+
+def test_run_localcmds_binary_output(runner):
+    results = runner.run_localcmds([("bin", "printf '\\377a'", "", None)])
+    assert results == [("bin", True, "\ufffda")]
+
+def test_host_limit(runner, monkeypatch):
+    runner.set_limits(2, {})
+    master = asyncexec.AsyncSSHMaster(HOST, [HOST])
+    runner.masters[HOST] = master
+    run_batch = master.run_batch
+    inflight = []
+
+    async def counting_run_batch(*args):
+        inflight.append(len(master.requests) + 1)
+        await run_batch(*args)
+
+    monkeypatch.setattr(master, "run_batch", counting_run_batch)
+    cmds = [(HOST, ["sleep", "0.2"])] * 5
+    results = runner.exec_multihost_commands(cmds, timeout=10)
+
+    assert [res.status for (host, res) in results] == [0] * 5
+    assert len(inflight) == 5
+    assert max(inflight) == 2
+
+async def _wait_for_request(runner):
+    import asyncio
+    while True:
+        master = runner.masters.get(HOST)
+        if master and master.requests:
+            return master
+        await asyncio.sleep(0.05)
@@ -0,0 +1,142 @@
+from __future__ import print_function
+import socket
+import time
+
+from BroControl import config
+from BroControl.config import FactCache
+
+def test_factcache_get(tmpdir):
+    calls = []
+    def func():
+        calls.append(1)
+        return ["10.0.0.1"]
+
+    facts = FactCache(str(tmpdir.join("facts.json")))
+    assert facts.get("addrs", "key", func) == ["10.0.0.1"]
+    assert facts.get("addrs", "key", func) == ["10.0.0.1"]
+    assert len(calls) == 1
+
+    # A different key invalidates the fact.
+    assert facts.get("addrs", "other", func) == ["10.0.0.1"]
+    assert len(calls) == 2
+
+def test_factcache_maxage(tmpdir, monkeypatch):
+    facts = FactCache(str(tmpdir.join("facts.json")))
+    facts.put("os", "key", "Linux")
+    assert facts.lookup("os", "key", 60) == "Linux"
+
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 61)
+    assert facts.lookup("os", "key", 60) is None
+
+def test_factcache_save(tmpdir):
+    path = str(tmpdir.join("facts.json"))
+    facts = FactCache(path)
+    facts.put("time", ["host", "/bin"], "/usr/bin/time")
+    facts.save()
+    assert not facts.dirty
+
+    # The facts are kept across broctl invocations.
+    facts = FactCache(path)
+    assert facts.lookup("time", ["host", "/bin"]) == "/usr/bin/time"
+    assert facts.lookup("time", ["host", "/usr/bin"]) is None
+
+def test_factcache_corrupt(tmpdir):
+    path = tmpdir.join("facts.json")
+    path.write("not json")
+    assert FactCache(str(path)).lookup("os", "key") is None
+
+def test_local_addrs_id(monkeypatch):
+    assert config.local_addrs_id("host") == config.local_addrs_id("host")
+    assert config.local_addrs_id("host") != config.local_addrs_id("other")
+
+    if hasattr(socket, "if_nameindex"):
+        key = config.local_addrs_id("host")
+        interfaces = socket.if_nameindex()
+        monkeypatch.setattr(socket, "if_nameindex", lambda: interfaces + [(999, "new0")])
+        assert config.local_addrs_id("host") != key
+
+# Stands in for socket.getaddrinfo and counts the lookups of each host.
+class FakeResolver:
+    def __init__(self, addrs):
+        self.addrs = addrs
+        self.lookups = []
+
+    def __call__(self, host, port, family=0, type=0, proto=0):
+        self.lookups.append(host)
+        if len(host) > 63:
+            raise UnicodeError("label too long")
+        if host not in self.addrs:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [(socket.AF_INET, socket.SOCK_STREAM, proto, "", (addr, 0)) for addr in self.addrs[host]]
+
+def make_config(tmpdir):
+    nodecfg = tmpdir.join("node.cfg")
+    nodecfg.write("")
+    cfg = config.Configuration.__new__(config.Configuration)
+    cfg.nodecfg = str(nodecfg)
+    cfg.facts = FactCache(str(tmpdir.join("facts.json")))
+    return cfg
+
+def test_resolve_hosts_once(tmpdir, monkeypatch):
+    resolver = FakeResolver({"host1": ["10.0.0.1"], "host2": ["10.0.0.2", "10.0.0.3"]})
+    monkeypatch.setattr(socket, "getaddrinfo", resolver)
+    cfg = make_config(tmpdir)
+
+    hostaddrs = cfg._resolve_hosts(["host1", "host2", "host1", "host2", "host1"])
+    assert hostaddrs == {"host1": (["10.0.0.1"], None), "host2": (["10.0.0.2", "10.0.0.3"], None)}
+    assert sorted(resolver.lookups) == ["host1", "host2"]
+
+    # The addresses are cached.
+    assert cfg._resolve_hosts(["host1", "host2"]) == hostaddrs
+    assert len(resolver.lookups) == 2
+
+def test_resolve_hosts_ttl(tmpdir, monkeypatch):
+    resolver = FakeResolver({"host1": ["10.0.0.1"]})
+    monkeypatch.setattr(socket, "getaddrinfo", resolver)
+    cfg = make_config(tmpdir)
+
+    cfg._resolve_hosts(["host1"])
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + config.DNS_TTL - 1)
+    cfg._resolve_hosts(["host1"])
+    assert resolver.lookups == ["host1"]
+
+    monkeypatch.setattr(time, "time", lambda: now + config.DNS_TTL + 1)
+    cfg._resolve_hosts(["host1"])
+    assert resolver.lookups == ["host1", "host1"]
+
+def test_resolve_hosts_nodecfg_changed(tmpdir, monkeypatch):
+    resolver = FakeResolver({"host1": ["10.0.0.1"]})
+    monkeypatch.setattr(socket, "getaddrinfo", resolver)
+    cfg = make_config(tmpdir)
+
+    cfg._resolve_hosts(["host1"])
+    tmpdir.join("node.cfg").write("[worker-1]\n")
+    cfg._resolve_hosts(["host1"])
+    assert resolver.lookups == ["host1", "host1"]
+
+def test_resolve_hosts_failure(tmpdir, monkeypatch):
+    resolver = FakeResolver({"host1": ["10.0.0.1"]})
+    monkeypatch.setattr(socket, "getaddrinfo", resolver)
+    cfg = make_config(tmpdir)
+
+    hostaddrs = cfg._resolve_hosts(["host1", "nosuchhost"])
+    assert hostaddrs["nosuchhost"] == (None, "Name or service not known")
+    assert hostaddrs["host1"] == (["10.0.0.1"], None)
+
+    # Failed lookups are not cached, so they are retried.
+    resolver.addrs["nosuchhost"] = ["10.0.0.9"]
+    hostaddrs = cfg._resolve_hosts(["host1", "nosuchhost"])
+    assert hostaddrs["nosuchhost"] == (["10.0.0.9"], None)
+    assert sorted(resolver.lookups) == ["host1", "nosuchhost", "nosuchhost"]
+
+def test_resolve_hosts_invalid_name(tmpdir, monkeypatch):
+    resolver = FakeResolver({"host1": ["10.0.0.1"]})
+    monkeypatch.setattr(socket, "getaddrinfo", resolver)
+    cfg = make_config(tmpdir)
+
+    # Errors other than failed lookups are reported for the host as well.
+    hostaddrs = cfg._resolve_hosts(["host1", "x" * 64])
+    assert hostaddrs["x" * 64] == (None, "label too long")
+    assert hostaddrs["host1"] == (["10.0.0.1"], None)
@@ -0,0 +1,140 @@
+from __future__ import print_function
+import json
+import os
+import socket
+import time
+from threading import Thread
+
+import pytest
+
+from BroControl import connbroker
+
+HOST = "localhost"
+
+@pytest.fixture
+def broker(muxer, tmpdir):
+    path = str(tmpdir.join("broker.sock"))
+    t = Thread(target=connbroker.serve, args=(path, [HOST]))
+    t.daemon = True
+    t.start()
+
+    deadline = time.time() + 5
+    while not connbroker.connect(path, [HOST]):
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+    return path
+
+# Send a request to the broker and return the socket and a file to read
+# the answer from.
+def request(path, req):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    sock.sendall(json.dumps(req).encode() + b"\n")
+    return sock, sock.makefile("rb")
+
+def read_answer(f):
+    msgs = []
+    for line in f:
+        msgs.append(json.loads(line.decode()))
+        if "done" in msgs[-1]:
+            break
+    return msgs
+
+def run_request(cmds, limits=(0, {}), shell=False):
+    return {"op": "run", "cmds": cmds, "shell": shell, "timeout": 10, "limits": list(limits)}
+
+def test_protocol(broker):
+    sock, f = request(broker, run_request([[HOST, ["echo", "one"]], [HOST, ["false"]]]))
+    msgs = read_answer(f)
+    sock.close()
+
+    assert msgs[-1] == {"done": True}
+    results = dict((m["i"], m["result"]) for m in msgs[:-1])
+    assert sorted(results) == [0, 1]
+    assert results[0][0] == 0
+    assert results[0][1] == "one\n"
+    assert results[1][0] == 1
+
+    sock, f = request(broker, {"op": "status"})
+    assert json.loads(f.readline().decode()) == []
+    sock.close()
+
+def test_client(broker):
+    client = connbroker.connect(broker, [HOST])
+    results = list(client.iter_multihost_commands([(HOST, ["echo", "hi"])]))
+    assert len(results) == 1
+    i, host, res = results[0]
+    assert (i, host) == (0, HOST)
+    assert res.stdout == "hi\n"
+    assert client.fallback is None
+
+def test_cancel_on_disconnect(broker, tmpdir):
+    pidfile = str(tmpdir.join("pid"))
+    sock, f = request(broker, run_request([[HOST, "echo $$ > %s; exec sleep 30" % pidfile]], shell=True))
+
+    deadline = time.time() + 5
+    while not (os.path.exists(pidfile) and os.path.getsize(pidfile)):
+        assert time.time() < deadline
+        time.sleep(0.05)
+    with open(pidfile) as pf:
+        pid = int(pf.read())
+
+    # Closing the connection kills the command.
+    f.close()
+    sock.close()
+
+    deadline = time.time() + 5
+    while os.path.exists("/proc/%d" % pid):
+        with open("/proc/%d/stat" % pid) as st:
+            if st.read().split(")")[-1].split()[0] == "Z":
+                break
+        assert time.time() < deadline, "command was not cancelled"
+        time.sleep(0.05)
+
+def test_limits_per_request(broker):
+    sleeps = [[HOST, ["sleep", "0.5"]], [HOST, ["sleep", "0.5"]]]
+    sock1, f1 = request(broker, run_request(sleeps, (1, {})))
+    sock2, f2 = request(broker, run_request(sleeps, (0, {})))
+
+    # The first request runs one command at a time, the second one is not
+    # limited (not even by the limit of the first request).
+    limited = [m["result"] for m in read_answer(f1)[:-1]]
+    unlimited = [m["result"] for m in read_answer(f2)[:-1]]
+    sock1.close()
+    sock2.close()
+
+    assert max([res[5] for res in limited]) >= 0.4
+    assert max([res[5] for res in unlimited]) < 0.4
+
+def test_fallback(muxer, tmpdir):
+    path = str(tmpdir.join("broker.sock"))
+
+    # A broker that goes away in the middle of a request.
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+
+    def serve_once():
+        conn, _ = listener.accept()
+        conn.makefile("rb").readline()
+        conn.close()
+        listener.close()
+        os.unlink(path)
+
+    t = Thread(target=serve_once)
+    t.start()
+
+    client = connbroker.BrokerClient(path, [HOST])
+    results = list(client.iter_multihost_commands([(HOST, ["echo", "one"])]))
+    t.join()
+
+    assert len(results) == 1
+    assert isinstance(results[0][2], Exception)
+    assert "Lost connection to connection broker" in str(results[0][2])
+
+    # Subsequent requests run the commands without the broker.
+    results = list(client.iter_multihost_commands([(HOST, ["echo", "two"])]))
+    assert results[0][2].stdout == "two\n"
+    assert client.fallback is not None
+    client.shutdown_all()
@@ -0,0 +1,260 @@
+from __future__ import print_function
+import threading
+import time
+
+import pytest
+
+from BroControl import control
+from BroControl import health
+from BroControl import install
+
+class FakeNode:
+    def __init__(self, name, type, addr, pid=None):
+        self.name = name
+        self.type = type
+        self.addr = addr
+        self.host = addr
+        self.pid = pid
+        self.crashed = False
+
+    def __repr__(self):
+        return self.name
+
+    def cwd(self):
+        return "/tmp/%s" % self.name
+
+    def setExpectRunning(self, val):
+        pass
+
+    def getPID(self):
+        return self.pid
+
+    def setPID(self, pid):
+        self.pid = pid
+
+    def clearPID(self):
+        self.pid = None
+
+    def hasCrashed(self):
+        return self.crashed
+
+    def setCrashed(self):
+        self.crashed = True
+
+    def clearCrashed(self):
+        self.crashed = False
+
+class FakeConfig:
+    maxhoststarts = 0
+    startstagger = 0
+    starttimeout = 3
+    stoptimeout = 1
+    commandtimeout = 10
+    statslogenable = False
+
+    def flush_state(self):
+        pass
+
+class FakeUI:
+    def __init__(self):
+        self.msgs = []
+
+    def info(self, txt):
+        self.msgs.append(txt)
+
+    error = info
+
+# Runs the start-node and stop-node helpers by recording the order in
+# which the nodes were started or stopped.  The nodes in "failing" fail,
+# and those in "slow" take a while.
+class FakeExecutor:
+    def __init__(self, failing=(), slow=()):
+        self.failing = failing
+        self.slow = slow
+        self.order = []
+        self.lock = threading.Lock()
+
+    def run_helper(self, cmds, shell=False):
+        # All nodes with a PID are up.
+        results = []
+        for (node, cmd, args) in cmds:
+            if cmd == "node-status":
+                pids = args[::2]
+                self.order += pids
+                results += [(node, True, "".join(["%s 1 100 10 5 RUNNING 1500000000\n" % pid for pid in pids]))]
+            else:
+                results += [(node, True, "".join(["%s running\n" % pid for pid in args]))]
+        return results
+
+    def iter_helper(self, cmds, shell=False, timeout=None):
+        for (node, cmd, args) in cmds:
+            if node.name in self.slow:
+                time.sleep(0.5)
+            with self.lock:
+                self.order.append(node.name)
+            if node.name in self.failing:
+                yield (node, False, "failed")
+            elif cmd == "start-node":
+                yield (node, True, "%d\nrunning\n" % (len(self.order) + 100))
+            else:
+                yield (node, True, "terminated\nstopped\n0\n")
+
+def cluster(pid=None):
+    return [FakeNode("manager", "manager", "host1", pid),
+            FakeNode("proxy-1", "proxy", "host1", pid),
+            FakeNode("proxy-2", "proxy", "host2", pid),
+            FakeNode("worker-1", "worker", "host2", pid),
+            FakeNode("worker-2", "worker", "host3", pid)]
+
+@pytest.fixture
+def make_controller(monkeypatch):
+    monkeypatch.setattr(install, "make_broctl_config_sh", lambda ui: None)
+    monkeypatch.setattr(control.Controller, "_start_cmds", lambda self, nodes: [(n, "start-node", []) for n in nodes])
+
+    def make(executor):
+        return control.Controller(FakeConfig(), FakeUI(), executor, None)
+
+    return make
+
+def types_in_order(nodes, names):
+    types = dict((n.name, n.type) for n in nodes)
+    order = []
+    for name in names:
+        if not order or order[-1] != types[name]:
+            order.append(types[name])
+    return order
+
+def test_start_order(make_controller):
+    nodes = cluster()
+    executor = FakeExecutor()
+    results = make_controller(executor).start(nodes)
+
+    assert results.ok
+    assert sorted(executor.order) == sorted([n.name for n in nodes])
+    assert types_in_order(nodes, executor.order) == ["manager", "proxy", "worker"]
+    assert all([n.pid for n in nodes])
+
+def test_start_dependency_failed(make_controller):
+    nodes = cluster()
+    executor = FakeExecutor(failing=["proxy-2"])
+    results = make_controller(executor).start(nodes)
+
+    # The workers are not started if a proxy failed to start.
+    assert not results.ok
+    assert sorted(executor.order) == ["manager", "proxy-1", "proxy-2"]
+    failed = sorted([n.name for (n, success, data) in results.nodes if not success])
+    assert failed == ["proxy-2", "worker-1", "worker-2"]
+
+def test_start_dependency_running(make_controller):
+    nodes = cluster()
+    nodes[0].pid = 42
+    executor = FakeExecutor()
+    results = make_controller(executor).start(nodes)
+
+    # A node that is running already counts as up for the nodes that
+    # depend on it.
+    assert results.ok
+    assert "manager" not in executor.order
+    assert types_in_order(nodes, executor.order) == ["proxy", "worker"]
+
+class InterruptingNode(FakeNode):
+    def setPID(self, pid):
+        raise KeyboardInterrupt
+
+def test_start_interrupted(make_controller):
+    nodes = cluster()
+    nodes[1] = InterruptingNode("proxy-1", "proxy", "host1")
+    executor = FakeExecutor(slow=["proxy-2"])
+    threads = set(threading.enumerate())
+
+    with pytest.raises(KeyboardInterrupt):
+        make_controller(executor).start(nodes)
+
+    # The start waits for the nodes that are still starting, so that they
+    # keep their PIDs and no thread is left behind.
+    assert set(threading.enumerate()) <= threads
+    assert [n.name for n in nodes if n.pid] == ["manager", "proxy-2"]
+
+def test_stop_order(make_controller):
+    nodes = cluster(pid=42)
+    executor = FakeExecutor()
+    results = make_controller(executor).stop(nodes)
+
+    assert results.ok
+    assert types_in_order(nodes, executor.order) == ["worker", "proxy", "manager"]
+    assert not [n for n in nodes if n.pid]
+
+def test_stop_dependency_failed(make_controller):
+    nodes = cluster(pid=42)
+    executor = FakeExecutor(failing=["worker-1"])
+    results = make_controller(executor).stop(nodes)
+
+    # Nodes that a node still running depends on are not stopped.
+    assert not results.ok
+    assert sorted(executor.order) == ["worker-1", "worker-2"]
+    failed = sorted([n.name for (n, success, data) in results.nodes if not success])
+    assert failed == ["manager", "proxy-1", "proxy-2", "worker-1"]
+
+class FakeGlobalConfig:
+    timefmt = "%d %b %H:%M:%S"
+    savetraces = False
+    prefixes = ""
+    sitepolicyscripts = "local.bro"
+    broargs = ""
+
+def check_keys(make_controller, monkeypatch, tmpdir, nodes):
+    monkeypatch.setattr(control.config, "Config", FakeGlobalConfig())
+
+    c = make_controller(FakeExecutor())
+    c.config.policydir = str(tmpdir.join("base"))
+    c.config.policydirsiteinstallauto = str(tmpdir.join("auto"))
+    c.config.sitepolicypath = str(tmpdir.join("site"))
+    c.config.subst = lambda s: s
+
+    names = c._check_script_names(False)
+    return [c._check_key(n, names) for n in nodes]
+
+def workers():
+    nodes = [FakeNode("worker-1", "worker", "host1"), FakeNode("worker-2", "worker", "host2")]
+    for n in nodes:
+        n.env_vars = {}
+    return nodes
+
+def test_check_key(make_controller, monkeypatch, tmpdir):
+    tmpdir.mkdir("site").join("local.bro").write("")
+
+    # Nodes that differ only by their names are checked together.
+    keys = check_keys(make_controller, monkeypatch, tmpdir, workers())
+    assert keys[0] == keys[1]
+
+def test_check_key_prefixed_script(make_controller, monkeypatch, tmpdir):
+    # A script with a node's name as prefix in a subdirectory of any of
+    # the script directories is loaded only for that node.
+    tmpdir.mkdir("site").join("local.bro").write("")
+    tmpdir.mkdir("base").mkdir("misc").join("worker-2.foo.bro").write("")
+
+    keys = check_keys(make_controller, monkeypatch, tmpdir, workers())
+    assert keys[0] != keys[1]
+    assert keys[1] == ("worker-2", )
+
+def test_status_uses_health(make_controller, monkeypatch):
+    monkeypatch.setattr(control.config, "Config", FakeGlobalConfig())
+    nodes = [FakeNode("manager", "manager", "host1", 100), FakeNode("worker-1", "worker", "host2", 200)]
+    executor = FakeExecutor()
+    c = make_controller(executor)
+    c.config.statuscmdshowall = False
+    c.health = health.HealthTable()
+    c.health.set("manager", 100, "up")
+
+    first = dict((n.name, data) for (n, success, data) in c.status(nodes).nodes)
+    assert sorted(executor.order) == ["100", "200"]
+
+    # Once its startup time is known, a node that is up is not probed
+    # again.
+    del executor.order[:]
+    second = dict((n.name, data) for (n, success, data) in c.status(nodes).nodes)
+    assert executor.order == ["200"]
+    assert second["manager"]["status"] == "running"
+    assert second["manager"]["started"] == first["manager"]["started"]
+    assert second["manager"]["cpu"] is None
+    assert second["worker-1"]["cpu"] == 5
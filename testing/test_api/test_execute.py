@@ -0,0 +1,31 @@
+from __future__ import print_function
+
+from BroControl import execute
+
+def test_run_localcmds():
+    cmds = [(i, "echo %d" % i, "", None) for i in range(3)] + [("in", "cat", "", "input")]
+    results = execute.run_localcmds(cmds)
+
+    assert results == [(i, True, "%d\n" % i) for i in range(3)] + [("in", True, "input")]
+
+def test_run_localcmds_bounded():
+    cmds = [(i, "echo %d; exit %d" % (i, i % 2), "", None) for i in range(6)]
+    results = execute.run_localcmds(cmds, maxprocs=2)
+
+    assert results == [(i, i % 2 == 0, "%d\n" % i) for i in range(6)]
+
+def test_run_localcmds_bounded_error(monkeypatch):
+    init = execute._run_localcmd_init
+
+    def failing_init(id, cmd, env):
+        if id == 1:
+            raise OSError("cannot run command")
+        return init(id, cmd, env)
+
+    monkeypatch.setattr(execute, "_run_localcmd_init", failing_init)
+
+    cmds = [(i, "echo %d" % i, "", None) for i in range(4)]
+    results = execute.run_localcmds(cmds, maxprocs=2)
+
+    assert results[1] == (1, False, "cannot run command")
+    assert [r for (i, r) in enumerate(results) if i != 1] == [(i, True, "%d\n" % i) for i in (0, 2, 3)]
@@ -0,0 +1,138 @@
+from __future__ import print_function
+
+import pytest
+
+from BroControl import health
+from BroControl.health import HealthTable, HealthMonitor
+
+# Stands in for the parts of the Broker Python bindings that the monitor
+# uses.
+class FakeBroker:
+    class SC:
+        PeerAdded = 1
+        PeerLost = 2
+        PeerRemoved = 3
+
+    class Status:
+        def __init__(self, code, addr, port):
+            self._code = code
+            self.network = self if addr else None
+            self.address = addr
+            self.port = port
+
+        def code(self):
+            return self._code
+
+        def context(self):
+            return self
+
+class FakeEndpoint:
+    def __init__(self):
+        self.peers = set()
+        self.closed = False
+
+    def make_subscriber(self, topic):
+        pass
+
+    def make_status_subscriber(self, statuses):
+        pass
+
+    def shutdown(self):
+        self.closed = True
+
+    def peer_nosync(self, addr, port, retry):
+        self.peers.add((addr, port))
+
+    def unpeer(self, addr, port):
+        self.peers.remove((addr, port))
+
+@pytest.fixture
+def monitor(monkeypatch):
+    monkeypatch.setattr(health, "broker", FakeBroker)
+    lost = []
+    m = HealthMonitor("bro/control", lost.extend)
+    m.lostnodes = lost
+    return m
+
+def test_table():
+    t = HealthTable()
+    assert not t.isup("worker-1", 10)
+
+    t.set("worker-1", 10, "up")
+    assert t.isup("worker-1", 10)
+    assert not t.isup("worker-1", 11)
+    assert t.get()["worker-1"]["state"] == "up"
+
+    t.set("worker-1", 10, "lost")
+    assert not t.isup("worker-1", 10)
+
+    t.remove("worker-1")
+    assert t.get() == {}
+
+def test_monitor_peering(monitor):
+    endpoint = FakeEndpoint()
+    monitor._set_targets(endpoint, [("manager", "10.0.0.1", 47761, 100), ("worker-1", "10.0.0.2", 47762, 200)])
+    assert endpoint.peers == set([("10.0.0.1", 47761), ("10.0.0.2", 47762)])
+    assert monitor.table.get()["manager"]["state"] == "connecting"
+    assert not monitor.table.isup("manager", 100)
+
+    monitor._handle_status([FakeBroker.Status(FakeBroker.SC.PeerAdded, "10.0.0.1", 47761)])
+    assert monitor.table.isup("manager", 100)
+    assert not monitor.table.isup("worker-1", 200)
+
+    monitor._handle_status([FakeBroker.Status(FakeBroker.SC.PeerLost, "10.0.0.1", 47761)])
+    assert not monitor.table.isup("manager", 100)
+    assert monitor.table.get()["manager"]["state"] == "lost"
+    assert monitor.lostnodes == ["manager"]
+
+    # Nodes that are no longer running are not watched anymore.
+    monitor._set_targets(endpoint, [("worker-1", "10.0.0.2", 47762, 200)])
+    assert endpoint.peers == set([("10.0.0.2", 47762)])
+    assert "manager" not in monitor.table.get()
+
+def test_monitor_restart(monitor):
+    endpoint = FakeEndpoint()
+    monitor._set_targets(endpoint, [("manager", "10.0.0.1", 47761, 100)])
+    monitor._handle_status([FakeBroker.Status(FakeBroker.SC.PeerAdded, "10.0.0.1", 47761)])
+    assert monitor.table.isup("manager", 100)
+
+    # A new process is not up until the peering with it is established.
+    monitor._set_targets(endpoint, [("manager", "10.0.0.1", 47761, 101)])
+    assert not monitor.table.isup("manager", 101)
+    assert not monitor.table.isup("manager", 100)
+
+    monitor._handle_status([FakeBroker.Status(FakeBroker.SC.PeerAdded, "10.0.0.1", 47761)])
+    assert monitor.table.isup("manager", 101)
+
+def test_monitor_ignores_unknown_peers(monitor):
+    endpoint = FakeEndpoint()
+    monitor._set_targets(endpoint, [("manager", "10.0.0.1", 47761, 100), ("standalone", "10.0.0.1", 0, 300)])
+    assert "standalone" not in monitor.table.get()
+
+    monitor._handle_status([FakeBroker.Status(FakeBroker.SC.PeerLost, "10.0.0.9", 47761), "not a status"])
+    monitor._handle_status([FakeBroker.Status(FakeBroker.SC.PeerLost, None, None)])
+    assert monitor.lostnodes == []
+
+class Stop(BaseException):
+    pass
+
+def test_monitor_survives_errors(monitor, monkeypatch):
+    endpoint = FakeEndpoint()
+    monkeypatch.setattr(FakeBroker, "Endpoint", lambda: endpoint, raising=False)
+    monkeypatch.setattr(health, "RETRY_INTERVAL", 0)
+    steps = []
+
+    def step(endpoint, status):
+        steps.append(None)
+        if len(steps) == 1:
+            raise ValueError("bad status")
+        raise Stop()
+
+    monkeypatch.setattr(monitor, "_step", step)
+
+    # An error is logged and the monitor keeps going.
+    with pytest.raises(Stop):
+        monitor.run()
+
+    assert len(steps) == 2
+    assert endpoint.closed
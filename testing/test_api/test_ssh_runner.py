@@ -0,0 +1,151 @@
+from __future__ import print_function
+import json
+import os
+import subprocess
+import sys
+import time
+import zlib
+
+import pytest
+
+from BroControl import ssh_runner
+from BroControl.ssh_runner import FRAME, RESULT, REQID
+
+def test_batch_frame():
+    frame = ssh_runner.batch_frame([["echo", "a"]], 10, False, 7, 2, {"start": 1})
+    ftype, length = FRAME.unpack_from(frame)
+    assert ftype == ssh_runner.FRAME_BATCH
+    assert length == len(frame) - FRAME.size
+
+    batch = json.loads(frame[FRAME.size:].decode())
+    assert batch["id"] == 7
+    assert batch["cmds"] == [["echo", "a"]]
+    assert batch["timeout"] == 10
+    assert batch["limit"] == 2
+    assert batch["limits"] == {"start": 1}
+
+def test_cancel_frame():
+    frame = ssh_runner.cancel_frame(42)
+    assert FRAME.unpack_from(frame) == (ssh_runner.FRAME_CANCEL, REQID.size)
+    assert REQID.unpack(frame[FRAME.size:]) == (42,)
+
+def test_decode_result():
+    out = b"x" * 10000
+    zout = zlib.compress(out)
+    payload = RESULT.pack(3, 1, 2, ssh_runner.FLAG_STDOUT_ZLIB | ssh_runner.FLAG_TIMEOUT,
+                          len(zout), 3, 4, 20000, 1500, 250) + zout + b"err" + b"/tmp"
+
+    reqid, idx, res = ssh_runner.decode_result(payload)
+    assert (reqid, idx) == (3, 1)
+    assert res.status == 2
+    assert res.stdout == out.decode()
+    assert res.stderr == "err"
+    assert res.spilled == "/tmp"
+    assert res.size == 20000
+    assert res.queued == 1.5
+    assert res.runtime == 0.25
+    assert res.killed == "timeout"
+
+def test_muxer_roundtrip(master):
+    results = master.exec_commands([["echo", "one"], "echo two >&2; exit 3"], timeout=10)
+    assert results[0].status == 0
+    assert results[0].stdout == "one\n"
+    assert results[0].spilled is None
+
+    res = master.exec_command("echo two >&2; exit 3", shell=True, timeout=10)
+    assert res.status == 3
+    assert res.stderr == "two\n"
+
+def test_muxer_compress(master):
+    res = master.exec_command("head -c 100000 /dev/zero | tr '\\0' a", shell=True, timeout=10)
+    assert res.stdout == "a" * 100000
+    assert res.size == 100000
+
+def test_muxer_cancel(master):
+    master.send_commands([["sleep", "10"]], 10, reqid=5)
+    master.cancel(5)
+    results = master.collect_results(10, reqid=5)
+    assert results[0].killed == "cancelled"
+
+def test_muxer_spill(master, monkeypatch):
+    monkeypatch.setattr(ssh_runner, "SPILL_SIZE", 1000)
+
+    res = master.exec_command("head -c 3000 /dev/zero | tr '\\0' a; head -c 500 /dev/zero | tr '\\0' b >&2", shell=True, timeout=10)
+    assert res.size == 3500
+    assert res.stdout == "a" * 1000
+    assert res.stderr == ""
+    assert os.path.isfile(res.spilled)
+
+    with open(res.spilled) as f:
+        assert f.read() == "a" * 3000 + "b" * 500
+
+    fetched = master.exec_command([ssh_runner.FETCH_CMD, res.spilled], timeout=10)
+    assert fetched.status == 0
+    assert fetched.stdout == "a" * 3000 + "b" * 500
+    assert not os.path.exists(res.spilled)
+
+def test_muxer_spill_cleanup(master, monkeypatch):
+    monkeypatch.setattr(ssh_runner, "SPILL_SIZE", 10)
+
+    res = master.exec_command(["echo", "more than ten bytes"], timeout=10)
+    assert os.path.isfile(res.spilled)
+
+    # Spill files that were not fetched are removed when the muxer exits.
+    master.close()
+    assert not os.path.exists(res.spilled)
+
+# Returns the CPU time in seconds that process "pid" has used.
+def cpu_time(pid):
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self"), reason="native helpers need /proc")
+def test_muxer_polling_sleeps(master, tmpdir):
+    # The muxer runs the helper natively if it looks like a broctl helper.
+    tmpdir.join("broctl-config.sh").write("")
+    helper = tmpdir.mkdir("helpers").join("wait-status")
+    helper.write("")
+
+    # A process that the muxer takes for Bro.
+    bro = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)", "bro"])
+    try:
+        master.connect()
+        before = cpu_time(master.master.pid)
+        start = time.time()
+        res = master.exec_command([str(helper), "RUNNING", "2", str(tmpdir), str(bro.pid)], timeout=10)
+        elapsed = time.time() - start
+        used = cpu_time(master.master.pid) - before
+    finally:
+        bro.kill()
+        bro.wait()
+
+    assert res.stdout == "timeout\n"
+    assert elapsed >= 2
+    assert used < elapsed * 0.25
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self"), reason="native helpers need /proc")
+def test_muxer_timeout_keeps_started_bro(master, tmpdir):
+    tmpdir.join("broctl-config.sh").write("")
+    helper = tmpdir.mkdir("helpers").join("start")
+    helper.write("")
+    # A run-bro that never writes the .pid file, so the start times out.
+    runbro = tmpdir.join("run-bro")
+    runbro.write("#!/bin/sh\necho $$ > \"$1\"\nexec sleep 30\n")
+    runbro.chmod(0o755)
+    wd = tmpdir.mkdir("wd")
+    marker = tmpdir.join("bro.pid")
+
+    res = master.exec_command([str(helper), str(wd), str(marker), "a", "b"], timeout=1)
+    assert res.killed == "timeout"
+
+    # Killing the start command must not kill Bro, even once the muxer exits.
+    master.close()
+    pid = int(marker.read())
+    try:
+        os.kill(pid, 0)
+    finally:
+        try:
+            os.kill(pid, 9)
+        except OSError:
+            pass
@@ -1,4 +1,8 @@
 from __future__ import print_function
+import json
+import sqlite3
+
+from BroControl.config import Configuration
 from BroControl.state import SqliteState
 
 def test_state_basic():
@@ -42,3 +46,140 @@ def test_state_items():
 
     assert d["a"] == 1
     assert d["b"] == "two"
+
+def test_state_changed(tmpdir):
+    path = str(tmpdir.join("state.db"))
+    s = SqliteState(path)
+    other = SqliteState(path)
+
+    assert s.changed()
+    assert not s.changed()
+
+    s.set("a", 1)
+    assert not s.changed()
+
+    other.set("b", 2)
+    assert s.changed()
+    assert dict(s.items())["b"] == 2
+
+def test_state_node_columns():
+    s = SqliteState(":memory:")
+
+    s.setmany([("worker-1-pid", 1234), ("worker-1-host", "10.0.0.1"),
+               ("worker-1-port", 47762), ("worker-1-crashed", False),
+               ("worker-1-expect-running", True)])
+
+    assert s.get("worker-1-pid") == 1234
+    assert s.get("worker-1-host") == "10.0.0.1"
+    assert s.get("worker-1-port") == 47762
+    assert s.get("worker-1-crashed") is False
+    assert s.get("worker-1-expect-running") is True
+
+    s.c.execute("SELECT pid, host, port, crashed, expect_running FROM nodes WHERE name='worker-1'")
+    assert s.c.fetchall() == [(1234, "10.0.0.1", 47762, 0, 1)]
+    s.c.execute("SELECT count(*) FROM state")
+    assert s.c.fetchone()[0] == 0
+
+    d = dict(s.items())
+    assert d["worker-1-pid"] == 1234
+    assert d["worker-1-crashed"] is False
+
+    s.set("worker-1-pid", None)
+    assert s.get("worker-1-pid") is None
+    assert "worker-1-pid" not in dict(s.items())
+
+def test_state_node_untyped():
+    s = SqliteState(":memory:")
+
+    # Values of other types are kept in the state table.
+    s.set("worker-1-pid", "not a pid")
+    assert s.get("worker-1-pid") == "not a pid"
+    s.c.execute("SELECT pid FROM nodes WHERE name='worker-1'")
+    assert s.c.fetchall() == [(None, )]
+
+    s.set("worker-1-pid", 42)
+    assert s.get("worker-1-pid") == 42
+    s.c.execute("SELECT count(*) FROM state")
+    assert s.c.fetchone()[0] == 0
+
+    # Plugin state variables never go to the nodes table.
+    s.set("plugin.foo-pid", 7)
+    s.c.execute("SELECT value FROM state WHERE key='plugin.foo-pid'")
+    assert s.c.fetchall() == [("7", )]
+    assert s.get("plugin.foo-pid") == 7
+
+def test_state_migration(tmpdir):
+    path = str(tmpdir.join("state.db"))
+
+    # A database written by an older version, which had only one table.
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE state (key TEXT PRIMARY KEY NOT NULL, value TEXT)")
+    old = [("worker-1-pid", 1234), ("worker-1-expect-running", True),
+           ("worker-1-host", "10.0.0.1"), ("plugin.foo-pid", 7),
+           ("broversion", "2.5")]
+    db.executemany("INSERT INTO state VALUES (?, ?)", [(k, json.dumps(v)) for (k, v) in old])
+    db.commit()
+    db.close()
+
+    s = SqliteState(path)
+
+    assert dict(s.items()) == dict(old)
+    s.c.execute("SELECT key FROM state ORDER BY key")
+    assert s.c.fetchall() == [("broversion", ), ("plugin.foo-pid", )]
+    s.c.execute("SELECT name, pid, host, expect_running FROM nodes")
+    assert s.c.fetchall() == [("worker-1", 1234, "10.0.0.1", 1)]
+
+    # Opening it again doesn't change anything.
+    s = SqliteState(path)
+    assert dict(s.items()) == dict(old)
+
+class RecordingState:
+    def __init__(self):
+        self.calls = []
+
+    def setmany(self, items):
+        self.calls.append(("setmany", items))
+
+class NoFacts:
+    def save(self):
+        pass
+
+def make_config(store):
+    cfg = Configuration.__new__(Configuration)
+    cfg.state = {}
+    cfg.state_dirty = {}
+    cfg.state_store = store
+    cfg.facts = NoFacts()
+    return cfg
+
+def test_flush_state_batched():
+    store = RecordingState()
+    cfg = make_config(store)
+
+    cfg.set_state("b", 2)
+    cfg.set_state("A", 1)
+    cfg.set_state("b", 3)
+    assert store.calls == []
+    assert cfg.get_state("b") == 3
+
+    # All changes are written at once.
+    cfg.flush_state()
+    assert store.calls == [("setmany", [("a", 1), ("b", 3)])]
+
+    # Nothing is written if nothing changed.
+    cfg.set_state("a", 1)
+    cfg.flush_state()
+    assert len(store.calls) == 1
+
+def test_flush_state_sqlite(tmpdir):
+    path = str(tmpdir.join("state.db"))
+    cfg = make_config(SqliteState(path))
+
+    cfg.set_state("worker-1-pid", 99)
+    cfg.set_state("key", "value")
+    assert SqliteState(path).get("key") is None
+
+    cfg.flush_state()
+    other = SqliteState(path)
+    assert other.get("worker-1-pid") == 99
+    assert other.get("key") == "value"